@@ -118,6 +118,11 @@ var update_error_count = 0;
 var update_error_threshold = 30;
 var update_error_delta = 1024;
 var update_normal_delta = update_falloff_deltas[0];
+// The state of the last cell update reply, which the server uses to
+// hold the next request until the cell changes (long polling).
+var cell_update_state = null;
+var cell_update_state_id = null;
+var cell_update_request_id = null;
 var cell_output_delta = update_normal_delta;
 
 // Introspection data.
@@ -3408,7 +3413,7 @@ function check_for_cell_update() {
         * makes an async request
         * causes the title bar compute spinner to spin
     */
-    var cell_id, busy_text, num_queued;
+    var cell_id, busy_text, num_queued, params;
 
     // Cancel update checks if no cells are doing computations.
     if (queue_id_list.length === 0) {
@@ -3422,10 +3427,15 @@ function check_for_cell_update() {
     // Check on the "lead" cell currently computing to see what's up.
     cell_id = queue_id_list[0];
 
+    params = {
+        id: cell_id
+    };
+    if (cell_update_state_id === cell_id && cell_update_state !== null) {
+        params.state = cell_update_state;
+    }
+    cell_update_request_id = cell_id;
     async_request(worksheet_command('cell_update'),
-                  check_for_cell_update_callback, { 
-                      id: cell_id 
-                  });
+                  check_for_cell_update_callback, params);
 
     // Spin the little title spinner in the title bar.
     try {
@@ -3460,6 +3470,10 @@ function check_for_cell_update_callback(status, response) {
                            whether/how the cell's computation was 
                            interrupted
             introspect_html -- string; updated introspection text
+            state -- string; sent back with the next request, so
+                     the server can wait until the cell changes
+            held -- string; 'true' if the server held the request
+                    until the cell changed, 'false' otherwise
     */
     var elapsed_time, eval_hook, msg, X;
 
@@ -3498,6 +3512,11 @@ function check_for_cell_update_callback(status, response) {
 
     X = decode_response(response);
 
+    if (X.state !== undefined) {
+        cell_update_state = X.state;
+        cell_update_state_id = cell_update_request_id;
+    }
+
     if (X.status === 'e') {
         cancel_update_check();
         halt_queued_cells();
@@ -3532,6 +3551,11 @@ function check_for_cell_update_callback(status, response) {
         update_count = 0;
         update_falloff_level = 0;
         cell_output_delta = update_falloff_deltas[0];
+    } else if (X.held === 'true') {
+        // The server held this request until there was new output,
+        // so there is no need to back off.  Otherwise (e.g., all its
+        // long poll slots are taken) we fall off as usual.
+        cell_output_delta = update_falloff_deltas[0];
     } else {
         if (update_count > update_falloff_threshold &&
             update_falloff_level + 1 < update_falloff_deltas.length) {
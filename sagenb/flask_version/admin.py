@@ -120,3 +120,14 @@ def notebook_settings():
     return render_template(os.path.join('html', 'settings', 'notebook_settings.html'),
                            **template_dict)
 
+
+@admin.route('/lockstatistics')
+@admin_required
+def lock_statistics():
+    """
+    Return how often and how long requests waited for each kind of
+    lock, to show where they still wait for each other.
+    """
+    from sagenb.misc.locks import lock_statistics
+    from sagenb.notebook.misc import encode_response
+    return encode_response(lock_statistics())
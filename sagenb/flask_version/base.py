@@ -3,10 +3,11 @@ from __future__ import absolute_import
 import os
 import time
 import re
+import threading
 from functools import partial
 from flask import Flask, Blueprint, url_for, request, session, redirect, g, make_response, current_app, render_template
 from .decorators import login_required, guest_or_login_required, with_lock
-from .decorators import global_lock
+from .decorators import notebook_lock
 # Make flask use the old session foo from <=flask-0.9
 from flask_oldsessions import OldSecureCookieSessionInterface
 
@@ -351,30 +352,57 @@ def set_profiles():
 ############################
 # Notebook autosave.
 ############################
-# save if make a change to notebook and at least some seconds have elapsed since last save.
+# A background thread saves the changes to the notebook every
+# save_interval seconds, so that no request has to wait for a save.
 def init_updates():
-    global save_interval, idle_interval, last_save_time, last_idle_time
+    global idle_interval, last_idle_time
     from sagenb.misc.misc import walltime
 
-    save_interval = notebook.conf()['save_interval']
     idle_interval = notebook.conf()['idle_check_interval']
-    last_save_time = walltime()
     last_idle_time = walltime()
 
-def notebook_save_check():
-    global last_save_time
-    from sagenb.misc.misc import walltime
+notebook_saver = None
+
+def start_notebook_saver():
+    global notebook_saver
+    if notebook_saver is None:
+        notebook_saver = threading.Thread(target=notebook_save_loop,
+                                          name='notebook saver')
+        notebook_saver.daemon = True
+        notebook_saver.start()
+
+def notebook_save_loop():
+    while True:
+        # %save_server in a cell wakes us up early
+        notebook.wait_for_save_request(max(notebook.conf()['save_interval'], 1))
+        notebook_save()
+        if not notebook.supervisor().is_alive():
+            # otherwise the supervisor unloads the idle worksheets
+            notebook_evict()
+
+def notebook_save():
+    from .worksheet import worksheet_locks
+    try:
+        # the users are changed by requests holding notebook_lock (or
+        # their user lock, which is only taken with the reader side of
+        # notebook_lock), and each worksheet by requests holding its
+        # worksheet lock
+        notebook.save(lock=notebook_lock.writer,
+                      worksheet_lock=lambda W: worksheet_locks[W.filename()])
+    except Exception:
+        import traceback
+        print("Error saving the notebook:\n%s" % traceback.format_exc())
+
+def notebook_evict():
+    from .worksheet import worksheet_locks
+    try:
+        notebook.evict_idle_worksheets(
+            worksheet_lock=lambda W: worksheet_locks[W.filename()])
+    except Exception:
+        import traceback
+        print("Error unloading worksheets:\n%s" % traceback.format_exc())
 
-    t = walltime()
-    if t > last_save_time + save_interval:
-        with global_lock:
-            # if someone got the lock before we did, they might have saved,
-            # so we check against the last_save_time again
-            # we don't put the global_lock around the outer loop since we don't need
-            # it unless we are actually thinking about saving.
-            if t > last_save_time + save_interval:
-                notebook.save()
-                last_save_time = t
+idle_lock = threading.Lock()
 
 def notebook_idle_check():
     global last_idle_time
@@ -382,20 +410,24 @@ def notebook_idle_check():
 
     t = walltime()
 
-    if t > last_idle_time + idle_interval:
-        with global_lock:
+    # Only one request checks for idle worksheets; the others do not
+    # wait for it.
+    if t > last_idle_time + idle_interval and idle_lock.acquire(False):
+        try:
             # if someone got the lock before we did, they might have already idled,
             # so we check against the last_idle_time again
-            # we don't put the global_lock around the outer loop since we don't need
-            # it unless we are actually thinking about quitting worksheets
             if t > last_idle_time + idle_interval:
                 notebook.update_worksheet_processes()
                 notebook.quit_idle_worksheet_processes()
                 last_idle_time = t
+        finally:
+            idle_lock.release()
 
 def notebook_updates():
-    notebook_save_check()
-    notebook_idle_check()
+    # The supervisor quits idle worksheet processes in the background;
+    # requests only do it if it is not running.
+    if not notebook.supervisor().is_alive():
+        notebook_idle_check()
 
 
 notebook = None
@@ -443,6 +475,17 @@ def create_app(path_to_notebook, *args, **kwds):
         if def_lang not in trans_ids:
             notebook.conf()['default_language'] = None
 
+    # Start the background threads and the pre-started worksheet
+    # processes only once the server runs, so that they are not lost
+    # if the server forks.
+    @app.before_first_request
+    def start_background_tasks():
+        from .worksheet import worksheet_locks
+        start_notebook_saver()
+        notebook.start_supervisor(
+            worksheet_lock=lambda W: worksheet_locks[W.filename()])
+        notebook.worksheet_process_pool()
+
     #register callback function for locale selection
     #this function must be modified to add per user language support
     @babel.localeselector
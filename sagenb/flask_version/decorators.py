@@ -3,8 +3,13 @@ from flask import Flask, url_for, render_template, request, session, redirect, g
 from flask_babel import Babel, gettext, ngettext, lazy_gettext
 _ = gettext
 
-from threading import Lock
-global_lock = Lock()
+from sagenb.misc.locks import RWLock, LockRegistry
+# The notebook wide structures (the user manager and the server
+# configuration) are changed by requests holding the writer side, and
+# read by requests holding the reader side.
+notebook_lock = RWLock('notebook')
+# The lock of each user, by username.
+user_locks = LockRegistry('user')
 
 def login_required(f):
     @wraps(f)
@@ -43,8 +48,25 @@ def guest_or_login_required(f):
     return wrapper
 
 def with_lock(f):
+    """
+    Run the view with exclusive access to the notebook wide
+    structures, e.g., to add or delete users.
+    """
     @wraps(f)
     def wrapper(*args, **kwds):
-        with global_lock:
+        with notebook_lock.writer:
             return f(*args, **kwds)
     return wrapper
+
+def with_user_lock(f):
+    """
+    Run the view holding the lock of the current user, e.g., to change
+    the settings of that user, while other users are served
+    concurrently.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        with notebook_lock.reader:
+            with user_locks[g.username]:
+                return f(*args, **kwds)
+    return wrapper
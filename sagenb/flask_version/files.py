@@ -0,0 +1,140 @@
+"""
+Serving the cell output files and data files of worksheets
+
+Plots, animations and data files can be large, so they are sent with
+an ETag and a Last-Modified date, and browsers revalidate them (the
+names of cell output files are reused by later evaluations) instead of
+downloading them again.  Single byte ranges are supported, so that
+videos can be seeked and downloads resumed.  The file itself is
+streamed with ``wsgi.file_wrapper`` if the WSGI server has it.
+
+If the notebook runs behind a web server, the sending can be left to
+it with the ``sendfile_header`` server setting:
+
+- ``X-Sendfile`` (Apache with mod_xsendfile, lighttpd) sends the
+  absolute path of the file, and
+
+- ``X-Accel-Redirect`` (nginx) sends the URI of the file below
+  ``sendfile_prefix``, an internal location of the web server that
+  serves the ``home`` directory of the notebook directory, e.g.::
+
+      location /_sagenb_home/ {
+          internal;
+          alias /path/to/notebook.sagenb/home/;
+      }
+"""
+from __future__ import absolute_import
+import calendar
+import mimetypes
+import os
+
+from flask import request, current_app, g, abort
+from flask.helpers import safe_join
+from werkzeug.wsgi import wrap_file
+from six.moves.urllib.parse import quote
+
+# bytes read at a time for a range of a file
+CHUNK_SIZE = 65536
+
+
+def file_etag(st):
+    """
+    Return the ETag of a file with the stat result ``st``.
+    """
+    return 'sagenb-%x-%x-%x' % (st.st_ino, int(st.st_mtime), st.st_size)
+
+
+def is_not_modified(etag, mtime):
+    """
+    Return True if the client has the current version of the file
+    with the given ETag and modification time.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return int(mtime) <= since
+    return False
+
+
+def requested_range(etag, mtime, size):
+    """
+    Return None to send the whole file, the pair ``(start, stop)`` of
+    the single byte range requested, or False if the requested range
+    is not satisfiable.
+    """
+    rng = request.range
+    if rng is None or rng.units != 'bytes' or len(rng.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and calendar.timegm(if_range.date.utctimetuple()) != int(mtime):
+        return None
+    r = rng.range_for_length(size)
+    return False if r is None else r
+
+
+def read_range(f, length):
+    try:
+        while length > 0:
+            data = f.read(min(length, CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def send_worksheet_file(worksheet, directory, filename):
+    """
+    Return the response sending the file ``filename`` of the
+    directory ``directory`` of ``worksheet``, e.g., its cells
+    directory.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    st = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = current_app.response_class(mimetype=mimetype,
+                                          direct_passthrough=True)
+
+    header = g.notebook.conf()['sendfile_header']
+    if header == 'X-Sendfile':
+        response.headers['X-Sendfile'] = path
+        return response
+    if header == 'X-Accel-Redirect':
+        location = '/'.join([g.notebook.conf()['sendfile_prefix'].rstrip('/'),
+                             worksheet.filename(),
+                             os.path.relpath(path, worksheet.directory())])
+        response.headers['X-Accel-Redirect'] = quote(location.encode('utf-8'))
+        return response
+
+    etag = file_etag(st)
+    response.set_etag(etag)
+    response.last_modified = int(st.st_mtime)
+    response.cache_control.no_cache = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    if is_not_modified(etag, st.st_mtime):
+        response.status_code = 304
+        return response
+
+    r = requested_range(etag, st.st_mtime, st.st_size)
+    if r is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */%d' % st.st_size
+        return response
+    f = open(path, 'rb')
+    if r is None:
+        response.response = wrap_file(request.environ, f)
+        response.content_length = st.st_size
+    else:
+        start, stop = r
+        f.seek(start)
+        response.response = read_range(f, stop - start)
+        response.status_code = 206
+        response.content_length = stop - start
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, st.st_size)
+    return response
@@ -1,16 +1,20 @@
 import os
 import random
 from flask import Blueprint, url_for, render_template, request, session, redirect, g, current_app
-from .decorators import login_required, with_lock
+from .decorators import login_required, with_user_lock
 from flask_babel import gettext, ngettext, lazy_gettext
 _ = gettext
 
 
 settings = Blueprint('settings', 'sagenb.flask_version.settings')
 
+# the choices of the number of revisions kept of each worksheet; 0 is
+# the setting of the server
+SNAPSHOT_LIMITS = [0, 10, 30, 100, 300]
+
 @settings.route('/settings', methods = ['GET','POST'])
 @login_required
-@with_lock
+@with_user_lock
 def settings_page():
     from sagenb.notebook.misc import is_valid_password, is_valid_email
     from sagenb.misc.misc import SAGE_VERSION
@@ -24,6 +28,12 @@ def settings_page():
         nu['autosave_interval'] = autosave
         redirect_to_home = True
 
+    if 'max_snapshots' in request.values:
+        max_snapshots = int(request.values['max_snapshots'])
+        if max_snapshots != nu['max_snapshots']:
+            nu['max_snapshots'] = max_snapshots
+            redirect_to_home = True
+
     old = request.values.get('old-pass', None)
     new = request.values.get('new-pass', None)
     two = request.values.get('retype-pass', None)
@@ -73,6 +83,10 @@ def settings_page():
 
     td['autosave_intervals'] = ((i, ' selected') if nu['autosave_interval']/60 == i else (i, '') for i in range(1, 10, 2))
 
+    td['max_snapshots'] = [(i, ' selected' if nu['max_snapshots'] == i else '')
+                           for i in sorted(set(SNAPSHOT_LIMITS + [nu['max_snapshots']]))]
+    td['server_max_snapshots'] = g.notebook.conf()['max_snapshots']
+
     td['email'] = g.notebook.conf()['email']
     if td['email']:
         td['email_address'] = nu.get_email() or 'None'
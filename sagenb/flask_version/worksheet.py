@@ -2,10 +2,11 @@ from __future__ import absolute_import
 import re
 import os
 import threading
+import zlib
+from contextlib import contextmanager
 from functools import wraps
 from flask import Blueprint, make_response, url_for, request, redirect, g, current_app
 from .decorators import login_required
-from collections import defaultdict
 from werkzeug.utils import secure_filename
 from flask_babel import gettext
 _ = gettext
@@ -13,8 +14,24 @@ _ = gettext
 from sagenb.notebook.interact import INTERACT_UPDATE_PREFIX
 from sagenb.notebook.misc import encode_response
 
+from sagenb.misc.locks import LockRegistry
+
 ws = Blueprint('worksheet', 'sagenb.flask_version.worksheet')
-worksheet_locks = defaultdict(threading.Lock)
+# The lock of each worksheet, by filename.
+worksheet_locks = LockRegistry('worksheet')
+
+@contextmanager
+def unlocked(worksheet):
+    """
+    Temporarily release the lock on ``worksheet`` taken by
+    :func:`worksheet_view`, e.g., while waiting for output.
+    """
+    lock = worksheet_locks[worksheet.filename()]
+    lock.release()
+    try:
+        yield
+    finally:
+        lock.acquire()
 
 def worksheet_view(f):
     """
@@ -31,7 +48,7 @@ def worksheet_view(f):
         except KeyError:
             return current_app.message(_("You do not have permission to access this worksheet"), username=g.username)
 
-        with worksheet_locks[worksheet]:
+        with worksheet_locks[worksheet.filename()]:
             owner = worksheet.owner()
 
             if owner != '_sage_' and g.username != owner:
@@ -444,18 +461,87 @@ def worksheet_eval(worksheet):
     return encode_response(r)
 
 
+# Number of cell_update requests that may wait for output at the same
+# time; set on first use from the server configuration.  This keeps
+# long polls from taking all threads of the server.
+long_poll_slots = None
+
+def cell_update_state(status, cell):
+    """
+    Return a short string that changes whenever the result of
+    :func:`worksheet_cell_update` for ``cell`` changes.
+    """
+    output = cell.output_text(raw=True)
+    if isinstance(output, unicode):
+        output = output.encode('utf-8', 'ignore')
+    introspect = cell.introspect_html()
+    if isinstance(introspect, unicode):
+        introspect = introspect.encode('utf-8', 'ignore')
+    return '%s%s%x' % (status, int(bool(cell.interrupted())),
+                       zlib.crc32(introspect, zlib.crc32(output)) & 0xffffffff)
+
+def cell_update_wait():
+    """
+    Return how long (in seconds) the current cell_update request may
+    wait for the cell to change, and whether it took a long poll slot.
+
+    The browser asks for a long poll by sending back the ``state`` of
+    the previous reply.
+    """
+    global long_poll_slots
+    timeout = g.notebook.conf()['cell_update_timeout']
+    if 'state' not in request.values or timeout <= 0:
+        return 0, False
+    if long_poll_slots is None:
+        # The server runner may know better how many threads it has.
+        n = current_app.config.get('MAX_LONG_POLLS', g.notebook.conf()['max_long_polls'])
+        long_poll_slots = threading.Semaphore(n)
+    if not long_poll_slots.acquire(False):
+        # too many waiting requests already, so just answer at once
+        return 0, False
+    return timeout, True
+
 @worksheet_command('cell_update')
 def worksheet_cell_update(worksheet):
+    """
+    Report the status and output of a cell.
+
+    If the request includes the ``state`` of the previous reply for
+    this cell, the reply is delayed until the cell changes or
+    ``cell_update_timeout`` seconds have passed (long polling).  The
+    ``held`` entry of the reply tells whether the request was actually
+    held; if not, the browser has to back off by itself.
+    """
     import time
 
     r = {}
     r['id'] = id = get_cell_id()
 
-    # update the computation one "step".
-    worksheet.check_comp()
-
-    # now get latest status on our cell
-    r['status'], cell = worksheet.check_cell(id)
+    known_state = request.values.get('state')
+    wait, slot = cell_update_wait()
+    deadline = time.time() + wait
+    try:
+        while True:
+            # update the computation one "step".
+            worksheet.check_comp()
+
+            # now get latest status on our cell
+            r['status'], cell = worksheet.check_cell(id)
+            r['state'] = cell_update_state(r['status'], cell)
+
+            remaining = deadline - time.time()
+            if r['status'] == 'd' or r['state'] != known_state or remaining <= 0:
+                break
+
+            # Start queued computations, then let other requests for
+            # this worksheet through while we wait for output.
+            worksheet.start_next_comp()
+            with unlocked(worksheet):
+                worksheet.wait_for_output(remaining)
+    finally:
+        if slot:
+            long_poll_slots.release()
+    r['held'] = 'true' if slot else 'false'
 
     if r['status'] == 'd':
         r['new_input'] = cell.changed_input_text()
@@ -615,25 +701,27 @@ def worksheet_revisions(worksheet):
     """
     if 'action' not in request.values:
         if 'rev' in request.values:
-            return g.notebook.html_specific_revision(g.username, worksheet,
-                                                       request.values['rev'])
+            try:
+                return g.notebook.html_specific_revision(g.username, worksheet,
+                                                           request.values['rev'])
+            except KeyError:
+                return current_app.message(_('No such revision'), username=g.username)
         else:
             return g.notebook.html_worksheet_revision_list(g.username, worksheet)
     else:
         rev = request.values['rev']
         action = request.values['action']
+        try:
+            txt = worksheet.snapshot_text(rev)
+        except KeyError:
+            return current_app.message(_('No such revision'), username=g.username)
         if action == 'revert':
-            import bz2
             worksheet.save_snapshot(g.username)
-            #XXX: Requires access to filesystem
-            txt = bz2.decompress(open(worksheet.get_snapshot_text_filename(rev)).read())
             worksheet.delete_cells_directory()
             worksheet.edit_save(txt)
             return redirect(url_for_worksheet(worksheet))
         elif action == 'publish':
-            import bz2
             W = g.notebook.publish_worksheet(worksheet, g.username)
-            txt = bz2.decompress(open(worksheet.get_snapshot_text_filename(rev)).read())
             W.delete_cells_directory()
             W.edit_save(txt)
             return redirect(url_for_worksheet(W))
@@ -649,8 +737,8 @@ def worksheet_revisions(worksheet):
 def worksheet_cells(worksheet, filename):
     #XXX: This requires that the worker filesystem be accessible from
     #the server.
-    from flask.helpers import send_from_directory
-    return send_from_directory(worksheet.cells_directory(), filename)
+    from .files import send_worksheet_file
+    return send_worksheet_file(worksheet, worksheet.cells_directory(), filename)
 
 
 ########################################################
@@ -734,8 +822,8 @@ def worksheet_data(worksheet, filename):
     if not os.path.exists(dir):
         return current_app.message(_('No data files'), username=g.username)
     else:
-        from flask.helpers import send_from_directory
-        return send_from_directory(worksheet.data_directory(), filename)
+        from .files import send_worksheet_file
+        return send_worksheet_file(worksheet, dir, filename)
 
 @worksheet_command('datafile')
 def worksheet_datafile(worksheet):
@@ -1002,33 +1090,16 @@ def worksheet_print(worksheet):
 #######################################################
 # Live "docbrowser" worksheets from HTML documentation
 #######################################################
-doc_worksheet_number = -1
 def doc_worksheet():
-    global doc_worksheet_number
-    doc_worksheet_number = doc_worksheet_number % g.notebook.conf()['doc_pool_size']
-    W = None
-    for X in g.notebook.users_worksheets('_sage_'):
-        if X.compute_process_has_been_started():
-            continue
-        if X.id_number() == doc_worksheet_number:
-            W = X
-            W.clear()
-            break
+    """
+    Return a proxy worksheet from the pool of the notebook (see
+    :meth:`Notebook.doc_worksheet_pool`), or None if all of them are
+    busy.  It must be given back with :func:`release_doc_worksheet`.
+    """
+    return g.notebook.doc_worksheet_pool().checkout()
 
-    if W is None:
-        # The first argument here is the worksheet's title, which the
-        # caller should set with W.set_name.
-        W = g.notebook.create_new_worksheet('', '_sage_')
-    return W
-
-def extract_title(html_page):
-    #XXX: This might be better as a regex
-    h = html_page.lower()
-    i = h.find('<title>')
-    if i == -1:
-        return gettext("Untitled")
-    j = h.find('</title>')
-    return html_page[i + len('<title>') : j]
+def release_doc_worksheet(W):
+    g.notebook.doc_worksheet_pool().checkin(W)
 
 @login_required
 def worksheet_file(path):
@@ -1036,38 +1107,52 @@ def worksheet_file(path):
     if not os.path.exists(path):
         return current_app.message(_('Document does not exist.'), username=g.username)
 
-    doc_page_html = open(path).read()
-    from sagenb.notebook.docHTMLProcessor import SphinxHTMLProcessor
-    doc_page = SphinxHTMLProcessor().process_doc_html(doc_page_html)
-
-    title = (extract_title(doc_page_html).replace('&mdash;', '--') or
-             'Live Sage Documentation')
+    # the conversion of the page is cached, see sagenb.notebook.doc_cache
+    from sagenb.notebook.doc_cache import doc_cache
+    title, doc_page = doc_cache().lookup(path)
+    title = title or 'Live Sage Documentation'
 
     W = doc_worksheet()
-    W.edit_save(doc_page)
-    W.set_system('sage')
-    W.set_name(title)
-    W.save()
-    W.quit()
+    if W is None:
+        return current_app.message(_('The documentation server is busy; please try again.'), username=g.username)
+    try:
+        W.edit_save(doc_page)
+        W.set_system('sage')
+        W.set_name(title)
+        W.save()
+        W.quit()
 
-    # FIXME: For some reason, an extra cell gets added so we
-    # remove it here.
-    W.cell_list().pop()
+        # FIXME: For some reason, an extra cell gets added so we
+        # remove it here.
+        W.cell_list().pop()
 
-    return g.notebook.html(worksheet_filename=W.filename(),
-                           username=g.username)
+        return g.notebook.html(worksheet_filename=W.filename(),
+                               username=g.username)
+    finally:
+        release_doc_worksheet(W)
 
 
 ####################
 # Public Worksheets
 ####################
 def pub_worksheet(source):
+    """
+    Return a proxy worksheet showing the published worksheet
+    ``source``, or None if all proxies are busy.  It must be given
+    back with :func:`release_doc_worksheet`.
+    """
     # TODO: Independent pub pool and server settings.
     proxy = doc_worksheet()
-    proxy.set_name(source.name())
-    proxy.set_last_change(*source.last_change())
-    proxy.set_worksheet_that_was_published(source.worksheet_that_was_published())
-    g.notebook._initialize_worksheet(source, proxy)
-    proxy.set_tags({'_pub_': [True]})
-    proxy.save()
+    if proxy is None:
+        return None
+    try:
+        proxy.set_name(source.name())
+        proxy.set_last_change(*source.last_change())
+        proxy.set_worksheet_that_was_published(source.worksheet_that_was_published())
+        g.notebook._initialize_worksheet(source, proxy)
+        proxy.set_tags({'_pub_': [True]})
+        proxy.save()
+    except Exception:
+        release_doc_worksheet(proxy)
+        raise
     return proxy
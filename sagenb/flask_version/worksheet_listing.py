@@ -5,10 +5,10 @@ import os
 
 try:
     from urllib.request import urlopen
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, urlencode
 except ImportError:
     from urlparse import urlparse
-    from urllib import urlopen
+    from urllib import urlopen, urlencode
 
 from flask import Blueprint, url_for, render_template, request, session, redirect, g, current_app
 from .decorators import login_required, guest_or_login_required, with_lock
@@ -18,6 +18,30 @@ _ = gettext
 worksheet_listing = Blueprint('worksheet_listing',
                               'sagenb.flask_version.worksheet_listing')
 
+# the number of worksheets on a page of the worksheet listing
+WORKSHEETS_PER_PAGE = 50
+
+def listing_args(args):
+    """
+    Returns the options of a worksheet listing given in the request
+    arguments ``args``, as a dictionary with the keys ``typ``,
+    ``search``, ``sort``, ``reverse``, ``offset`` and ``limit``.
+    """
+    from sagenb.misc.misc import unicode_str
+
+    def integer(key, default):
+        try:
+            return max(0, int(args[key]))
+        except (KeyError, ValueError):
+            return default
+
+    return {'typ': args['typ'] if 'typ' in args else 'active',
+            'search': unicode_str(args['search']) if 'search' in args else None,
+            'sort': args['sort'] if 'sort' in args else 'last_edited',
+            'reverse': (args['reverse'] == 'True') if 'reverse' in args else False,
+            'offset': integer('offset', 0),
+            'limit': integer('limit', WORKSHEETS_PER_PAGE) or WORKSHEETS_PER_PAGE}
+
 def render_worksheet_list(args, pub, username):
     """
     Returns a rendered worksheet listing.
@@ -38,21 +62,18 @@ def render_worksheet_list(args, pub, username):
     a string
     """
 
-    from sagenb.notebook.notebook import sort_worksheet_list
-    from sagenb.misc.misc import unicode_str, SAGE_VERSION
+    from sagenb.misc.misc import SAGE_VERSION
 
-    typ = args['typ'] if 'typ' in args else 'active'
-    search = unicode_str(args['search']) if 'search' in args else None
-    sort = args['sort'] if 'sort' in args else 'last_edited'
-    reverse = (args['reverse'] == 'True') if 'reverse' in args else False
+    options = listing_args(args)
+    typ = options['typ']
+    search = options['search']
+    sort = options['sort']
+    reverse = options['reverse']
+    offset = options['offset']
+    limit = options['limit']
     readonly = g.notebook.readonly_user(g.username)
     try:
-        if not pub:
-            worksheets = g.notebook.worksheet_list_for_user(username, typ=typ, sort=sort,
-                                                              search=search, reverse=reverse)
-        else:
-            worksheets = g.notebook.worksheet_list_for_public(username, sort=sort,
-                                                                search=search, reverse=reverse)
+        total, worksheets = g.notebook.worksheet_listing(username, pub=pub, **options)
     except ValueError as E:
         # for example, the sort key was not valid
         print("Error displaying worksheet listing: {}".format(E))
@@ -60,6 +81,16 @@ def render_worksheet_list(args, pub, username):
 
     worksheet_filenames = [x.filename() for x in worksheets]
 
+    def page_url(offset):
+        page = [('typ', typ), ('sort', sort), ('offset', offset), ('limit', limit)]
+        if reverse:
+            page.append(('reverse', 'True'))
+        if search:
+            page.append(('search', search.encode('utf-8')))
+        return '.?' + urlencode(page)
+    prev_url = page_url(max(0, offset - limit)) if offset > 0 else None
+    next_url = page_url(offset + limit) if offset + limit < total else None
+
     if pub and (not username or username == tuple([])):
         username = 'pub'
 
@@ -80,13 +111,42 @@ def home(username):
 def bare_home():
     return redirect(url_for('home', username=g.username))
 
+def worksheet_listing_response(args, pub, username):
+    """
+    Returns one page of a worksheet listing, encoded with
+    :func:`encode_response`.  The arguments are as for
+    :func:`render_worksheet_list`.
+    """
+    from sagenb.notebook.misc import encode_response
+
+    options = listing_args(args)
+    try:
+        total, worksheets = g.notebook.worksheet_listing(username, pub=pub, **options)
+    except ValueError as E:
+        return encode_response({'error': str(E)})
+    rows = [{'filename': W.filename(),
+             'name': W.name(),
+             'owner': W.owner(),
+             'last_edited': W.last_edited(),
+             'rating': W.rating()}
+            for W in worksheets]
+    return encode_response({'total': total,
+                            'offset': options['offset'],
+                            'limit': options['limit'],
+                            'worksheets': rows})
+
+@worksheet_listing.route('/home/<username>/worksheets.json')
+@login_required
+def home_listing(username):
+    if not g.notebook.user_manager().user_is_admin(g.username) and username != g.username:
+        return current_app.message(_("User '%(user)s' does not have permission to view the home page of '%(name)s'.", user=g.username, name=username), username=g.username)
+    return worksheet_listing_response(request.args, pub=False, username=username)
+
 ###########
 # Folders #
 ###########
 
-def get_worksheets_from_request():
-    U = g.notebook.user_manager().user(g.username)
-
+def get_worksheet_filenames_from_request():
     if 'filename' in request.form:
         filenames = [request.form['filename']]
     elif 'filenames' in request.form:
@@ -94,55 +154,80 @@ def get_worksheets_from_request():
         filenames = json.loads(request.form['filenames'])
     else:
         filenames = []
-    worksheets = []
-    for filename in filenames:
-        W = g.notebook.get_worksheet_with_filename(filename)
-        if W.owner() != g.username:
-            # TODO BUG: if trying to stop a shared worksheet, this check means that
-            # only the owner can stop from the worksheet listing (using /send_to_stop), but any
-            # shared person can stop the worksheet by quitting it.
-            continue
-        worksheets.append(W)
-
-    return worksheets
+    return filenames
+
+# the number of seconds a bulk operation may take before its request
+# returns and the operation continues in the background
+BULK_WAIT = 5
+
+def bulk_operation(action):
+    """
+    Start the bulk operation ``action`` (see
+    :meth:`Notebook.bulk_operation`) on the worksheets of the user given
+    in the request, and wait for at most ``BULK_WAIT`` seconds.  Return
+    the job.
+    """
+    from .worksheet import worksheet_locks
+    if action == 'empty_trash':
+        filenames = None
+    else:
+        # only the owner may change the worksheets from the listing
+        filenames = [x for x in get_worksheet_filenames_from_request()
+                     if x.split('/')[0] == g.username]
+    job = g.notebook.bulk_operation(g.username, action, filenames,
+                                    worksheet_lock=lambda W: worksheet_locks[W.filename()])
+    job.wait(BULK_WAIT)
+    return job
+
+def bulk_response(job):
+    if job.is_finished():
+        return ''
+    return _("The operation continues in the background (%(done)s of %(total)s worksheets done).",
+             done=job.progress()['done'], total=job.progress()['total'])
 
 @worksheet_listing.route('/send_to_trash', methods=['POST'])
 @login_required
 def send_worksheet_to_trash():
-    for W in get_worksheets_from_request():
-        W.move_to_trash(g.username)
-    return ''
+    return bulk_response(bulk_operation('trash'))
 
 @worksheet_listing.route('/send_to_archive', methods=['POST'])
 @login_required
 def send_worksheet_to_archive():
-    for W in get_worksheets_from_request():
-        W.move_to_archive(g.username)
-    return ''
+    return bulk_response(bulk_operation('archive'))
 
 @worksheet_listing.route('/send_to_active', methods=['POST'])
 @login_required
 def send_worksheet_to_active():
-    for W in get_worksheets_from_request():
-        W.set_active(g.username)
-    return ''
+    return bulk_response(bulk_operation('active'))
 
 @worksheet_listing.route('/send_to_stop', methods=['POST'])
 @login_required
 def send_worksheet_to_stop():
-    for W in get_worksheets_from_request():
-        W.quit()
-    return ''
+    # TODO BUG: only the owner can stop a shared worksheet from the
+    # listing, but any shared person can stop it by quitting it.
+    return bulk_response(bulk_operation('stop'))
 
 @worksheet_listing.route('/emptytrash', methods=['POST'])
 @login_required
 def empty_trash():
-    g.notebook.empty_trash(g.username)
+    bulk_operation('empty_trash')
     if 'referer' in request.headers:
         return redirect(request.headers['referer'])
     else:
         return redirect(url_for('home', typ='trash'))
 
+@worksheet_listing.route('/bulk_jobs/<int:job_id>')
+@login_required
+def bulk_job(job_id):
+    """
+    Return the progress of the bulk operation with given id.
+    """
+    from sagenb.notebook.misc import encode_response
+    job = g.notebook.bulk_job(job_id)
+    if job is None or job.username != g.username:
+        return encode_response({'error': 'unknown job'})
+    return encode_response(job.progress())
+
 
 #####################
 # Public Worksheets #
@@ -152,10 +237,15 @@ def empty_trash():
 def pub():
     return render_worksheet_list(request.args, pub=True, username=g.username)
 
+@worksheet_listing.route('/pub/worksheets.json')
+@guest_or_login_required
+def pub_listing():
+    return worksheet_listing_response(request.args, pub=True, username=g.username)
+
 @worksheet_listing.route('/home/pub/<id>/')
 @guest_or_login_required
 def public_worksheet(id):
-    from .worksheet import pub_worksheet
+    from .worksheet import pub_worksheet, release_doc_worksheet
     filename = 'pub/%s'%id
     if g.notebook.conf()['pub_interact']:
         try:
@@ -163,12 +253,17 @@ def public_worksheet(id):
         except KeyError:
             return _("Requested public worksheet does not exist"), 404
         worksheet = pub_worksheet(original_worksheet)
+        if worksheet is None:
+            return current_app.message(_("The server is busy; please try again."), username=g.username)
 
-        owner = worksheet.owner()
-        worksheet.set_owner('pub')
-        s = g.notebook.html(worksheet_filename=worksheet.filename(),
-                            username=g.username)
-        worksheet.set_owner(owner)
+        try:
+            owner = worksheet.owner()
+            worksheet.set_owner('pub')
+            s = g.notebook.html(worksheet_filename=worksheet.filename(),
+                                username=g.username)
+            worksheet.set_owner(owner)
+        finally:
+            release_doc_worksheet(worksheet)
     else:
         s = g.notebook.html(worksheet_filename=filename, username = g.username)
     return s
@@ -190,8 +285,8 @@ def public_worksheet_cells(id, filename):
         worksheet = g.notebook.get_worksheet_with_filename(worksheet_filename)
     except KeyError:
         return current_app.message(_("You do not have permission to access this worksheet"), username=g.username)
-    from flask.helpers import send_from_directory
-    return send_from_directory(worksheet.cells_directory(), filename)
+    from .files import send_worksheet_file
+    return send_worksheet_file(worksheet, worksheet.cells_directory(), filename)
 
 #######################
 # Download Worksheets #
@@ -199,14 +294,9 @@ def public_worksheet_cells(id, filename):
 @worksheet_listing.route('/download_worksheets.zip')
 @login_required
 def download_worksheets():
-    from sagenb.misc.misc import walltime, tmp_filename
-
-    t = walltime()
-    print("Starting zipping a group of worksheets in a separate thread...")
-    zip_filename = tmp_filename() + ".zip"
+    from sagenb.misc.misc import walltime
+    from sagenb.misc.zipstream import ZipStream
 
-    # child
-    worksheet_names = set()
     if 'filenames' in request.values:
         import json
         filenames = json.loads(request.values['filenames'])
@@ -214,27 +304,31 @@ def download_worksheets():
                       for x in filenames if len(x.strip()) > 0]
     else:
         worksheets = g.notebook.worksheet_list_for_user(g.username)
-
-    import zipfile
-    zip = zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_STORED)
-    for worksheet in worksheets:
-        sws_filename = tmp_filename() + '.sws'
-        g.notebook.export_worksheet(worksheet.filename(), sws_filename)
-        entry_name = worksheet.name()
-        if entry_name in worksheet_names:
-            i = 2
-            while ("%s_%s" % (entry_name, i)) in worksheet_names:
-                i += 1
-            entry_name = "%s_%s" % (entry_name, i)
-        zip.write(sws_filename, entry_name + ".sws")
-        os.unlink(sws_filename)
-    zip.close()
-    r = open(zip_filename, 'rb').read()
-    os.unlink(zip_filename)
-    print("Finished zipping %s worksheets (%s seconds)" % (len(worksheets), walltime(t)))
-
-    response = current_app.make_response(r)
-    response.headers['Content-Type'] = 'application/zip'
+    filenames = [W.filename() for W in worksheets]
+    notebook = g.notebook
+
+    # The archive is sent while it is written, and the worksheets are
+    # exported in parallel; see Notebook.export_worksheets.
+    def archive():
+        t = walltime()
+        print("Starting zipping a group of worksheets...")
+        worksheet_names = set()
+        zip = ZipStream()
+        for worksheet, sws_filename in notebook.export_worksheets(filenames):
+            entry_name = worksheet.name()
+            if entry_name in worksheet_names:
+                i = 2
+                while ("%s_%s" % (entry_name, i)) in worksheet_names:
+                    i += 1
+                entry_name = "%s_%s" % (entry_name, i)
+            worksheet_names.add(entry_name)
+            for data in zip.add_file(sws_filename, entry_name + ".sws"):
+                yield data
+        for data in zip.close():
+            yield data
+        print("Finished zipping %s worksheets (%s seconds)" % (len(filenames), walltime(t)))
+
+    response = current_app.response_class(archive(), mimetype='application/zip')
     return response
 
 
@@ -17,4 +17,12 @@ from .reference import WorksheetProcess_ReferenceImplementation
 from .expect import (WorksheetProcess_ExpectImplementation,
                     WorksheetProcess_RemoteExpectImplementation)
 
+from .framed import WorksheetProcess_FramedImplementation
+
 from .limits import ProcessLimits
+
+from .pool import WorksheetProcessPool
+
+from .scheduler import HostScheduler
+
+from .ssh import SSHConnections
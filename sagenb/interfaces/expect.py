@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*
 import os
+import collections
+import select
 import tempfile
 import shutil
 import pexpect
@@ -15,6 +17,175 @@ from sagenb.misc.misc import (walltime,
 ###################################################################
 # Expect-based implementation
 ###################################################################
+class OutputBuffer(object):
+    r"""
+    The output of one computation of a worksheet process, of which at
+    most ``max_size`` bytes are kept: when the output grows beyond
+    that, the oldest part is discarded and replaced by a note.
+
+    INPUT:
+
+    - ``max_size`` -- integer or None (default: None); the maximum
+      number of bytes of output to keep, or None (or 0) for no limit
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.expect import OutputBuffer
+        sage: B = OutputBuffer(max_size=4)
+        sage: B.append('ab'); B.append('cdef'); B.output()
+        '[...2 bytes of output discarded...]\ncdef'
+    """
+    def __init__(self, max_size=None):
+        self._max_size = max_size or None
+        self._chunks = collections.deque()
+        self._size = 0
+        self._discarded = 0
+
+    def append(self, data):
+        """
+        Append ``data`` to the output.
+        """
+        if not data:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._max_size is None:
+            return
+        while self._size > self._max_size:
+            excess = self._size - self._max_size
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                n = len(first)
+            else:
+                # Do not cut a UTF-8 encoded character in half.
+                n = excess
+                while n < len(first) and 0x80 <= ord(first[n]) < 0xC0:
+                    n += 1
+                self._chunks[0] = first[n:]
+            self._size -= n
+            self._discarded += n
+
+    def output(self):
+        """
+        Return the output of the computation so far.
+        """
+        if len(self._chunks) > 1:
+            s = ''.join(self._chunks)
+            self._chunks.clear()
+            self._chunks.append(s)
+        s = self._chunks[0] if self._chunks else ''
+        if self._discarded:
+            s = '[...%s bytes of output discarded...]\n' % self._discarded + s
+        return s
+
+
+class ExpectOutputReader(OutputBuffer):
+    r"""
+    Incrementally extract the output of one computation from the
+    stream of bytes written by an expect worksheet process.
+
+    The code sent to the process (see
+    :func:`~sagenb.misc.format.format_for_pexpect`) first prints
+    ``START<number>``, then runs, and the process finally prints its
+    prompt.  The output of the computation is everything in between.
+    Each byte of the stream is looked at only a bounded number of
+    times, however the stream is cut into chunks, so the total work
+    is linear in the amount of output.
+
+    At most ``max_size`` bytes of output are kept: when the output
+    grows beyond that, the oldest part is discarded and replaced by a
+    note.
+
+    INPUT:
+
+    - ``number`` -- integer; the number of the computation
+
+    - ``prompt`` -- string; the prompt of the worksheet process
+
+    - ``max_size`` -- integer or None (default: None); the maximum
+      number of bytes of output to keep, or None (or 0) for no limit
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.expect import ExpectOutputReader
+        sage: R = ExpectOutputReader(2, '__SAGE__')
+        sage: R.feed('>>> execfile("_sage_input_2.py")\r\nSTA')
+        sage: R.output(), R.done
+        ('', False)
+        sage: R.feed('RT2\r\n4\r\n__SA')
+        sage: R.output(), R.done
+        ('\r\n4\r\n', False)
+        sage: R.feed('GE__')
+        sage: R.output(), R.done
+        ('\r\n4\r\n', True)
+
+    The output is capped::
+
+        sage: R = ExpectOutputReader(1, 'PROMPT', max_size=10)
+        sage: R.feed('START1')
+        sage: for i in range(5): R.feed('%s\n' % i)
+        sage: R.output()
+        '0\n1\n2\n3\n4\n'
+        sage: R.feed('5\n6\n7\n8\nPROMPT')
+        sage: print(R.output())
+        [...8 bytes of output discarded...]
+        4
+        5
+        6
+        7
+        8
+    """
+    def __init__(self, number, prompt, max_size=None):
+        OutputBuffer.__init__(self, max_size)
+        self._start = 'START%s' % number
+        self._prompt = prompt
+        self._started = False
+        self._pending = ''   # unscanned data that may begin a marker
+        self.done = False
+
+    def __repr__(self):
+        return "Output of computation %s (%s bytes%s)" % (
+            self._start[len('START'):], self._size,
+            ', done' if self.done else '')
+
+    def feed(self, data):
+        """
+        Scan newly arrived ``data`` from the process.
+        """
+        if self.done or not data:
+            return
+        data = self._pending + data
+        self._pending = ''
+        if not self._started:
+            i = data.find(self._start)
+            if i == -1:
+                self._pending = data[max(0, len(data) - len(self._start) + 1):]
+                return
+            self._started = True
+            data = data[i + len(self._start):]
+        i = data.find(self._prompt)
+        if i != -1:
+            self.append(data[:i])
+            self.done = True
+            return
+        # Hold back a suffix that could be the beginning of the prompt.
+        for k in range(min(len(self._prompt) - 1, len(data)), 0, -1):
+            if data.endswith(self._prompt[:k]):
+                self._pending = data[-k:]
+                data = data[:-k]
+                break
+        self.append(data)
+
+    def finish(self, text=''):
+        """
+        Mark the computation as done, with ``text`` appended to the
+        output.
+        """
+        self.append(text)
+        self.done = True
+
+
 class WorksheetProcess_ExpectImplementation(WorksheetProcess):
     """
     A controlled Python process that executes code using expect.
@@ -23,11 +194,20 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
 
     - ``process_limits`` -- None or a ProcessLimits objects as defined by
       the ``sagenb.interfaces.ProcessLimits`` object.
+
+    - ``max_output_size`` -- None or an integer; the maximum number of
+      bytes of output of a computation that are kept (see
+      :class:`ExpectOutputReader`).
     """
+    # read at most this many bytes in one call to output_status, so
+    # that a process printing without pause cannot hold the caller
+    _max_read = 1 << 20
+
     def __init__(self,
                  process_limits=None,
                  timeout=0.05,
-                 python='python'):
+                 python='python',
+                 max_output_size=None):
         """
         Initialize this worksheet process.
         """
@@ -44,6 +224,9 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         self._start_walltime = None
         self._data_dir = None
         self._python = python
+        self._max_output_size = max_output_size
+        self._reader = ExpectOutputReader(0, self._prompt)
+        self._reader.finish()
 
         if process_limits:
             u = ''
@@ -155,6 +338,24 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         """
         self._check_for_walltimeout()
 
+    def reset_walltime(self):
+        """
+        Measure the wall time limit of this worksheet process from now
+        on.
+        """
+        if self._start_walltime is not None:
+            self._start_walltime = walltime()
+
+    def walltime_deadline(self):
+        """
+        Return the wall time at which this worksheet process exceeds
+        its wall time limit, or None if it has no limit or is not
+        running.
+        """
+        if self._is_started and self._max_walltime and self._start_walltime:
+            return self._start_walltime + self._max_walltime
+        return None
+
     def _check_for_walltimeout(self):
         """
         Check if the walltimeout has been reached, and if so, kill
@@ -210,6 +411,19 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         s = tempfile.mkdtemp()
         return (s, s)
 
+    def _link_data_dir(self, local, data):
+        """
+        Make a symbolic link to the data directory ``data`` (if not
+        None) in the temporary directory ``local`` of a computation.
+        """
+        if data is not None:
+            self._data = os.path.split(data)[1]
+            self._data_dir = data
+            set_permissive_permissions(data)
+            os.symlink(data, os.path.join(local, self._data))
+        else:
+            self._data = ''
+
     def execute(self, string, data=None):
         """
         Start executing the given string in this subprocess.
@@ -232,21 +446,13 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
         self._number += 1
 
         local, remote = self.get_tmpdir()
-
-        if data is not None:
-            # make a symbolic link from the data directory into local
-            # tmp directory
-            self._data = os.path.split(data)[1]
-            self._data_dir = data
-            set_permissive_permissions(data)
-            os.symlink(data, os.path.join(local, self._data))
-        else:
-            self._data = ''
+        self._link_data_dir(local, data)
 
         self._tempdir = local
         sage_input = '_sage_input_%s.py' % self._number
         self._filename = os.path.join(self._tempdir, sage_input)
-        self._so_far = ''
+        self._reader = ExpectOutputReader(self._number, self._prompt,
+                                          self._max_output_size)
         self._is_computing = True
 
         self._all_tempdirs.append(self._tempdir)
@@ -258,16 +464,49 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
             self._expect.sendline(txt)
         except OSError as msg:
             self._is_computing = False
-            self._so_far = str(msg)
+            self._reader.finish(str(msg))
 
     def _read(self):
+        """
+        Pass what the subprocess wrote since the last call to the
+        output reader, waiting at most ``self._timeout`` seconds for
+        something to arrive.
+        """
+        timeout = self._timeout
+        total = 0
+        while total < self._max_read:
+            try:
+                s = self._expect.read_nonblocking(65536, timeout)
+            except pexpect.EOF:
+                # got EOF subprocess must have crashed; cleanup
+                print("got EOF subprocess must have crashed...")
+                print(self._reader.output())
+                self.quit()
+                return
+            except:
+                return
+            self._reader.feed(s)
+            total += len(s)
+            timeout = 0
+
+    def wait_for_output(self, timeout):
+        """
+        Block until the subprocess wrote something to its terminal, or
+        until ``timeout`` seconds have elapsed, whichever comes first.
+
+        INPUT:
+
+            - ``timeout`` -- float; maximum number of seconds to wait
+        """
+        # The supervisor may quit the process (and reset _expect) while
+        # we wait, so only look at it once.
+        E = self._expect
+        if E is None:
+            return
         try:
-            self._expect.expect(pexpect.EOF, self._timeout)
-            # got EOF subprocess must have crashed; cleanup
-            print("got EOF subprocess must have crashed...")
-            print(self._expect.before)
-            self.quit()
-        except:
+            select.select([E.child_fd], [], [], timeout)
+        except (select.error, ValueError, TypeError):
+            # the process went away in the meantime
             pass
 
     ###########################################################
@@ -284,27 +523,11 @@ class WorksheetProcess_ExpectImplementation(WorksheetProcess):
 
             - ``OutputStatus`` object.
         """
-        self._read()
-        if self._expect is None:
+        if self._expect is not None:
+            self._read()
+        if self._expect is None or self._reader.done:
             self._is_computing = False
-        else:
-            self._so_far = self._expect.before
-
-        import re
-        v = re.findall('START%s.*%s' % (self._number, self._prompt),
-                       self._so_far, re.DOTALL)
-        if len(v):
-            self._is_computing = False
-            s = v[0][len('START%s' % self._number):-len(self._prompt)]
-        else:
-            v = re.findall('START%s.*' % self._number, self._so_far, re.DOTALL)
-            if len(v) > 0:
-                s = v[0][len('START%s' % self._number):]
-            else:
-                s = ''
-
-        if s.endswith(self._prompt):
-            s = s[:-len(self._prompt)]
+        s = self._reader.output()
 
         files = []
         if os.path.exists(self._tempdir):
@@ -357,6 +580,14 @@ class WorksheetProcess_RemoteExpectImplementation(WorksheetProcess_ExpectImpleme
 
         - ``process_limits`` -- None or a ProcessLimits objects as defined by
           the ``sagenb.interfaces.ProcessLimits`` object.
+
+        - ``max_output_size`` -- None or an integer; the maximum number
+          of bytes of output of a computation that are kept.
+
+        - ``connections`` -- None or an
+          :class:`~sagenb.interfaces.ssh.SSHConnections` object; if
+          given, the ssh session runs over its master connection to
+          ``user_at_host``.
     """
     def __init__(self,
                  user_at_host,
@@ -364,9 +595,12 @@ class WorksheetProcess_RemoteExpectImplementation(WorksheetProcess_ExpectImpleme
                  local_directory=None,
                  remote_directory=None,
                  process_limits=None,
-                 timeout=0.05):
+                 timeout=0.05,
+                 max_output_size=None,
+                 connections=None):
         WorksheetProcess_ExpectImplementation.__init__(self, process_limits,
-                                                       timeout=timeout)
+                                                       timeout=timeout,
+                                                       max_output_size=max_output_size)
         self._user_at_host = user_at_host
 
         if local_directory is None:
@@ -382,13 +616,18 @@ class WorksheetProcess_RemoteExpectImplementation(WorksheetProcess_ExpectImpleme
         self._remote_directory = remote_directory
 
         self._remote_python = remote_python
+        self._connections = connections
 
     def command(self):
         if self._ulimit == '':
             c = self._remote_python
         else:
             c = '&&'.join([x for x in [self._ulimit, self._remote_python] if x])
-        return 'sage-native-execute ssh -t %s "%s"' % (self._user_at_host, c)
+        if self._connections is None:
+            ssh = 'sage-native-execute ssh'
+        else:
+            ssh = self._connections.command(self._user_at_host)
+        return '%s -t %s "%s"' % (ssh, self._user_at_host, c)
 
     def get_tmpdir(self):
         """
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*
+r"""
+Worksheet processes talking a framed message protocol over pipes
+
+The expect implementation runs an interactive Python in a pseudo
+terminal, and finds the output of each computation between a start
+marker and the prompt in the stream of bytes it writes.  Every byte
+of output goes through the terminal (which translates newlines and
+echoes the input), and the names of the files a computation created
+are found by listing its directory.
+
+:class:`WorksheetProcess_FramedImplementation` instead runs
+:mod:`sagenb.interfaces.framed_worker` with its standard input and
+output connected to the server by pipes, and both ends exchange
+length-prefixed messages.  Each message has a header giving its
+channel, the number of the computation it belongs to and the length
+of its payload, so that no marker has to be searched for and the
+output of an earlier computation cannot be mistaken for the current
+one.  The worker sends
+
+- ``OUTPUT`` -- what the computation wrote to its standard output and
+  error,
+
+- ``HTML`` -- HTML display data (see
+  :func:`~sagenb.interfaces.framed_worker.display_html`),
+
+- ``FILE`` -- the name of a file the computation created in its
+  directory, and
+
+- ``DONE`` -- that the computation is finished,
+
+and the server sends the ``EXECUTE``, ``INTERRUPT`` and ``QUIT``
+commands.
+
+EXAMPLES::
+
+    sage: from sagenb.interfaces.framed import MessageReader, encode_message, OUTPUT, DONE
+    sage: data = encode_message(OUTPUT, 3, '5\n') + encode_message(DONE, 3, '')
+    sage: R = MessageReader()
+    sage: R.feed(data[:5])
+    []
+    sage: R.feed(data[5:])
+    [('o', 3, '5\n'), ('d', 3, '')]
+"""
+import errno
+import json
+import os
+import select
+import shlex
+import struct
+import subprocess
+
+from .status import OutputStatus
+from .expect import WorksheetProcess_ExpectImplementation, OutputBuffer
+from sagenb.misc.misc import walltime
+
+# channel, number of the computation, length of the payload
+HEADER = struct.Struct('!cII')
+
+# from the worker
+OUTPUT = 'o'
+HTML = 'h'
+FILE = 'f'
+DONE = 'd'
+
+# from the server
+EXECUTE = 'x'
+INTERRUPT = 'i'
+QUIT = 'q'
+
+
+def encode_message(channel, number, payload):
+    """
+    Return the bytes of the message with the given ``channel``,
+    computation ``number`` and ``payload``.
+    """
+    return HEADER.pack(channel, number, len(payload)) + payload
+
+
+def write_message(fd, channel, number, payload):
+    """
+    Write a message (see :func:`encode_message`) to the file
+    descriptor ``fd``.
+    """
+    data = encode_message(channel, number, payload)
+    while data:
+        try:
+            n = os.write(fd, data)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        data = data[n:]
+
+
+class MessageReader(object):
+    """
+    Incrementally split a stream of bytes into messages (see
+    :func:`encode_message`), however the stream is cut into chunks.
+    """
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        """
+        Scan newly arrived ``data`` and return the list of the
+        messages it completes, as triples ``(channel, number,
+        payload)``.
+        """
+        buf = self._buffer + data if self._buffer else data
+        messages = []
+        i = 0
+        while len(buf) - i >= HEADER.size:
+            channel, number, length = HEADER.unpack_from(buf, i)
+            j = i + HEADER.size + length
+            if j > len(buf):
+                break
+            messages.append((channel, number, buf[i + HEADER.size:j]))
+            i = j
+        self._buffer = buf[i:]
+        return messages
+
+
+class WorksheetProcess_FramedImplementation(WorksheetProcess_ExpectImplementation):
+    r"""
+    A controlled Python process that executes code and sends back its
+    output, HTML display data and created files as framed messages on
+    a pipe (see :mod:`sagenb.interfaces.framed`).
+
+    The process runs as the same user on the local machine.  Process
+    and wall time limits and temporary directories are handled as by
+    :class:`~sagenb.interfaces.expect.WorksheetProcess_ExpectImplementation`.
+
+    INPUT:
+
+    - ``process_limits`` -- None or a ProcessLimits objects as defined by
+      the ``sagenb.interfaces.ProcessLimits`` object.
+
+    - ``python`` -- string (default: 'python'); the command running
+      the Python of the worker
+
+    - ``max_output_size`` -- None or an integer; the maximum number of
+      bytes of output of a computation that are kept.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces import WorksheetProcess_FramedImplementation
+        sage: import sys
+        sage: W = WorksheetProcess_FramedImplementation(python=sys.executable)
+        sage: W.execute('print(2+3)')
+        sage: W.wait_for_output(10); O = W.output_status()
+        sage: while not O.done: W.wait_for_output(1); O = W.output_status()
+        sage: O.output
+        '5\n'
+        sage: W.quit()
+    """
+    def __init__(self,
+                 process_limits=None,
+                 timeout=0.05,
+                 python='python',
+                 max_output_size=None):
+        """
+        Initialize this worksheet process.
+        """
+        WorksheetProcess_ExpectImplementation.__init__(self, process_limits,
+                                                       timeout=timeout,
+                                                       python=python,
+                                                       max_output_size=max_output_size)
+        self._process = None
+        self._messages = MessageReader()
+        self._number = 0
+        self._output = OutputBuffer()
+        self._files = []
+        self._done = True
+        self._tempdir = ''
+
+    def __repr__(self):
+        """
+        Return string representation of this worksheet process.
+        """
+        return "Framed pipe implementation of worksheet process"
+
+    def _send(self, channel, payload=''):
+        write_message(self._process.stdin.fileno(), channel,
+                      self._number, payload)
+
+    ###########################################################
+    # Control the state of the subprocess
+    ###########################################################
+    def interrupt(self):
+        """
+        Send an interrupt signal to the currently running computation
+        in the controlled process.  This may or may not succeed.  Call
+        ``self.is_computing()`` to find out if it did.
+        """
+        if self._process is None:
+            return
+        try:
+            self._send(INTERRUPT)
+        except (OSError, IOError):
+            pass
+
+    def quit(self):
+        """
+        Quit this worksheet process.
+        """
+        if self._process is None:
+            return
+        try:
+            self._send(QUIT)
+        except (OSError, IOError):
+            pass
+        try:
+            os.killpg(self._process.pid, 9)
+            os.kill(self._process.pid, 9)
+        except OSError:
+            pass
+        try:
+            self._process.wait()
+        except OSError:
+            pass
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process = None
+        self._messages = MessageReader()
+        self._is_started = False
+        self._is_computing = False
+        self._start_walltime = None
+        self._cleanup_tempfiles()
+        self._cleanup_data_dir()
+
+    def start(self):
+        """
+        Start this worksheet process running.
+        """
+        command = shlex.split(self.command())
+        # unbuffered, so that output is sent as it is printed
+        command += ['-u', '-m', 'sagenb.interfaces.framed_worker']
+        env = dict(os.environ, PYTHONIOENCODING='utf-8')
+        try:
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             close_fds=True, env=env,
+                                             preexec_fn=os.setsid)
+        except OSError:
+            self._process = None
+            return
+        self._messages = MessageReader()
+        self._is_started = True
+        self._is_computing = False
+        self._number = 0
+        self._start_walltime = walltime()
+
+    ###########################################################
+    # Sending a string to be executed in the subprocess
+    ###########################################################
+    def execute(self, string, data=None):
+        """
+        Start executing the given string in this subprocess.
+
+        INPUT:
+
+            - ``string`` -- a string containing code to be executed.
+
+            - ``data`` -- a string or None; if given, must specify an
+              absolute path on the server host filesystem.   This may
+              be ignored by some worksheet process implementations.
+        """
+        if self._process is None:
+            self.start()
+
+        if self._process is None:
+            msg = "unable to start subprocess using command '%s'" % self.command()
+            raise RuntimeError(msg)
+
+        self._number += 1
+
+        local, remote = self.get_tmpdir()
+        self._link_data_dir(local, data)
+
+        self._tempdir = local
+        self._output = OutputBuffer(self._max_output_size)
+        self._files = []
+        self._done = False
+        self._is_computing = True
+
+        self._all_tempdirs.append(self._tempdir)
+        request = json.dumps({'code': string, 'directory': remote,
+                              'data': self._data})
+        try:
+            self._send(EXECUTE, request)
+        except (OSError, IOError) as msg:
+            self._is_computing = False
+            self._output.append(str(msg))
+            self._done = True
+
+    def _read(self):
+        """
+        Handle the messages the subprocess sent since the last call,
+        waiting at most ``self._timeout`` seconds for something to
+        arrive.
+        """
+        fd = self._process.stdout.fileno()
+        timeout = self._timeout
+        total = 0
+        while total < self._max_read:
+            try:
+                if not select.select([fd], [], [], timeout)[0]:
+                    return
+                s = os.read(fd, 65536)
+            except (select.error, OSError):
+                return
+            if not s:
+                # got EOF subprocess must have crashed; cleanup
+                print("got EOF subprocess must have crashed...")
+                print(self._output.output())
+                self.quit()
+                return
+            for channel, number, payload in self._messages.feed(s):
+                self._receive(channel, number, payload)
+            total += len(s)
+            timeout = 0
+
+    def _receive(self, channel, number, payload):
+        if number != self._number:
+            # what is left of an earlier computation
+            return
+        if channel == OUTPUT:
+            self._output.append(payload)
+        elif channel == HTML:
+            self._output.append('<html>%s</html>\n' % payload)
+        elif channel == FILE:
+            filename = os.path.join(self._tempdir, payload)
+            if filename not in self._files:
+                self._files.append(filename)
+        elif channel == DONE:
+            self._done = True
+
+    def wait_for_output(self, timeout):
+        """
+        Block until the subprocess sent something, or until
+        ``timeout`` seconds have elapsed, whichever comes first.
+
+        INPUT:
+
+            - ``timeout`` -- float; maximum number of seconds to wait
+        """
+        P = self._process
+        if P is None:
+            return
+        try:
+            select.select([P.stdout], [], [], timeout)
+        except (select.error, ValueError):
+            # the process went away in the meantime
+            pass
+
+    ###########################################################
+    # Getting the output so far from a subprocess
+    ###########################################################
+    def output_status(self):
+        """
+        Return OutputStatus object, which includes output from the
+        subprocess from the last executed command up until now,
+        information about files that were created, and whether
+        computing is now done.
+
+        OUTPUT:
+
+            - ``OutputStatus`` object.
+        """
+        if self._process is not None:
+            self._read()
+        if self._process is None or self._done:
+            self._is_computing = False
+        return OutputStatus(self._output.output(), list(self._files),
+                            not self._is_computing)
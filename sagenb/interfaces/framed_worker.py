@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*
+r"""
+Worker side of the framed worksheet process
+
+This is run as ``python -u -m sagenb.interfaces.framed_worker`` by
+:class:`~sagenb.interfaces.framed.WorksheetProcess_FramedImplementation`,
+with its standard input and output connected to the server.  It keeps
+these two file descriptors for the messages (see
+:mod:`sagenb.interfaces.framed`), and connects the standard output
+and error to a pipe read by a thread, which sends what the code wrote
+as ``OUTPUT`` messages.  Output of the Python code, of extension
+modules and of child processes is thus all caught, in the order it
+was written.
+
+The code of each ``EXECUTE`` command is run in the namespace of the
+worksheet, in the directory of the computation, and the last line is
+displayed if it is an expression (as in the interactive interpreter).
+When it is done, the worker sends a ``FILE`` message for each file in
+the directory, then ``DONE``.
+"""
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import traceback
+import types
+
+from six.moves import queue
+
+from sagenb.interfaces.framed import (MessageReader, write_message,
+                                      OUTPUT, HTML, FILE, DONE,
+                                      EXECUTE, INTERRUPT, QUIT)
+from sagenb.misc.format import displayhook_hack, relocate_future_imports
+
+# written to the standard output to know when all that was written
+# before it has been sent
+SYNC = '\x00\x1bsagenb-sync\x1b\x00'
+
+# the worker of this process, if it is a framed worksheet process
+_worker = None
+
+
+def display_html(html):
+    """
+    Display ``html`` in the output of the current computation.
+
+    In a framed worksheet process this sends ``html`` as HTML display
+    data, after what was printed so far.
+    """
+    if isinstance(html, type(u'')):
+        html = html.encode('utf-8', 'ignore')
+    if _worker is None:
+        print('<html>%s</html>' % html)
+    else:
+        _worker.send_html(html)
+
+
+def _close_on_exec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class Worker(object):
+    def __init__(self, commands, messages, output):
+        """
+        The worker executing the commands read from the file
+        descriptor ``commands``, sending messages to the file
+        descriptor ``messages`` and what is written to the standard
+        output and error (which must write to the file descriptor
+        ``output``) as ``OUTPUT``.
+        """
+        self._commands = commands
+        self._messages = messages
+        self._output = output
+        self._lock = threading.Lock()
+        self._synced = threading.Semaphore(0)
+        self._queue = queue.Queue()
+        # the number of the computation whose output is being sent,
+        # and of the one that is running, if any
+        self._number = 0
+        self._running = None
+        main = types.ModuleType('__main__')
+        sys.modules['__main__'] = main
+        self._namespace = main.__dict__
+
+    def send(self, channel, payload, number=None):
+        with self._lock:
+            write_message(self._messages, channel,
+                          self._number if number is None else number, payload)
+
+    def sync(self):
+        """
+        Wait until all that was written to the standard output and
+        error has been sent.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            import ctypes
+            ctypes.CDLL(None).fflush(None)
+        except (ImportError, OSError, AttributeError):
+            pass
+        os.write(1, SYNC)
+        self._synced.acquire()
+
+    def send_html(self, html):
+        self.sync()
+        self.send(HTML, html)
+
+    def _read_output(self):
+        pending = ''
+        while True:
+            try:
+                data = os.read(self._output, 65536)
+            except OSError:
+                continue
+            if not data:
+                return
+            data = pending + data
+            pending = ''
+            while True:
+                i = data.find(SYNC)
+                if i == -1:
+                    break
+                if i:
+                    self.send(OUTPUT, data[:i])
+                data = data[i + len(SYNC):]
+                self._synced.release()
+            # Hold back a suffix that could be the beginning of SYNC.
+            for k in range(min(len(SYNC) - 1, len(data)), 0, -1):
+                if data.endswith(SYNC[:k]):
+                    pending = data[-k:]
+                    data = data[:-k]
+                    break
+            if data:
+                self.send(OUTPUT, data)
+
+    def _read_commands(self):
+        reader = MessageReader()
+        while True:
+            try:
+                data = os.read(self._commands, 65536)
+            except OSError:
+                continue
+            if not data:
+                self._queue.put(None)
+                return
+            for channel, number, payload in reader.feed(data):
+                if channel == EXECUTE:
+                    self._queue.put((number, payload))
+                elif channel == INTERRUPT:
+                    if self._running == number:
+                        os.kill(os.getpid(), signal.SIGINT)
+                elif channel == QUIT:
+                    self._queue.put(None)
+
+    def run(self):
+        """
+        Execute the commands until told to quit.
+        """
+        for target in [self._read_output, self._read_commands]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+        while True:
+            try:
+                command = self._queue.get()
+            except KeyboardInterrupt:
+                continue
+            if command is None:
+                return
+            self.execute(*command)
+
+    def execute(self, number, request):
+        """
+        Run the code of the ``EXECUTE`` command ``number`` with the
+        payload ``request``, then send the names of the files it
+        created and ``DONE``.
+        """
+        request = json.loads(request.decode('utf-8'))
+        directory = request['directory']
+        code = displayhook_hack(request['code']).encode('utf-8', 'ignore')
+        try:
+            code = relocate_future_imports(code)
+        except SyntaxError:
+            # Syntax error anyways, so no need to relocate future imports.
+            pass
+        code = '# -*- coding: utf-8 -*-\n' + code
+
+        self.sync()
+        self._number = number
+        self._running = number
+        try:
+            try:
+                os.chdir(directory)
+                code = compile(code, '_sage_input_%s.py' % number, 'exec')
+                exec(code, self._namespace)
+            finally:
+                self._running = None
+        except SystemExit:
+            raise
+        except BaseException:
+            etype, value, tb = sys.exc_info()
+            # do not show this frame
+            traceback.print_exception(etype, value, tb.tb_next)
+        while True:
+            # An interrupt that arrives after the code is finished
+            # must not keep the computation from being done.
+            try:
+                self.sync()
+                if os.path.isdir(directory):
+                    for filename in sorted(os.listdir(directory)):
+                        if filename != request['data']:
+                            self.send(FILE, filename, number)
+                self.send(DONE, '', number)
+                return
+            except KeyboardInterrupt:
+                continue
+
+
+def main():
+    """
+    Run the worker of a framed worksheet process on the standard input
+    and output.
+    """
+    global _worker
+    commands = os.dup(0)
+    messages = os.dup(1)
+    r, w = os.pipe()
+    for fd in [commands, messages, r]:
+        _close_on_exec(fd)
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+    os.dup2(w, 1)
+    os.dup2(w, 2)
+    os.close(w)
+    _worker = Worker(commands, messages, r)
+    _worker.run()
+
+
+if __name__ == '__main__':
+    # run in the module, so that display_html finds the worker
+    from sagenb.interfaces import framed_worker
+    framed_worker.main()
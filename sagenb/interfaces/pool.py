@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*
+"""
+A pool of pre-started worksheet processes
+
+Starting a worksheet process and importing Sage into it takes several
+seconds, which the first evaluation in a worksheet has to wait for.
+A :class:`WorksheetProcessPool` keeps a number of processes that were
+started in advance and have already imported the (slow to import)
+modules, and a background thread replaces each process taken from the
+pool.
+
+A process taken from the pool has not run any worksheet code yet, so
+it is initialized for its worksheet exactly like a new process; the
+imports are just fast because the modules are already loaded.  A
+process that has run worksheet code is never given to another
+worksheet; it is quit (in the background) and replaced by a fresh one.
+"""
+
+import threading
+import time
+
+from sagenb.misc.misc import walltime
+
+# Code run in each process of the pool.  This only fills sys.modules,
+# so that the namespace of the worksheet is the same as in a process
+# that was started on demand.
+WARMUP_CODE = """
+import base64
+import sagenb.misc.support
+import sagenb.notebook.interact
+try:
+    import sage.all_notebook
+    import sagenb.notebook.all
+except ImportError:
+    pass
+"""
+
+
+class WorksheetProcessPool(object):
+    def __init__(self, factory, size, code=WARMUP_CODE, timeout=600):
+        """
+        A pool of pre-started worksheet processes.
+
+        INPUT:
+
+        - ``factory`` -- a callable returning a new (not yet started)
+          worksheet process, e.g., :meth:`Notebook.new_worksheet_process`
+
+        - ``size`` -- integer; the number of idle processes to keep
+
+        - ``code`` -- string (default: :data:`WARMUP_CODE`); code run
+          in each process before it is handed out
+
+        - ``timeout`` -- number (default: 600); the number of seconds
+          after which a process that did not finish running ``code``
+          is given up
+
+        EXAMPLES::
+
+            sage: from sagenb.interfaces.pool import WorksheetProcessPool
+            sage: from sagenb.interfaces import WorksheetProcess_ReferenceImplementation
+            sage: P = WorksheetProcessPool(WorksheetProcess_ReferenceImplementation, 2, code='2+2')
+            sage: P
+            Pool of 0 of 2 worksheet processes
+            sage: P.start(); P.wait_until_full(10)
+            True
+            sage: P
+            Pool of 2 of 2 worksheet processes
+            sage: S = P.take(); S
+            Reference implementation of worksheet process
+            sage: P.wait_until_full(10)
+            True
+            sage: P.recycle(S)
+            sage: P.quit(); P
+            Pool of 0 of 2 worksheet processes
+            sage: P.take() is None
+            True
+        """
+        self._factory = factory
+        self._size = size
+        self._code = code
+        self._timeout = timeout
+        self._ready = []
+        self._recycled = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "Pool of %s of %s worksheet processes" % (len(self._ready),
+                                                          self._size)
+
+    def __len__(self):
+        """
+        Return the number of processes that are ready to be taken.
+        """
+        return len(self._ready)
+
+    def size(self):
+        """
+        Return the number of idle processes this pool keeps.
+        """
+        return self._size
+
+    def set_size(self, size):
+        """
+        Set the number of idle processes this pool keeps.  Extra idle
+        processes are quit in the background.
+        """
+        with self._cond:
+            self._size = size
+            self._cond.notify_all()
+        if size > 0:
+            self.start()
+
+    def start(self):
+        """
+        Start the thread that fills the pool and quits recycled
+        processes.
+        """
+        with self._cond:
+            if self._thread is not None or self._size <= 0:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='worksheet process pool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def take(self):
+        """
+        Return a started worksheet process from the pool, or None if
+        the pool is empty.  The pool is refilled in the background.
+        """
+        with self._cond:
+            if not self._ready:
+                return None
+            S = self._ready.pop(0)
+            self._cond.notify_all()
+        S.reset_walltime()
+        return S
+
+    def recycle(self, S):
+        """
+        Give back the worksheet process ``S``, which is no longer
+        used.  Since it ran worksheet code, it is quit in the
+        background; the pool is refilled with a new process.
+
+        If the pool is not running, ``S`` is quit at once.
+        """
+        with self._cond:
+            if self._thread is not None:
+                self._recycled.append(S)
+                self._cond.notify_all()
+                return
+        self._quit(S)
+
+    def wait_until_full(self, timeout):
+        """
+        Wait until the pool has ``self.size()`` ready processes, but at
+        most ``timeout`` seconds.  Return True if the pool is full.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self._ready) < self._size:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._thread is None:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def quit(self):
+        """
+        Stop filling the pool and quit all its processes.
+        """
+        with self._cond:
+            self._stopped = True
+            thread = self._thread
+            self._thread = None
+            processes = self._ready + self._recycled
+            self._ready = []
+            self._recycled = []
+            self._cond.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self._timeout)
+        for S in processes:
+            self._quit(S)
+
+    def _quit(self, S):
+        try:
+            S.quit()
+        except Exception as msg:
+            print("WARNING: Error quitting worksheet process: %s" % msg)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while (not self._stopped and not self._recycled and
+                       len(self._ready) == self._size):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                while len(self._ready) > self._size:
+                    self._recycled.append(self._ready.pop())
+                recycled = self._recycled
+                self._recycled = []
+            for S in recycled:
+                self._quit(S)
+            if len(self._ready) < self._size:
+                S = self._new_process()
+                with self._cond:
+                    if S is not None and not self._stopped:
+                        self._ready.append(S)
+                        S = None
+                    self._cond.notify_all()
+                if S is not None:
+                    self._quit(S)
+
+    def _new_process(self):
+        """
+        Start a new process and run the warmup code in it.  Return
+        the process, or None if it failed.
+        """
+        S = None
+        try:
+            S = self._factory()
+            S.start()
+            S.execute(self._code)
+            deadline = walltime() + self._timeout
+            while not S.output_status().done:
+                if self._stopped or walltime() > deadline:
+                    raise RuntimeError("timed out")
+                if not S.is_started():
+                    raise RuntimeError("process died")
+                S.wait_for_output(1)
+            return S
+        except Exception as msg:
+            print("WARNING: Error starting pooled worksheet process: %s" % msg)
+            if S is not None:
+                self._quit(S)
+            # do not retry at once if starting processes fails
+            time.sleep(5)
+            return None
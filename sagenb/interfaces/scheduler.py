@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*
+r"""
+Placement of worksheet processes on the hosts of the server pool
+
+When the ``server_pool`` server option lists several ``user@host``
+accounts, each new worksheet process is started on one of them.  A
+:class:`HostScheduler` chooses the host according to a policy, and
+keeps track of the worksheet processes it placed on each host that
+are still running.  The accounts on the same host share it: their
+processes are counted together, and the host is probed once.  On the
+chosen host, the account with the fewest processes is used.  The
+policies are
+
+- ``least-processes`` -- the host with the fewest running worksheet
+  processes,
+
+- ``least-loaded`` -- the host with the lowest load average per CPU,
+
+- ``memory`` -- the host with the most available memory,
+
+- ``round-robin`` -- the host that was chosen least recently, and
+
+- ``random`` -- any host.
+
+The load average and the available memory of the hosts are probed in
+the background (by default with ``ssh``) at most every ``interval``
+seconds; they are only known as of the last probe, so the processes
+placed on a host since then are taken into account as well.  A host
+that could not be probed comes after those that could.  Ties are
+broken by the number of processes, then by round-robin.
+
+A policy is a function of the :class:`HostState` of a host returning a
+key, the host with the smallest key being chosen, or None if it does
+not know.  Other policies can be added to ``POLICIES``.
+
+EXAMPLES::
+
+    sage: from sagenb.interfaces.scheduler import HostScheduler
+    sage: S = HostScheduler('least-processes', background=False)
+    sage: class Process(object): is_started = lambda self: True
+    sage: P = [Process() for i in range(4)]
+    sage: hosts = ['sage1@localhost', 'sage2@localhost', 'sage@remote']
+    sage: chosen = []
+    sage: for p in P: chosen.append(S.choose(hosts)); S.add(chosen[-1], p)
+    sage: chosen
+    ['sage1@localhost', 'sage@remote', 'sage2@localhost', 'sage@remote']
+    sage: S
+    least-processes scheduler: localhost (2 processes), remote (2 processes)
+"""
+import random
+import re
+import shlex
+import subprocess
+import threading
+import time
+import weakref
+
+# a process placed on a host counts as running for this many seconds
+# before it is started
+STARTUP_GRACE = 60
+
+# assumed memory use of a new worksheet process (bytes)
+PROCESS_MEMORY = 256 * 2**20
+
+PROBE_COMMAND = ("cat /proc/loadavg; getconf _NPROCESSORS_ONLN; "
+                 "grep -E '^(MemAvailable|MemFree):' /proc/meminfo")
+
+
+def parse_probe_output(text):
+    r"""
+    Return the dictionary of the ``load`` average, number of ``cpus``
+    and available ``memory`` (in bytes) of a host given the output of
+    ``PROBE_COMMAND`` on it.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.scheduler import parse_probe_output
+        sage: S = parse_probe_output('3.50 2.10 1.00 4/310 9987\n8\nMemFree:  1024 kB\nMemAvailable:  4096 kB\n')
+        sage: sorted(S.items())
+        [('cpus', 8), ('load', 3.5), ('memory', 4194304)]
+    """
+    lines = text.split('\n')
+    stats = {'load': float(lines[0].split()[0]), 'cpus': int(lines[1])}
+    memory = dict(re.findall(r'^(\w+):\s*(\d+)\s*kB', text, re.MULTILINE))
+    kB = memory.get('MemAvailable', memory.get('MemFree'))
+    stats['memory'] = int(kB) * 1024 if kB is not None else None
+    return stats
+
+
+def host_of(user_at_host):
+    """
+    Return the host of the account ``user_at_host``.
+
+    EXAMPLES::
+
+        sage: from sagenb.interfaces.scheduler import host_of
+        sage: host_of('sage@localhost'), host_of('localhost')
+        ('localhost', 'localhost')
+    """
+    return user_at_host.rsplit('@', 1)[-1]
+
+
+def ssh_probe(user_at_host, timeout=10, connections=None):
+    """
+    Return the load average, number of CPUs and available memory of
+    the host of ``user_at_host`` (see :func:`parse_probe_output`),
+    found by running ``PROBE_COMMAND`` with ssh (over the master
+    connection of ``connections`` if given), or None if that fails.
+    """
+    if connections is None:
+        command = shlex.split('sage-native-execute ssh')
+    else:
+        command = shlex.split(connections.command(user_at_host))
+    command += ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%s' % timeout,
+                user_at_host, PROBE_COMMAND]
+    try:
+        P = subprocess.Popen(command, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, close_fds=True)
+        out = P.communicate()[0]
+        if P.returncode:
+            return None
+        return parse_probe_output(out)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class HostState(object):
+    """
+    What a :class:`HostScheduler` knows about one host: the worksheet
+    processes placed on it (by any account) and the result of its last
+    probe.
+    """
+    def __init__(self, host, process_memory=PROCESS_MEMORY, clock=time.time):
+        self.host = host
+        self.process_memory = process_memory
+        self._clock = clock
+        # (weak reference to the process, time it was placed, account)
+        self._placed = []
+        # the account used to probe the host
+        self.account = None
+        # account --> the order in which it was last chosen
+        self.accounts_chosen = {}
+        # number of processes placed since the last probe
+        self.recent = 0
+        # the order in which the hosts were last chosen
+        self.last_chosen = -1
+        self.load = None
+        self.cpus = None
+        self.memory = None
+        self.probed = None
+        self.probing = False
+
+    def __repr__(self):
+        return "%s (%s processes)" % (self.host, self.processes())
+
+    def add(self, process, account=None):
+        self._placed.append((weakref.ref(process), self._clock(), account))
+        self.recent += 1
+
+    def processes(self, account=None):
+        """
+        Return the number of running worksheet processes on this host,
+        or only those of ``account`` if given.
+        """
+        t = self._clock()
+        placed = []
+        for ref, started, a in self._placed:
+            P = ref()
+            if P is not None and (P.is_started() or t - started < STARTUP_GRACE):
+                placed.append((ref, started, a))
+        self._placed = placed
+        if account is None:
+            return len(placed)
+        return len([x for x in placed if x[2] == account])
+
+    def update(self, stats):
+        """
+        Record the result ``stats`` of a probe (see
+        :func:`parse_probe_output`), or None if it failed.
+        """
+        stats = stats or {}
+        self.load = stats.get('load')
+        self.cpus = stats.get('cpus')
+        self.memory = stats.get('memory')
+        self.probed = self._clock()
+        self.recent = 0
+
+
+def least_processes(state):
+    return state.processes()
+
+
+def least_loaded(state):
+    if state.load is None:
+        return None
+    # Processes placed since the last probe are not in its load
+    # average yet; count them as busy.
+    return (state.load + state.recent) / float(state.cpus or 1)
+
+
+def most_memory(state):
+    if state.memory is None:
+        return None
+    return -(state.memory - state.recent * state.process_memory)
+
+
+def round_robin(state):
+    return state.last_chosen
+
+
+def random_host(state):
+    return random.random()
+
+
+POLICIES = {'least-processes': least_processes,
+            'least-loaded': least_loaded,
+            'memory': most_memory,
+            'round-robin': round_robin,
+            'random': random_host}
+
+# the policies that need the hosts to be probed
+PROBED_POLICIES = ['least-loaded', 'memory']
+
+
+class HostScheduler(object):
+    def __init__(self, policy='least-processes', probe=ssh_probe, interval=30,
+                 background=True, process_memory=PROCESS_MEMORY,
+                 clock=time.time):
+        """
+        Choose the hosts of new worksheet processes.
+
+        INPUT:
+
+        - ``policy`` -- string (default: 'least-processes'); a key of
+          ``POLICIES``
+
+        - ``probe`` -- function (default: :func:`ssh_probe`); returns
+          the load average, number of CPUs and available memory of a
+          host, or None
+
+        - ``interval`` -- number (default: 30); the number of seconds
+          after which the hosts are probed again
+
+        - ``background`` -- bool (default: True); whether the hosts
+          are probed in background threads, or when choosing
+
+        - ``process_memory`` -- integer; the memory (in bytes) a new
+          worksheet process is assumed to use
+
+        - ``clock`` -- function (default: ``time.time``); returns the
+          current time
+        """
+        self.set_policy(policy)
+        self._probe = probe
+        self._interval = interval
+        self._background = background
+        self._process_memory = process_memory
+        self._clock = clock
+        self._hosts = {}
+        self._chosen = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        with self._lock:
+            states = [self._hosts[h] for h in sorted(self._hosts)]
+            return "%s scheduler: %s" % (self._policy_name,
+                                         ', '.join([repr(S) for S in states]))
+
+    def policy(self):
+        return self._policy_name
+
+    def set_policy(self, policy):
+        if policy not in POLICIES:
+            raise ValueError("unknown scheduling policy '%s'" % policy)
+        self._policy_name = policy
+        self._policy = POLICIES[policy]
+
+    def set_interval(self, interval):
+        self._interval = interval
+
+    def state(self, user_at_host):
+        """
+        Return the :class:`HostState` of the host of the account
+        ``user_at_host`` (or of the host ``user_at_host``).
+        """
+        host = host_of(user_at_host)
+        with self._lock:
+            try:
+                S = self._hosts[host]
+            except KeyError:
+                S = HostState(host, self._process_memory, self._clock)
+                self._hosts[host] = S
+            if S.account is None and '@' in user_at_host:
+                S.account = user_at_host
+            return S
+
+    def processes(self, user_at_host):
+        """
+        Return the number of running worksheet processes placed on the
+        host of the account ``user_at_host``, by any account.
+        """
+        return self.state(user_at_host).processes()
+
+    def choose(self, hosts):
+        """
+        Return the account of ``hosts`` (a list of ``user@host``) with
+        which to start a new worksheet process.  The process must then
+        be given to :meth:`add`.
+        """
+        if not hosts:
+            raise ValueError("no host to choose from")
+        with self._lock:
+            # host --> its accounts in hosts
+            accounts = {}
+            states = []
+            for user_at_host in hosts:
+                S = self.state(user_at_host)
+                if S.host not in accounts:
+                    accounts[S.host] = []
+                    states.append(S)
+                accounts[S.host].append(user_at_host)
+            if self._policy_name in PROBED_POLICIES:
+                self._refresh(states)
+
+            def key(state):
+                k = self._policy(state)
+                return (k is None, k, state.processes(), state.last_chosen)
+            best = min(states, key=key)
+            account = min(accounts[best.host],
+                          key=lambda a: (best.processes(a),
+                                         best.accounts_chosen.get(a, -1)))
+            self._chosen += 1
+            best.last_chosen = best.accounts_chosen[account] = self._chosen
+            return account
+
+    def add(self, user_at_host, process):
+        """
+        Record that the worksheet process ``process`` runs as the
+        account ``user_at_host``.
+        """
+        with self._lock:
+            self.state(user_at_host).add(process, user_at_host)
+
+    def _refresh(self, states):
+        t = self._clock()
+        for S in states:
+            if S.probing or (S.probed is not None and t - S.probed < self._interval):
+                continue
+            if self._background:
+                S.probing = True
+                thread = threading.Thread(target=self._update, args=(S,))
+                thread.daemon = True
+                thread.start()
+            else:
+                self._update(S)
+
+    def _update(self, state):
+        try:
+            stats = self._probe(state.account or state.host)
+        except Exception as msg:
+            print("WARNING: Error probing %s: %s" % (state.host, msg))
+            stats = None
+        with self._lock:
+            state.update(stats)
+            state.probing = False
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*
+r"""
+Shared ssh connections to the hosts of the server pool
+
+Each remote worksheet process is an ssh session to a ``user@host`` of
+the server pool, and opening an ssh connection (key exchange, login)
+takes much longer than starting a session on an open one.  An
+:class:`SSHConnections` object keeps one master connection per
+``user@host`` open in the background, using the connection sharing of
+OpenSSH (``ControlMaster``), and the ssh commands of worksheet
+processes run their sessions over it.
+
+Before a master connection is used, it is checked with ``ssh -O
+check`` (at most every ``check_interval`` seconds) and started again
+if it went away.  If it cannot be started, the ssh commands open their
+own connections as before, and starting it is only tried again after
+``check_interval`` seconds.  A master connection that is not used for
+``persist`` seconds closes itself.
+
+The ``ssh`` command can be replaced, e.g., by a stand-in for testing.
+
+EXAMPLES::
+
+    sage: from sagenb.interfaces.ssh import SSHConnections
+    sage: C = SSHConnections(ssh='false')
+    sage: C.options('sage1@localhost')   # the master cannot be started
+    []
+    sage: C.command('sage1@localhost')
+    'false'
+    sage: C
+    ssh connections: sage1@localhost (down)
+"""
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from six.moves import shlex_quote
+
+
+class SSHConnections(object):
+    def __init__(self, ssh='sage-native-execute ssh', check_interval=60,
+                 timeout=10, persist=600):
+        """
+        Master ssh connections to the hosts of the server pool.
+
+        INPUT:
+
+        - ``ssh`` -- string (default: 'sage-native-execute ssh'); the
+          ssh command
+
+        - ``check_interval`` -- number (default: 60); the number of
+          seconds after which a master connection is checked again
+
+        - ``timeout`` -- number (default: 10); the number of seconds
+          after which opening a master connection is given up
+
+        - ``persist`` -- number (default: 600); the number of seconds
+          after which an unused master connection is closed
+        """
+        self._ssh = ssh
+        self._check_interval = check_interval
+        self._timeout = timeout
+        self._persist = persist
+        self._directory = None
+        # user_at_host --> (whether the master is up, time of the check)
+        self._masters = {}
+        # user_at_host --> lock for starting its master
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        with self._lock:
+            hosts = ['%s (%s)' % (h, 'up' if self._masters[h][0] else 'down')
+                     for h in sorted(self._masters)]
+        return "ssh connections: %s" % (', '.join(hosts) or 'none')
+
+    def control_path(self, user_at_host):
+        """
+        Return the path of the control socket of the master connection
+        to ``user_at_host``.
+        """
+        with self._lock:
+            if self._directory is None:
+                # readable only by us (and short, since the length of
+                # the path of a socket is limited)
+                self._directory = tempfile.mkdtemp(prefix='sagenb-ssh-')
+        name = hashlib.md5(user_at_host.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self._directory, name)
+
+    def _run(self, args):
+        """
+        Run ssh with the arguments ``args`` and return True if it
+        succeeded.
+        """
+        null = open(os.devnull, 'r+b')
+        try:
+            return subprocess.call(shlex.split(self._ssh) + args, stdin=null,
+                                   stdout=null, stderr=null,
+                                   close_fds=True) == 0
+        except OSError:
+            return False
+        finally:
+            null.close()
+
+    def is_alive(self, user_at_host):
+        """
+        Return True if the master connection to ``user_at_host`` is up.
+        """
+        return self._run(['-o', 'ControlPath=%s' % self.control_path(user_at_host),
+                          '-O', 'check', user_at_host])
+
+    def _start(self, user_at_host):
+        # ssh returns once it is logged in and the master is in the
+        # background.
+        return self._run(['-o', 'ControlMaster=yes',
+                          '-o', 'ControlPath=%s' % self.control_path(user_at_host),
+                          '-o', 'ControlPersist=%s' % self._persist,
+                          '-o', 'BatchMode=yes',
+                          '-o', 'ConnectTimeout=%s' % self._timeout,
+                          '-o', 'ServerAliveInterval=30',
+                          '-f', '-N', user_at_host])
+
+    def options(self, user_at_host):
+        """
+        Return the list of the ssh options that run a session over the
+        master connection to ``user_at_host``, which is started if
+        needed, or the empty list if there is none.
+        """
+        with self._lock:
+            lock = self._locks.setdefault(user_at_host, threading.Lock())
+        with lock:
+            t = time.time()
+            up, checked = self._masters.get(user_at_host, (False, None))
+            if checked is None or t - checked >= self._check_interval:
+                up = self.is_alive(user_at_host) or (self._start(user_at_host) and
+                                                     self.is_alive(user_at_host))
+                with self._lock:
+                    self._masters[user_at_host] = (up, t)
+        if not up:
+            return []
+        # ControlMaster=no still connects directly if the master is gone.
+        return ['-o', 'ControlPath=%s' % self.control_path(user_at_host),
+                '-o', 'ControlMaster=no']
+
+    def command(self, user_at_host):
+        """
+        Return the ssh command (as a string) that runs a session over
+        the master connection to ``user_at_host``, if there is one.
+        """
+        return ' '.join([self._ssh] + [shlex_quote(x) for x in self.options(user_at_host)])
+
+    def close(self, user_at_host):
+        """
+        Close the master connection to ``user_at_host``.
+        """
+        with self._lock:
+            up, checked = self._masters.pop(user_at_host, (False, None))
+        if up:
+            self._run(['-o', 'ControlPath=%s' % self.control_path(user_at_host),
+                       '-O', 'exit', user_at_host])
+
+    def close_all(self):
+        """
+        Close all master connections.
+        """
+        for user_at_host in list(self._masters):
+            self.close(user_at_host)
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
@@ -16,6 +16,8 @@ AUTHORS:
 #
 #############################################################################
 
+import time
+
 ###################################################################
 # Abstract base class
 ###################################################################
@@ -72,6 +74,21 @@ class WorksheetProcess:
         """
         # default implementation is to do nothing.
 
+    def reset_walltime(self):
+        """
+        Measure the wall time limit of this worksheet process from now
+        on, e.g., when a process that was started in advance is given
+        to a worksheet.
+        """
+        # default implementation is to do nothing.
+
+    def walltime_deadline(self):
+        """
+        Return the wall time at which this worksheet process exceeds
+        its wall time limit, or None if it has no limit.
+        """
+        return None
+
     ###########################################################
     # Query the state of the subprocess
     ###########################################################
@@ -127,7 +144,23 @@ class WorksheetProcess:
 
             - ``OutputStatus`` object.
         """
-        raise NotImplementedError                        
+        raise NotImplementedError
+
+    def wait_for_output(self, timeout):
+        """
+        Block until the subprocess may have produced new output, or
+        until ``timeout`` seconds have elapsed, whichever comes first.
+
+        This lets the caller of :meth:`output_status` wait for output
+        events instead of polling.
+
+        INPUT:
+
+            - ``timeout`` -- float; maximum number of seconds to wait
+        """
+        # default implementation is to wait a little, which makes a
+        # loop around output_status behave like polling.
+        time.sleep(min(timeout, 0.1))                        
 
 
 
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*
+"""
+Locks for the notebook server
+
+The notebook server handles requests in several threads.  Instead of
+one lock for everything, the server uses
+
+- a lock per worksheet and a lock per user, taken from a
+  :class:`LockRegistry`, so that requests on unrelated worksheets or
+  users run concurrently, and
+
+- a :class:`RWLock` for notebook wide structures (such as the user
+  manager and the server configuration), which many requests may read
+  at the same time.
+
+All these locks record how long threads waited for them, under the
+name of their kind; :func:`lock_statistics` returns these numbers, to
+show where threads still wait for each other.
+
+EXAMPLES::
+
+    sage: from sagenb.misc.locks import LockRegistry, lock_statistics
+    sage: L = LockRegistry('example')
+    sage: A = L['sage/0']
+    sage: A.acquire()
+    True
+    sage: L['sage/0'].locked()
+    True
+    sage: A.release()
+    sage: sorted(lock_statistics()['example'].items())
+    [('acquisitions', 1), ('contended', 0), ('max_wait', 0.0), ('wait', 0.0)]
+"""
+
+import threading
+import time
+import weakref
+
+# name --> [acquisitions, contended acquisitions, total wait, maximal wait]
+_statistics = {}
+_statistics_lock = threading.Lock()
+
+
+def _record(name, wait, contended):
+    with _statistics_lock:
+        s = _statistics.get(name)
+        if s is None:
+            s = _statistics[name] = [0, 0, 0.0, 0.0]
+        s[0] += 1
+        if contended:
+            s[1] += 1
+            s[2] += wait
+            s[3] = max(s[3], wait)
+
+
+def lock_statistics():
+    """
+    Return a dictionary mapping the name of each kind of lock to a
+    dictionary with the number of ``acquisitions``, the number of
+    ``contended`` acquisitions (which had to wait), and the ``wait``
+    and ``max_wait`` times of these in seconds.
+    """
+    with _statistics_lock:
+        return dict([(name, {'acquisitions': s[0], 'contended': s[1],
+                             'wait': s[2], 'max_wait': s[3]})
+                     for name, s in _statistics.items()])
+
+
+def reset_lock_statistics():
+    with _statistics_lock:
+        _statistics.clear()
+
+
+class InstrumentedLock(object):
+    def __init__(self, name):
+        """
+        A lock that records how long threads wait for it.
+
+        INPUT:
+
+        - ``name`` -- string; the kind of this lock, see
+          :func:`lock_statistics`
+        """
+        self._name = name
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "%s lock" % self._name
+
+    def acquire(self, blocking=True):
+        if self._lock.acquire(False):
+            _record(self._name, 0, False)
+            return True
+        if not blocking:
+            return False
+        t = time.time()
+        self._lock.acquire()
+        _record(self._name, time.time() - t, True)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class LockRegistry(object):
+    def __init__(self, name):
+        """
+        A lock for each key, e.g., for each worksheet filename.
+
+        A lock exists as long as it is used, so the registry does not
+        grow with the number of keys ever used.
+
+        EXAMPLES::
+
+            sage: from sagenb.misc.locks import LockRegistry
+            sage: L = LockRegistry('worksheet')
+            sage: A = L['sage/0']
+            sage: A is L['sage/0'], A is L['sage/1']
+            (True, False)
+            sage: len(L)
+            1
+        """
+        self._name = name
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Registry of %s locks" % self._name
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __getitem__(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = InstrumentedLock(self._name)
+            return lock
+
+
+class RWLock(object):
+    def __init__(self, name):
+        """
+        A lock that is held either by any number of readers or by one
+        writer.  Waiting writers have precedence over new readers.
+
+        EXAMPLES::
+
+            sage: from sagenb.misc.locks import RWLock
+            sage: L = RWLock('notebook')
+            sage: L.acquire_read(); L.acquire_read(); L.readers()
+            2
+            sage: L.release_read(); L.release_read()
+            sage: L.acquire_write(); L.readers()
+            0
+            sage: L.release_write()
+        """
+        self._name = name
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self.reader = _LockSide(self.acquire_read, self.release_read)
+        self.writer = _LockSide(self.acquire_write, self.release_write)
+
+    def __repr__(self):
+        return "%s reader/writer lock" % self._name
+
+    def readers(self):
+        """
+        Return the number of threads reading.
+        """
+        return self._readers
+
+    def acquire_read(self):
+        t = None
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                if t is None:
+                    t = time.time()
+                self._cond.wait()
+            self._readers += 1
+        _record(self._name + ' (read)', time.time() - t if t else 0, t is not None)
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        t = None
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    if t is None:
+                        t = time.time()
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        _record(self._name + ' (write)', time.time() - t if t else 0, t is not None)
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class _LockSide(object):
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, *args):
+        self._release()
+
@@ -392,6 +392,43 @@ def ignore_nonexistent_files(curdir, dirlist):
     return ignore
 
 
+def move_path(source, target):
+    """
+    Move the file or directory ``source`` to ``target``.
+
+    The file is renamed if it belongs to us and is on the same file
+    system as ``target``.  Otherwise, e.g., if it was written by a
+    worksheet process running as another Unix user, it is copied
+    (skipping broken symbolic links) and then removed.  Return True if
+    it was renamed.
+
+    EXAMPLES::
+
+        sage: from sagenb.misc.misc import move_path
+        sage: t = tmp_dir(); s = os.path.join(t, 'a.png')
+        sage: open(s, 'w').write('png')
+        sage: move_path(s, os.path.join(t, 'b.png'))
+        True
+        sage: sorted(os.listdir(t))
+        ['b.png']
+    """
+    try:
+        if os.lstat(source).st_uid == os.getuid():
+            os.rename(source, target)
+            return True
+    except OSError:
+        # e.g., on another file system
+        pass
+    import shutil
+    if os.path.isdir(source):
+        shutil.copytree(source, target, ignore=ignore_nonexistent_files)
+        shutil.rmtree(source, ignore_errors=True)
+    else:
+        shutil.copy(source, target)
+        os.unlink(source)
+    return False
+
+
 def translations_path():
     return os.path.join(SAGENB_ROOT, 'translations')
 
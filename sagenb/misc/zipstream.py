@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*
+r"""
+Writing zip archives as a stream
+
+The ``zipfile`` module of Python 2 needs a seekable file to write an
+archive to, so an archive has to be written completely before it can
+be sent to a client.  :class:`ZipStream` instead produces the archive
+as a sequence of strings, while the files are added: the size and
+checksum of each file are written after its contents (in a "data
+descriptor"), so nothing has to be written back.
+
+The files are stored uncompressed, like the worksheets (``.sws``
+files are already compressed).
+
+EXAMPLES::
+
+    sage: from sagenb.misc.zipstream import ZipStream
+    sage: fn = tmp_filename()
+    sage: open(fn, 'wb').write('hello world')
+    sage: Z = ZipStream()
+    sage: data = ''.join(Z.add_file(fn, u'caf\xe9.txt'))
+    sage: data += ''.join(Z.close())
+    sage: import zipfile
+    sage: from six import BytesIO
+    sage: A = zipfile.ZipFile(BytesIO(data))
+    sage: A.namelist()
+    [u'caf\xe9.txt']
+    sage: A.read(u'caf\xe9.txt')
+    'hello world'
+    sage: A.testzip() is None
+    True
+"""
+
+import struct
+import time
+import zlib
+
+from .misc import encoded_str
+
+
+class ZipStream(object):
+    def __init__(self, chunk_size=65536):
+        """
+        A zip archive written as a stream of strings.
+
+        Add files with :meth:`add_file` and finish the archive with
+        :meth:`close`; both return iterators over the strings making
+        up the archive, which must be consumed in order.
+
+        INPUT:
+
+        - ``chunk_size`` -- integer (default: 65536); the size of the
+          pieces in which the files are read
+        """
+        self._chunk_size = chunk_size
+        self._offset = 0
+        self._entries = []
+
+    def __repr__(self):
+        return "Zip stream with %s files" % len(self._entries)
+
+    def _emit(self, data):
+        self._offset += len(data)
+        if self._offset > 0xFFFFFFFF:
+            raise ValueError("zip archive too large")
+        return data
+
+    def add_file(self, filename, name):
+        """
+        Return an iterator over the strings adding the file
+        ``filename`` as ``name`` to the archive.
+
+        INPUT:
+
+        - ``filename`` -- string; the name of the file to read
+
+        - ``name`` -- string or unicode; the name in the archive
+        """
+        name = encoded_str(name)
+        t = time.localtime(time.time())
+        dostime = (t[3] << 11) | (t[4] << 5) | (t[5] // 2)
+        dosdate = ((t[0] - 1980) << 9) | (t[1] << 5) | t[2]
+        # bit 3: sizes and CRC in a data descriptor; bit 11: UTF-8 name
+        flags = 0x08 | 0x800
+        offset = self._offset
+        yield self._emit(struct.pack('<4s5H3L2H', 'PK\x03\x04', 20, flags,
+                                     0, dostime, dosdate, 0, 0, 0,
+                                     len(name), 0) + name)
+        crc = 0
+        size = 0
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(self._chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                yield self._emit(chunk)
+        crc &= 0xFFFFFFFF
+        yield self._emit(struct.pack('<4s3L', 'PK\x07\x08', crc, size, size))
+        self._entries.append((name, flags, dostime, dosdate, crc, size, offset))
+
+    def close(self):
+        """
+        Return an iterator over the strings ending the archive (its
+        central directory).
+        """
+        start = self._offset
+        for name, flags, dostime, dosdate, crc, size, offset in self._entries:
+            yield self._emit(struct.pack('<4s6H3L5H2L', 'PK\x01\x02', 20, 20,
+                                         flags, 0, dostime, dosdate, crc,
+                                         size, size, len(name), 0, 0, 0, 0,
+                                         0, offset) + name)
+        n = len(self._entries)
+        yield self._emit(struct.pack('<4s4H2LH', 'PK\x05\x06', 0, 0, n, n,
+                                     self._offset - start, start, 0))
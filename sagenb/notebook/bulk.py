@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*
+"""
+Operations on many worksheets at once
+
+Moving many worksheets to the trash, archiving them, stopping them or
+emptying the trash is done by a :class:`BulkJob`, which runs in a
+background thread (see :meth:`Notebook.bulk_operation`).  The writes
+to the datastore are grouped in batches (see
+:meth:`FilesystemDatastore.write_batch`), so that, e.g., the index of
+the worksheets of a user is saved once per batch instead of once per
+worksheet, and the directories of deleted worksheets are removed in a
+pool of threads.  The progress of a job can be queried while it runs.
+"""
+
+import threading
+
+# the operations and the worksheet method applied by each of them
+BULK_ACTIONS = {'trash': 'move_to_trash',
+                'archive': 'move_to_archive',
+                'active': 'set_active',
+                'stop': None,
+                'empty_trash': None}
+
+
+class BulkJob(object):
+    def __init__(self, id, username, action, filenames=None):
+        """
+        An operation on many worksheets of a user.
+
+        INPUT:
+
+        - ``id`` -- integer; the number of this job
+
+        - ``username`` -- string; the user for whom the operation is
+          done
+
+        - ``action`` -- string; one of the keys of
+          :data:`BULK_ACTIONS`
+
+        - ``filenames`` -- None or a list of worksheet filenames; None
+          for ``'empty_trash'``, whose worksheets are determined when
+          the job runs
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.bulk import BulkJob
+            sage: J = BulkJob(0, 'sage', 'trash', ['sage/0', 'sage/1']); J
+            Bulk trash of 2 worksheets of sage (0 done)
+            sage: J.step(); J.step('sage/1', ValueError('oops'))
+            sage: J.finish(); J.wait(0)
+            True
+            sage: sorted(J.progress().items())
+            [('action', 'trash'), ('done', 2), ('failed', {'sage/1': 'oops'}), ('finished', True), ('id', 0), ('total', 2)]
+        """
+        if action not in BULK_ACTIONS:
+            raise ValueError("unknown bulk operation '%s'" % action)
+        self.id = id
+        self.username = username
+        self.action = action
+        self.filenames = filenames
+        self._total = len(filenames) if filenames is not None else 0
+        self._done = 0
+        # filename --> error message
+        self._failed = {}
+        self._finished = threading.Event()
+
+    def __repr__(self):
+        return "Bulk %s of %s worksheets of %s (%s done)" % (
+            self.action, self._total, self.username, self._done)
+
+    def set_filenames(self, filenames):
+        self.filenames = filenames
+        self._total = len(filenames)
+
+    def step(self, filename=None, error=None):
+        """
+        Record that one more worksheet was done; if ``error`` is given,
+        the operation failed for the worksheet with given filename.
+        """
+        if error is not None:
+            self._failed[filename] = str(error)
+        self._done += 1
+
+    def finish(self):
+        self._finished.set()
+
+    def is_finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until this job is finished, but at most ``timeout``
+        seconds.  Return True if the job is finished.
+        """
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
+    def progress(self):
+        """
+        Return a dictionary describing the progress of this job.
+        """
+        return {'id': self.id,
+                'action': self.action,
+                'total': self._total,
+                'done': self._done,
+                'failed': dict(self._failed),
+                'finished': self.is_finished()}
@@ -805,6 +805,7 @@ class Cell(Cell_generic):
         self._out = u''
         self._out_html = u''
         self._evaluated = False
+        self._invalidate_html()
         self.delete_files()
 
     def evaluated(self):
@@ -956,6 +957,7 @@ class Cell(Cell_generic):
             'nowrap'
         """
         self._type = typ
+        self._invalidate_html()
 
     def update_html_output(self, output=''):
         """
@@ -993,6 +995,7 @@ class Cell(Cell_generic):
             self._out_html = u""
         else:
             self._out_html = self.files_html(output)
+        self._invalidate_html()
 
     def directory(self):
         """
@@ -1252,6 +1255,7 @@ class Cell(Cell_generic):
         """
         self._interrupted = True
         self._evaluated = False
+        self._invalidate_html()
 
     def interrupted(self):
         """
@@ -1356,6 +1360,7 @@ class Cell(Cell_generic):
         """
         if self.is_interacting():
             del self.interact
+            self._invalidate_html()
 
     def set_input_text(self, input):
         """
@@ -1395,6 +1400,7 @@ class Cell(Cell_generic):
         if input.startswith(INTERACT_UPDATE_PREFIX):
             self.interact = input[len(INTERACT_UPDATE_PREFIX)+1:]
             self._version = self.version() + 1
+            self._invalidate_html()
             return
         elif self.is_interacting():
             try:
@@ -1408,8 +1414,7 @@ class Cell(Cell_generic):
         self._evaluated = False
         self._version = self.version() + 1
         self._in = input
-        if hasattr(self, '_html_cache'):
-            del self._html_cache
+        self._invalidate_html()
 
         #Run get the input text with all of the percent
         #directives parsed
@@ -1619,6 +1624,7 @@ class Cell(Cell_generic):
 
         self._changed_input = new_text
         self._in = new_text
+        self._invalidate_html()
 
     def set_output_text(self, output, html, sage=None):
         r"""
@@ -1652,6 +1658,7 @@ class Cell(Cell_generic):
         # (do not overwrite).
         if self.is_interacting():
             self._interact_output = (output, html)
+            self._invalidate_html()
             if INTERACT_RESTART in output:
                 # We forfeit any interact output template (in
                 # self._out), so that the restart message propagates
@@ -1661,8 +1668,7 @@ class Cell(Cell_generic):
                 self._out = output
             return
 
-        if hasattr(self, '_html_cache'):
-            del self._html_cache
+        self._invalidate_html()
 
         output = output.replace('\r', '')
         # We do not truncate if "notruncate" or "Output truncated!" already
@@ -2093,6 +2099,7 @@ class Cell(Cell_generic):
             sage: nb.delete()
         """
         self._introspect = False
+        self._invalidate_html()
 
     def set_introspect(self, before_prompt, after_prompt):
         """
@@ -2112,6 +2119,7 @@ class Cell(Cell_generic):
             ['a', 'b']
         """
         self._introspect = [before_prompt, after_prompt]
+        self._invalidate_html()
 
     def evaluate(self, introspect=False, time=None, username=None):
         r"""
@@ -2161,6 +2169,7 @@ class Cell(Cell_generic):
         self._introspect = introspect
         self.worksheet().enqueue(self, username=username)
         self._type = 'wrap'
+        self._invalidate_html()
         dir = self.directory()
         for D in os.listdir(dir):
             F = os.path.join(dir, D)
@@ -2249,15 +2258,51 @@ class Cell(Cell_generic):
             sage: C = sagenb.notebook.cell.Cell(0, '2+3', '5', W)
             sage: C.html()
             u'...cell_outer_0...2+3...5...'
+
+        The HTML is cached until the cell changes::
+
+            sage: C.html() is C.html()
+            True
+            sage: C.set_output_text('6', '')
+            sage: C.html()
+            u'...cell_outer_0...2+3...6...'
         """
         from .template import template
+        from flask_babel import get_locale
 
         if wrap is None:
             wrap = self.notebook().conf()['word_wrap_cols']
 
-        return template(os.path.join('html', 'notebook', 'cell.html'),
-                        cell=self, wrap=wrap, div_wrap=div_wrap,
-                        do_print=do_print, publish=publish)
+        # Everything the template uses that does not go through a
+        # method calling _invalidate_html.
+        worksheet = self.worksheet()
+        key = (self.version(), wrap, div_wrap, do_print, publish,
+               publish and self.notebook().conf()['pub_interact'],
+               self.evaluated(), self.computing(), worksheet.filename(),
+               worksheet.docbrowser(), str(get_locale()))
+        try:
+            return self._html_cache[key]
+        except AttributeError:
+            self._html_cache = {}
+        except KeyError:
+            if len(self._html_cache) >= 8:
+                self._html_cache.clear()
+
+        s = template(os.path.join('html', 'notebook', 'cell.html'),
+                     cell=self, wrap=wrap, div_wrap=div_wrap,
+                     do_print=do_print, publish=publish)
+        self._html_cache[key] = s
+        return s
+
+    def _invalidate_html(self):
+        """
+        Forget the HTML cached by :meth:`html`; called whenever the
+        input, output or state of this compute cell changes.
+        """
+        try:
+            del self._html_cache
+        except AttributeError:
+            pass
 
     def url_to_self(self):
         """
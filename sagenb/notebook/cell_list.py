@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*
+"""
+Indexed lists of the cells of a worksheet
+
+A worksheet looks up its cells by id on almost every request (to
+evaluate a cell, to send its new output, to insert a cell after it,
+...), and checks whether a cell is in the queue of cells waiting for
+evaluation.  A :class:`CellList` is a list of cells that keeps the
+position of each cell by id, and a :class:`CellQueue` a list of cells
+that keeps the set of their ids, so that these are dictionary lookups
+instead of scans comparing the cells one by one.
+
+Both are kept up to date by their mutating methods.  Inserting,
+replacing or removing a single cell of a :class:`CellList` updates its
+index in place, shifting the positions after that cell (which costs no
+more than moving the cells of the list itself); changes of slices, of
+the order, or of many cells at once drop the index, which is rebuilt
+by the next lookup.  The ids of the cells must not change while they
+are in these lists.
+
+EXAMPLES::
+
+    sage: from sagenb.notebook.cell_list import CellList
+    sage: from sagenb.notebook.cell import Cell
+    sage: L = CellList([Cell(0, '2+3', '', None), Cell('a', '', '', None)])
+    sage: L.position('a')
+    1
+    sage: L.insert(0, Cell(5, '', '', None)); L.position('a')
+    2
+    sage: L.cell(7) is None
+    True
+
+Single cell changes keep the index::
+
+    sage: L.insert(1, Cell('a', '', '', None)); sorted(L._positions.items())
+    [(0, 2), (5, 0), ('a', 1)]
+    sage: del L[1]; sorted(L._positions.items())
+    [(0, 1), (5, 0), ('a', 2)]
+    sage: L[0] = Cell(7, '', '', None); L.pop(1).id()
+    0
+    sage: sorted(L._positions.items())
+    [(7, 0), ('a', 1)]
+    sage: L.remove(L[0]); sorted(L._positions.items())
+    [('a', 0)]
+"""
+
+
+class CellList(list):
+    def __init__(self, cells=()):
+        """
+        A list of cells with an index of their positions by id.
+        """
+        list.__init__(self, cells)
+        # id --> position of the first cell with this id, or None
+        self._positions = None
+
+    def __reduce__(self):
+        # copies and pickles build their own index
+        return (self.__class__, (list(self),))
+
+    def _changed(self):
+        self._positions = None
+
+    def _index(self, i):
+        # the non-negative position of the cell at index i
+        return i + len(self) if i < 0 else i
+
+    def _shift(self, i, n):
+        # move the positions of the cells from position i on by n
+        positions = self._positions
+        for id, j in list(positions.items()):
+            if j >= i:
+                positions[id] = j + n
+
+    def _added(self, i, C):
+        # the cell C is now at position i
+        j = self._positions.get(C.id())
+        if j is None or j > i:
+            self._positions[C.id()] = i
+
+    def _removed(self, i, C):
+        # the cell C at position i is gone, or replaced
+        id = C.id()
+        if self._positions.get(id) != i:
+            return
+        for j in range(i, len(self)):
+            if self[j].id() == id:
+                self._positions[id] = j
+                return
+        del self._positions[id]
+
+    def position(self, id):
+        """
+        Return the position of the first cell with given id, or None if
+        there is no such cell.
+        """
+        positions = self._positions
+        if positions is None:
+            positions = {}
+            for i in range(len(self) - 1, -1, -1):
+                positions[self[i].id()] = i
+            self._positions = positions
+        return positions.get(id)
+
+    def cell(self, id):
+        """
+        Return the first cell with given id, or None if there is no
+        such cell.
+        """
+        i = self.position(id)
+        if i is None:
+            return None
+        return self[i]
+
+    def append(self, C):
+        list.append(self, C)
+        if self._positions is not None:
+            self._positions.setdefault(C.id(), len(self) - 1)
+
+    def pop(self, i=-1):
+        i = self._index(i)
+        C = list.pop(self, i)
+        if self._positions is not None:
+            self._shift(i + 1, -1)
+            self._removed(i, C)
+        return C
+
+    def insert(self, i, C):
+        i = max(0, min(self._index(i), len(self)))
+        list.insert(self, i, C)
+        if self._positions is not None:
+            self._shift(i, 1)
+            self._added(i, C)
+
+    def extend(self, cells):
+        list.extend(self, cells)
+        self._changed()
+
+    def remove(self, C):
+        self.pop(self.index(C))
+
+    def sort(self, *args, **kwds):
+        list.sort(self, *args, **kwds)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def __setitem__(self, i, C):
+        if not isinstance(i, int):
+            list.__setitem__(self, i, C)
+            self._changed()
+            return
+        i = self._index(i)
+        old = self[i]
+        list.__setitem__(self, i, C)
+        if self._positions is not None:
+            self._removed(i, old)
+            self._added(i, C)
+
+    def __delitem__(self, i):
+        if isinstance(i, int):
+            self.pop(i)
+        else:
+            list.__delitem__(self, i)
+            self._changed()
+
+    def __iadd__(self, cells):
+        list.extend(self, cells)
+        self._changed()
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._changed()
+        return self
+
+    # Python 2 slices
+    def __setslice__(self, i, j, cells):
+        list.__setslice__(self, i, j, cells)
+        self._changed()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed()
+
+
+class CellQueue(list):
+    def __init__(self, cells=()):
+        """
+        A queue of cells, in which a cell is found by its id.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.cell_list import CellQueue
+            sage: from sagenb.notebook.cell import Cell
+            sage: C = Cell(0, '2+3', '', None)
+            sage: Q = CellQueue(); Q.append(C)
+            sage: Cell(0, '', '', None) in Q, Cell(1, '', '', None) in Q
+            (True, False)
+            sage: del Q[0]; C in Q
+            False
+
+        Copies keep their own ids::
+
+            sage: import copy
+            sage: Q.append(C)
+            sage: copies = [copy.copy(Q), copy.deepcopy(Q), loads(dumps(Q))]
+            sage: for R in copies: _ = R.pop()
+            sage: [C in R for R in copies], C in Q
+            ([False, False, False], True)
+            sage: Q *= 2; _ = Q.pop(); C in Q
+            True
+        """
+        list.__init__(self, cells)
+        self._rebuild()
+
+    def __reduce__(self):
+        # copies and pickles count the ids of their own cells
+        return (self.__class__, (list(self),))
+
+    def _rebuild(self):
+        # id --> number of cells with this id
+        self._ids = {}
+        for C in self:
+            self._add(C)
+
+    def _add(self, C):
+        self._ids[C.id()] = self._ids.get(C.id(), 0) + 1
+
+    def _discard(self, C):
+        n = self._ids[C.id()] - 1
+        if n:
+            self._ids[C.id()] = n
+        else:
+            del self._ids[C.id()]
+
+    def __contains__(self, C):
+        return C.id() in self._ids
+
+    def append(self, C):
+        list.append(self, C)
+        self._add(C)
+
+    def insert(self, i, C):
+        list.insert(self, i, C)
+        self._add(C)
+
+    def pop(self, i=-1):
+        C = list.pop(self, i)
+        self._discard(C)
+        return C
+
+    def remove(self, C):
+        i = self.index(C)
+        self._discard(list.__getitem__(self, i))
+        list.__delitem__(self, i)
+
+    def extend(self, cells):
+        list.extend(self, cells)
+        self._rebuild()
+
+    def __setitem__(self, i, C):
+        list.__setitem__(self, i, C)
+        self._rebuild()
+
+    def __delitem__(self, i):
+        if isinstance(i, int):
+            self._discard(self[i])
+            list.__delitem__(self, i)
+        else:
+            list.__delitem__(self, i)
+            self._rebuild()
+
+    def __iadd__(self, cells):
+        self.extend(cells)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._rebuild()
+        return self
+
+    # Python 2 slices
+    def __setslice__(self, i, j, cells):
+        list.__setslice__(self, i, j, cells)
+        self._rebuild()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._rebuild()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*
+r"""
+A cache of the live documentation pages
+
+Showing a page of the documentation in a live worksheet converts its
+HTML to worksheet text with
+:class:`~sagenb.notebook.docHTMLProcessor.SphinxHTMLProcessor`, which is
+slow for the large pages of the reference manual.  The pages do not
+change between Sage upgrades, so a :class:`DocCache` stores the title
+and the worksheet text of each converted page on disk.  The entries
+are addressed by a hash of the HTML source (and of
+:data:`CACHE_VERSION`), so a changed page is converted again while a
+reinstalled, unchanged page is not; the modification time and size of
+each file are remembered so that a page is only read and hashed again
+when it changed.
+
+The cache can be filled in advance, in parallel, by running::
+
+    python -m sagenb.notebook.doc_cache [DOC_DIRECTORY [PROCESSES]]
+
+EXAMPLES::
+
+    sage: from sagenb.notebook.doc_cache import DocCache
+    sage: C = DocCache(tmp_dir())
+    sage: page = tmp_filename(ext='.html')
+    sage: html = '<html><head><title>Sage &mdash; Test</title></head><body><p>Hello</p></body></html>'
+    sage: open(page, 'w').write(html)
+    sage: title, text = C.lookup(page); title
+    u'Sage -- Test'
+    sage: C.conversions
+    1
+    sage: C.lookup(page) == (title, text)
+    True
+    sage: C.conversions
+    1
+"""
+
+import json
+import os
+import threading
+from hashlib import sha1
+
+from sagenb.misc.misc import DOT_SAGENB, unicode_str
+
+# Change this when the conversion changes, to invalidate the entries.
+CACHE_VERSION = 1
+
+
+def convert_doc_page(html):
+    """
+    Return the title and the worksheet text of the HTML documentation
+    page ``html``.  The title is empty if the page has none.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.doc_cache import convert_doc_page
+        sage: convert_doc_page('<html><body><p>Hi</p></body></html>')[0]
+        u''
+    """
+    from .docHTMLProcessor import SphinxHTMLProcessor
+    text = SphinxHTMLProcessor().process_doc_html(html)
+    h = html.lower()
+    i = h.find('<title>')
+    if i == -1:
+        title = u''
+    else:
+        title = unicode_str(html[i + len('<title>'):h.find('</title>')])
+    return title.replace(u'&mdash;', u'--'), text
+
+
+class DocCache(object):
+    def __init__(self, directory):
+        """
+        A cache of converted documentation pages in ``directory``.
+        """
+        self._directory = directory
+        # path --> (mtime, size, digest)
+        self._stamps = {}
+        self._lock = threading.Lock()
+        self.conversions = 0
+
+    def __repr__(self):
+        return "Documentation cache in %s" % self._directory
+
+    def directory(self):
+        return self._directory
+
+    def _filename(self, digest):
+        return os.path.join(self._directory, digest[:2], digest + '.json')
+
+    def _read(self, digest):
+        try:
+            with open(self._filename(digest), 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8'))
+            return entry['title'], entry['text']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, digest, title, text):
+        filename = self._filename(digest)
+        tmp = '%s.%s.tmp' % (filename, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps({'title': title, 'text': text}).encode('utf-8'))
+            os.rename(tmp, filename)
+        except (IOError, OSError) as msg:
+            print("WARNING: Could not cache documentation page: %s" % msg)
+
+    def lookup(self, path):
+        """
+        Return the title and the worksheet text of the documentation
+        page in the file ``path``, converting it only if it is not in
+        the cache.
+        """
+        st = os.stat(path)
+        stamp = (st.st_mtime, st.st_size)
+        with self._lock:
+            known = self._stamps.get(path)
+        if known is not None and known[:2] == stamp:
+            entry = self._read(known[2])
+            if entry is not None:
+                return entry
+        with open(path, 'rb') as f:
+            html = f.read()
+        digest = sha1(b'%d\0' % CACHE_VERSION + html).hexdigest()
+        entry = self._read(digest)
+        if entry is None:
+            entry = convert_doc_page(html)
+            self.conversions += 1
+            self._write(digest, *entry)
+        with self._lock:
+            self._stamps[path] = stamp + (digest,)
+        return entry
+
+    def prewarm(self, root, processes=None):
+        """
+        Convert all HTML pages below the directory ``root`` that are not
+        in the cache yet, in ``processes`` parallel processes (default:
+        the number of CPUs).  Return the number of pages.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in ['_static', '_sources']]
+            paths.extend([os.path.join(dirpath, x) for x in filenames
+                          if x.endswith('.html')])
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            for path in pool.imap_unordered(_prewarm_page,
+                                            [(self._directory, x) for x in paths]):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+        return len(paths)
+
+
+def _prewarm_page(args):
+    directory, path = args
+    try:
+        DocCache(directory).lookup(path)
+    except Exception as msg:
+        print("WARNING: Could not convert %s: %s" % (path, msg))
+    return path
+
+
+_doc_cache = None
+
+
+def doc_cache():
+    """
+    Return the documentation cache of this Sage installation, which
+    lives in the ``doc_cache`` directory of ``DOT_SAGENB``.
+    """
+    global _doc_cache
+    if _doc_cache is None:
+        _doc_cache = DocCache(os.path.join(DOT_SAGENB, 'doc_cache'))
+    return _doc_cache
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        root = sys.argv[1]
+    else:
+        from sage.env import SAGE_DOC
+        root = os.path.join(SAGE_DOC, 'html', 'en')
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    C = doc_cache()
+    print("Converted %s documentation pages into %s" % (C.prewarm(root, processes),
+                                                        C.directory()))
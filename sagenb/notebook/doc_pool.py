@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*
+"""
+A pool of proxy worksheets for the documentation and published pages
+
+Each live documentation page and each interactive view of a published
+worksheet is shown in a proxy worksheet owned by the ``_sage_`` user.
+A :class:`DocWorksheetPool` keeps these proxies in memory: a proxy is
+checked out for a page, checked in again when the page was rendered,
+and reused (least recently used first) for later pages.  At most
+``size`` proxies are created; when all of them are busy, a checkout
+waits a bounded time for one to become free.
+
+A checked in proxy whose worksheet process is still running is in use
+by the reader of its page, so it is not reused until the process was
+quit (e.g., by :meth:`Notebook.quit_idle_worksheet_processes`).
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class DocWorksheetPool(object):
+    def __init__(self, factory, size, worksheets=()):
+        """
+        A pool of proxy worksheets.
+
+        INPUT:
+
+        - ``factory`` -- a callable returning a new proxy worksheet
+
+        - ``size`` -- integer; the maximal number of proxies
+
+        - ``worksheets`` -- iterable (default: empty); existing proxy
+          worksheets to reuse
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.doc_pool import DocWorksheetPool
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: P = DocWorksheetPool(lambda: nb.create_new_worksheet('', '_sage_'), 2)
+            sage: P
+            Pool of 0 of 2 doc worksheets
+            sage: W = P.checkout(); W.filename()
+            '_sage_/0'
+            sage: V = P.checkout(); V.filename()
+            '_sage_/1'
+            sage: P.checkout(timeout=0) is None
+            True
+            sage: P.checkin(W); P
+            Pool of 2 of 2 doc worksheets
+            sage: P.checkout(timeout=0) is W
+            True
+        """
+        self._factory = factory
+        self._size = size
+        self._idle = deque()
+        self._busy = {}
+        self._count = 0
+        self._cond = threading.Condition()
+        for W in worksheets:
+            if self._count < size:
+                self._idle.append(W)
+                self._count += 1
+
+    def __repr__(self):
+        return "Pool of %s of %s doc worksheets" % (self._count, self._size)
+
+    def __len__(self):
+        """
+        Return the number of proxies that are checked in.
+        """
+        return len(self._idle)
+
+    def size(self):
+        """
+        Return the maximal number of proxies of this pool.
+        """
+        return self._size
+
+    def set_size(self, size):
+        """
+        Set the maximal number of proxies of this pool.  Extra proxies
+        are dropped when they are checked in.
+        """
+        with self._cond:
+            self._size = size
+            while self._count > size and self._idle:
+                self._idle.popleft()
+                self._count -= 1
+            self._cond.notify_all()
+
+    def _take_idle(self):
+        """
+        Remove and return the least recently used checked in proxy
+        whose worksheet process is not running, or None.
+        """
+        for i in range(len(self._idle)):
+            W = self._idle.popleft()
+            if not W.compute_process_has_been_started():
+                return W
+            self._idle.append(W)
+        return None
+
+    def checkout(self, timeout=10):
+        """
+        Return a cleared proxy worksheet, which must be given back with
+        :meth:`checkin`, or None if no proxy became free within
+        ``timeout`` seconds.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                W = self._take_idle()
+                if W is not None or self._count < self._size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                # proxies whose process quits do not notify the pool
+                self._cond.wait(min(remaining, 1))
+            if W is None:
+                self._count += 1
+        if W is None:
+            try:
+                W = self._factory()
+            except Exception:
+                with self._cond:
+                    self._count -= 1
+                    self._cond.notify_all()
+                raise
+        else:
+            W.clear()
+            W.set_tags({})
+        with self._cond:
+            self._busy[W.filename()] = W
+        return W
+
+    def checkin(self, W):
+        """
+        Give back the proxy worksheet ``W``, taken with :meth:`checkout`.
+        """
+        with self._cond:
+            if self._busy.pop(W.filename(), None) is None:
+                return
+            if self._count > self._size:
+                self._count -= 1
+            else:
+                self._idle.append(W)
+            self._cond.notify_all()
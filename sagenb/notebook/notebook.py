@@ -21,13 +21,16 @@ from __future__ import print_function, absolute_import
 USE_REFERENCE_WORKSHEET_PROCESSES = False
 
 # System libraries
+import heapq
+import itertools
 import os
 import random
 import re
 import shutil
 import socket
+import threading
 import time
-import bz2
+from collections import OrderedDict
 from cgi import escape
 
 try:
@@ -44,7 +47,7 @@ from six import iteritems
 
 # Sage libraries
 from sagenb.misc.misc import (pad_zeros, cputime, tmp_dir, load, save,
-                              ignore_nonexistent_files, unicode_str)
+                              ignore_nonexistent_files, unicode_str, walltime)
 
 # Sage Notebook
 from . import css          # style
@@ -96,15 +99,91 @@ MATHJAX = True
 
 JEDITABLE_TINYMCE  = True
 
+class _NoLock(object):
+    # stands in for a lock when Notebook.save is not given one
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+_no_lock = _NoLock()
+
 class WorksheetDict(dict):
+    """
+    The loaded worksheets of a notebook, by filename.
+
+    A worksheet that is not loaded is loaded from the datastore when
+    it is accessed.  The least recently used worksheets are unloaded
+    again (see :meth:`shrink`), except for those with a running compute
+    process, those of the ``_sage_`` user and those accessed in the
+    last ``min_idle`` seconds.  Worksheets are only unloaded by the
+    supervisor and the background saver (see
+    :meth:`Notebook.evict_idle_worksheets`), never while accessing
+    one: the thread accessing it may be writing in a batch, or hold
+    the lock of another worksheet.
+
+    EXAMPLES::
+
+        sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+        sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+        sage: for i in range(3): W = nb.create_new_worksheet('W%s' % i, 'sage')
+        sage: D = nb._Notebook__worksheets
+        sage: D.min_idle = 0
+        sage: W = D['sage/0']
+        sage: D.shrink(max_count=2)
+        sage: sorted(D)
+        ['sage/0', 'sage/2']
+        sage: D['sage/1']
+        sage/1: [Cell 1: in=, out=]
+        sage: S = D.stats(); S['hits'], S['misses'], S['evictions'], S['loaded']
+        (1, 1, 1, 3)
+    """
+    # a worksheet accessed more recently than this many seconds ago
+    # may still be used by a request, and is never unloaded
+    min_idle = 60
+
     def __init__(self, notebook, *args, **kwds):
         self.notebook = notebook
         self.storage = notebook._Notebook__storage
         dict.__init__(self, *args, **kwds)
+        # filename --> walltime of the last access, least recent first
+        self.last_access = OrderedDict.fromkeys(self, walltime())
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+        # filenames of the worksheets that may have changed in a way
+        # shown in the listing since they were saved
+        self.changed_listings = set()
+
+    def __setitem__(self, item, worksheet):
+        with self._lock:
+            dict.__setitem__(self, item, worksheet)
+            self._touch(item)
+        worksheet._changed_listings = self.changed_listings
+        if worksheet.listing_changed():
+            self.changed_listings.add(item)
+
+    def __delitem__(self, item):
+        with self._lock:
+            dict.__delitem__(self, item)
+            self.last_access.pop(item, None)
+
+    def _touch(self, item):
+        self.last_access.pop(item, None)
+        self.last_access[item] = walltime()
 
     def __getitem__(self, item):
-        if item in self:
-            return dict.__getitem__(self, item)
+        with self._lock:
+            if item in self:
+                self.hits += 1
+                self._touch(item)
+                return dict.__getitem__(self, item)
 
         try:
             if '/' not in item:
@@ -122,10 +201,135 @@ class WorksheetDict(dict):
         except ValueError:
             raise KeyError(item)
 
-        dict.__setitem__(self, item, worksheet)
+        with self._lock:
+            if item in self:
+                # loaded by another thread in the meantime
+                self._touch(item)
+                return dict.__getitem__(self, item)
+            self.misses += 1
+            self[item] = worksheet
         return worksheet
-        
-        
+
+    def idle(self, timeout, prefix=''):
+        """
+        Return the list of filenames starting with ``prefix`` of the
+        loaded worksheets that were not accessed in the last
+        ``timeout`` seconds, least recently used first.
+        """
+        t = walltime() - timeout
+        v = []
+        with self._lock:
+            for k, a in self.last_access.items():
+                if a >= t:
+                    break
+                if k.startswith(prefix):
+                    v.append(k)
+        return v
+
+    def evict(self, item, worksheet_lock=None):
+        """
+        Save the worksheet with filename ``item`` and unload it, unless
+        it must stay loaded.  It is loaded again from the datastore on
+        the next access.  Return True if the worksheet was unloaded.
+
+        If ``worksheet_lock`` is given, it is called with the worksheet
+        and returns its lock, which is held while saving and unloading
+        it; a worksheet whose lock is held is in use, and stays loaded.
+        """
+        W = dict.get(self, item)
+        if W is None or item.startswith('_sage_/'):
+            return False
+        if walltime() - self.last_access.get(item, 0) < self.min_idle:
+            return False
+        lock = worksheet_lock(W) if worksheet_lock else _no_lock
+        if not lock.acquire(False):
+            return False
+        try:
+            if W.compute_process_has_been_started():
+                return False
+            # The file is in place once save_worksheet returns, even
+            # inside a write batch, so the worksheet can be loaded again.
+            self.storage.save_worksheet(W)
+            with self._lock:
+                if self.last_access.get(item, 0) > walltime() - self.min_idle:
+                    # accessed while it was being saved
+                    return False
+                del self[item]
+                self.evictions += 1
+            return True
+        finally:
+            lock.release()
+
+    def shrink(self, max_count=None, max_size=None, worksheet_lock=None):
+        """
+        Unload the least recently used worksheets that can be unloaded
+        until at most ``max_count`` worksheets are loaded and their
+        :meth:`Worksheet.approximate_size` adds up to at most
+        ``max_size``.  A limit that is None or 0 is ignored.  See
+        :meth:`evict` for ``worksheet_lock``.
+        """
+        if not max_count and not max_size:
+            return
+        size = 0
+        if max_size:
+            size = sum([W.approximate_size() for W in list(self.values())])
+        for item in self.idle(self.min_idle):
+            if ((not max_count or len(self) <= max_count) and
+                    (not max_size or size <= max_size)):
+                break
+            W = dict.get(self, item)
+            if W is None:
+                continue
+            n = W.approximate_size() if max_size else 0
+            if self.evict(item, worksheet_lock):
+                size -= n
+
+    def changed_listing_rows(self):
+        """
+        Return a dictionary mapping the pairs ``(owner, id_number)`` of
+        the loaded worksheets whose listing rows changed since they
+        were saved to their new listing rows.  Only the worksheets
+        which changed since the last call are looked at.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.create_new_worksheet('Test', 'sage'); W.save()
+            sage: D = nb._Notebook__worksheets
+            sage: D.changed_listing_rows()
+            {}
+            sage: W.set_name('Renamed')
+            sage: [row['name'] for row in D.changed_listing_rows().values()]
+            [u'renamed']
+            sage: W.save(); D.changed_listing_rows(), len(D.changed_listings)
+            ({}, 0)
+        """
+        rows = {}
+        for item in list(self.changed_listings):
+            # forget it first, so that a change made while we look is
+            # recorded again
+            self.changed_listings.discard(item)
+            W = dict.get(self, item)
+            if W is None or not W.listing_changed():
+                continue
+            self.changed_listings.add(item)
+            rows[(W.owner(), W.id_number())] = worksheet.listing_row(W.basic())
+        return rows
+
+    def stats(self):
+        """
+        Return a dictionary with the numbers of hits, misses,
+        evictions and loaded worksheets, and the total approximate
+        size of the loaded worksheets.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loaded': len(self),
+                'size': sum([W.approximate_size() for W in list(self.values())])}
+
+
 class Notebook(object):
     HISTORY_MAX_OUTPUT = 92*5
     HISTORY_NCOLS = 90
@@ -145,6 +349,20 @@ class Notebook(object):
         from sagenb.storage import FilesystemDatastore
         S = FilesystemDatastore(dir)
         self.__storage = S
+        self.__save_lock = threading.RLock()
+        # set to have the background saver save now (see request_save)
+        self.__save_requested = threading.Event()
+        self.__saver_waiting = False
+        # the recent bulk operations, by id
+        self.__bulk_jobs = {}
+        self.__bulk_count = 0
+        self.__bulk_lock = threading.Lock()
+        # history entries of each user that are not saved yet
+        self._pending_history = {}
+        self.__history_lock = threading.Lock()
+        # held while appending the pending entries to disk, without
+        # the history lock (see _save_user_history)
+        self.__history_save_lock = threading.Lock()
 
         # Now set the configuration, loaded from the datastore.
         try:
@@ -173,16 +391,8 @@ class Notebook(object):
         W = WorksheetDict(self)
         self.__worksheets = W
 
-        # Store / Refresh public worksheets
-        for id_number in os.listdir(self.__storage._abspath(self.__storage._user_path("pub"))):
-            if id_number.isdigit():
-                a = "pub/"+str(id_number)
-                if a not in self.__worksheets:
-                    try:
-                        self.__worksheets[a] = self.__storage.load_worksheet("pub",int(id_number))
-                    except Exception:
-                        import traceback
-                        print("Warning: problem loading %s/%s: %s" % ("pub", int(id_number), traceback.format_exc()))
+        # Published worksheets are loaded on demand, like all the
+        # other worksheets; see pub_worksheets.
 
         # Set the openid-user dict
         try:
@@ -348,10 +558,11 @@ class Notebook(object):
         #      shutil.copytree(src.cells_directory(), W.cells_directory())
         #      shutil.copytree(src.data_directory(), W.data_directory())
 
-        for sub in ['cells', 'data', 'snapshots']:
+        for sub in ['cells', 'data']:
             target_dir = os.path.join(W.directory(), sub)
             if os.path.exists(target_dir):
                 shutil.rmtree(target_dir, ignore_errors=True)
+        W.delete_snapshots()
 
         # Copy images, data files, etc.
         for sub in ['cells', 'data']:
@@ -364,31 +575,36 @@ class Notebook(object):
         W.save()
 
     def pub_worksheets(self):
-        path = self.__storage._abspath(self.__storage._user_path("pub"))
-        v = []
-        a = ""
-        for id_number in os.listdir(path):
-            if id_number.isdigit():
-                a = "pub"+"/"+id_number
-                if a in self.__worksheets:
-                    v.append(self.__worksheets[a])
-                else:
-                    try:
-                        self.__worksheets[a] = self.__storage.load_worksheet("pub", int(id_number))
-                        v.append(self.__worksheets[a])
-                    except Exception:
-                        import traceback
-                        print("Warning: problem loading %s/%s: %s" % ("pub", id_number, traceback.format_exc()))
-        return v
+        """
+        Return the list of published worksheets.
+
+        They are built from the worksheet metadata index of the
+        datastore, so the published worksheets need not be loaded; a
+        published worksheet is loaded when it is viewed.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.load_notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Published', 'admin')
+            sage: P = nb.publish_worksheet(W, 'admin')
+            sage: nb.pub_worksheets()
+            [pub/0: [Cell 1: in=, out=]]
+            sage: nb.pub_worksheets()[0] is P
+            True
+            sage: nb._Notebook__worksheets.min_idle = 0
+            sage: nb.evict_idle_worksheets(pub_timeout=-1)
+            sage: 'pub/0' in nb.worksheet_names()
+            False
+            sage: nb.pub_worksheets()[0].name()
+            u'Published'
+        """
+        return self.users_worksheets('pub')
 
     def users_worksheets(self, username):
         r"""
         Returns all worksheets owned by `username`
         """
-
-        if username == "pub":
-            return self.pub_worksheets()
-
         worksheets = self.__storage.worksheets(username)
         # if a worksheet has already been loaded in self.__worksheets, return
         # that instead since worksheets that are already running should be
@@ -402,10 +618,15 @@ class Notebook(object):
         # Should return worksheets from self.__worksheets if possible
         worksheets = self.users_worksheets(username)
         user=self.user_manager().user(username)
-        viewable_worksheets=[self.__storage.load_worksheet(owner, id) for owner,id in user.viewable_worksheets()]
-        # we double-check that we can actually view these worksheets
-        # just in case someone forgets to update the map
-        worksheets.extend([w for w in viewable_worksheets if w.is_viewer(username)])
+        # group the viewable worksheets by owner, so that each owner's
+        # worksheet index is read only once
+        viewable = {}
+        for owner, id in user.viewable_worksheets():
+            viewable.setdefault(owner, []).append(id)
+        for owner, ids in iteritems(viewable):
+            # we double-check that we can actually view these worksheets
+            # just in case someone forgets to update the map
+            worksheets.extend([w for w in self.__storage.worksheets(owner, ids) if w.is_viewer(username)])
         # if a worksheet has already been loaded in self.__worksheets, return that instead
         # since worksheets that are already running should be noted as such
         return [self.__worksheets[w.filename()] if w.filename() in self.__worksheets else w for w in worksheets]
@@ -494,7 +715,7 @@ class Notebook(object):
         W.set_name(name)
         return W
 
-    def delete_worksheet(self, filename):
+    def delete_worksheet(self, filename, remove_files=True):
         """
         Delete the given worksheet and remove its name from the worksheet
         list.  Raise a KeyError, if it is missing.
@@ -502,6 +723,10 @@ class Notebook(object):
         INPUT:
 
         - ``filename`` - a string
+
+        - ``remove_files`` - a boolean (default: True); see
+          :meth:`FilesystemDatastore.delete_worksheet`, whose output
+          is returned
         """
         try:
             W = self.__worksheets[filename]
@@ -509,8 +734,13 @@ class Notebook(object):
             raise KeyError("Attempt to delete missing worksheet '%s'" % filename)
         
         W.quit()
-        shutil.rmtree(W.directory(), ignore_errors=False)
+        # the owner may already have been removed from W (see
+        # empty_trash), so we use the filename to locate it
+        owner = W.filename().split('/')[0]
+        deleted = self.__storage.delete_worksheet(owner, W.id_number(),
+                                                  remove_files=remove_files)
         self.deleted_worksheets()[filename] = W
+        return deleted
 
     def deleted_worksheets(self):
         try:
@@ -543,12 +773,139 @@ class Notebook(object):
             sage: nb.worksheet_names()
             []
         """
-        X = self.get_worksheets_with_viewer(username)
-        X = [W for W in X if W.is_trashed(username)]
-        for W in X:
-            W.delete_user(username)
-            if W.owner() is None:
-                self.delete_worksheet(W.filename())
+        self.bulk_operation(username, 'empty_trash').wait()
+
+    def bulk_operation(self, username, action, filenames=None,
+                       worksheet_lock=None, threads=4, batch_size=100):
+        """
+        Start an operation on many worksheets of a user in the
+        background, and return its :class:`~sagenb.notebook.bulk.BulkJob`.
+
+        INPUT:
+
+        - ``username`` - a string
+
+        - ``action`` - a string; ``'trash'``, ``'archive'`` or
+          ``'active'`` to change the view of the user on the
+          worksheets, ``'stop'`` to quit their processes, or
+          ``'empty_trash'`` to delete the user from the worksheets in
+          their trash (and the worksheets without users)
+
+        - ``filenames`` - a list of worksheet filenames; ignored for
+          ``'empty_trash'``
+
+        - ``worksheet_lock`` - None or a function; if given, it is
+          called with each worksheet and returns a lock held while
+          changing that worksheet
+
+        - ``threads`` - an integer (default: 4); the number of threads
+          removing the directories of deleted worksheets
+
+        - ``batch_size`` - an integer (default: 100); the number of
+          worksheets whose changes are written to the datastore together
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: V = [nb.new_worksheet_with_title_from_text(str(i), owner='sage') for i in range(3)]
+            sage: for W in V: W._notebook = nb
+            sage: J = nb.bulk_operation('sage', 'archive', ['sage/0', 'sage/1', 'sage/2'])
+            sage: J.wait(10), J.progress()['done']
+            (True, 3)
+            sage: [W.is_archived('sage') for W in V]
+            [True, True, True]
+            sage: nb.bulk_job(J.id) is J
+            True
+            sage: J = nb.bulk_operation('sage', 'trash', ['sage/1', 'sage/2', 'sage/5'])
+            sage: J.wait(10), list(J.progress()['failed'])
+            (True, ['sage/5'])
+            sage: nb.bulk_operation('sage', 'empty_trash').wait(10)
+            True
+            sage: nb.worksheet_names()
+            ['sage/0']
+
+        If the server stops before the files of the deleted worksheets
+        are removed, they are removed when the datastore is opened
+        again::
+
+            sage: W = nb.new_worksheet_with_title_from_text('3', owner='sage')
+            sage: W._notebook = nb; W.move_to_trash('sage')
+            sage: nb._Notebook__storage.remove_deleted_files = lambda deleted: None
+            sage: nb.bulk_operation('sage', 'empty_trash').wait(10)
+            True
+            sage: deleted = os.path.join(nb._dir, 'deleted')
+            sage: len(os.listdir(deleted))
+            1
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: S = FilesystemDatastore(nb._dir)
+            sage: os.listdir(deleted)
+            []
+        """
+        from .bulk import BulkJob
+        with self.__bulk_lock:
+            self.__bulk_count += 1
+            job = BulkJob(self.__bulk_count, username, action,
+                          None if action == 'empty_trash' else list(filenames))
+            self.__bulk_jobs[job.id] = job
+            # forget the oldest finished jobs
+            for i in sorted(self.__bulk_jobs)[:-20]:
+                if self.__bulk_jobs[i].is_finished():
+                    del self.__bulk_jobs[i]
+        t = threading.Thread(target=self._run_bulk_operation,
+                             args=(job, worksheet_lock, threads, batch_size),
+                             name='bulk %s' % action)
+        t.daemon = True
+        t.start()
+        return job
+
+    def bulk_job(self, job_id):
+        """
+        Return the bulk operation with given id (see
+        :meth:`bulk_operation`), or None if it is unknown.
+        """
+        return self.__bulk_jobs.get(job_id)
+
+    def _run_bulk_operation(self, job, worksheet_lock, threads, batch_size):
+        from multiprocessing.pool import ThreadPool
+        from .bulk import BULK_ACTIONS
+        S = self.__storage
+        pool = ThreadPool(threads)
+        removals = []
+        try:
+            if job.action == 'empty_trash':
+                job.set_filenames([W.filename() for W in
+                                   self.worksheet_listing(job.username, typ='trash')[1]])
+            filenames = job.filenames
+            for i in range(0, len(filenames), batch_size):
+                with S.write_batch():
+                    for filename in filenames[i:i + batch_size]:
+                        try:
+                            W = self.get_worksheet_with_filename(filename)
+                            with (worksheet_lock(W) if worksheet_lock else _no_lock):
+                                if job.action == 'stop':
+                                    W.quit()
+                                elif job.action == 'empty_trash':
+                                    W.delete_user(job.username)
+                                    if W.owner() is None:
+                                        deleted = self.delete_worksheet(filename, remove_files=False)
+                                        removals.append(pool.apply_async(S.remove_deleted_files,
+                                                                         (deleted,)))
+                                else:
+                                    getattr(W, BULK_ACTIONS[job.action])(job.username)
+                        except Exception as msg:
+                            job.step(filename, msg)
+                        else:
+                            job.step()
+            for r in removals:
+                r.wait()
+        except Exception:
+            import traceback
+            print("Error in bulk %s:\n%s" % (job.action, traceback.format_exc()))
+        finally:
+            pool.close()
+            pool.join()
+            job.finish()
 
     def worksheet_names(self):
         """
@@ -596,17 +953,62 @@ class Notebook(object):
     def set_ulimit(self, ulimit):
         self.__ulimit = ulimit
 
+    def host_scheduler(self):
+        """
+        Return the scheduler choosing the worksheet process users of
+        the server pool on which new worksheet processes are started,
+        according to the ``server_pool_policy`` server option.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.set_server_pool(['sage1@localhost', 'sage2@localhost'])
+            sage: nb.get_server()
+            'sage1@localhost'
+            sage: nb.host_scheduler()
+            least-processes scheduler: localhost (0 processes)
+        """
+        try:
+            S = self.__host_scheduler
+        except AttributeError:
+            from sagenb.interfaces import HostScheduler
+            from sagenb.interfaces.scheduler import ssh_probe
+            S = HostScheduler(probe=lambda user_at_host: ssh_probe(
+                user_at_host, connections=self.ssh_connections()))
+            self.__host_scheduler = S
+        S.set_policy(self.conf()['server_pool_policy'])
+        S.set_interval(self.conf()['server_pool_probe_interval'])
+        return S
+
+    def ssh_connections(self):
+        """
+        Return the master ssh connections to the worksheet process
+        users of the server pool, or None if the
+        ``server_pool_ssh_multiplexing`` server option is off.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.ssh_connections()
+            ssh connections: none
+            sage: nb.conf()['server_pool_ssh_multiplexing'] = False
+            sage: nb.ssh_connections() is None
+            True
+        """
+        if not self.conf()['server_pool_ssh_multiplexing']:
+            return None
+        try:
+            return self.__ssh_connections
+        except AttributeError:
+            from sagenb.interfaces import SSHConnections
+            self.__ssh_connections = SSHConnections()
+            return self.__ssh_connections
+
     def get_server(self):
         P = self.server_pool()
         if P is None or len(P) == 0:
             return None
-        try:
-            self.__server_number = (self.__server_number + 1) % len(P)
-            i = self.__server_number
-        except AttributeError:
-            self.__server_number = 0
-            i = 0
-        return P[i]
+        return self.host_scheduler().choose(P)
 
     def new_worksheet_process(self):
         """
@@ -614,6 +1016,7 @@ class Notebook(object):
         configuration of this notebook server.
         """
         from sagenb.interfaces import (WorksheetProcess_ExpectImplementation,
+                                       WorksheetProcess_FramedImplementation,
                                        WorksheetProcess_ReferenceImplementation,
                                        WorksheetProcess_RemoteExpectImplementation)
 
@@ -645,16 +1048,136 @@ class Notebook(object):
         process_limits = ProcessLimits(max_vmem=tbl['v'], max_walltime=tbl['t'],
                                        max_processes=tbl['u'])
 
+        max_output_size = self.conf()['max_output_size']
+
         server_pool = self.server_pool()
         if not server_pool or len(server_pool) == 0:
-            return WorksheetProcess_ExpectImplementation(process_limits=process_limits)
+            if self.conf()['worksheet_process_protocol'] == 'framed':
+                return WorksheetProcess_FramedImplementation(process_limits=process_limits,
+                                                             max_output_size=max_output_size)
+            return WorksheetProcess_ExpectImplementation(process_limits=process_limits,
+                                                         max_output_size=max_output_size)
         else:
-            import random
-            user_at_host = random.choice(server_pool)
+            scheduler = self.host_scheduler()
+            user_at_host = scheduler.choose(server_pool)
             python_command = os.path.join(os.environ['SAGE_ROOT'], 'sage -python')
-            return WorksheetProcess_RemoteExpectImplementation(user_at_host=user_at_host,
+            S = WorksheetProcess_RemoteExpectImplementation(user_at_host=user_at_host,
                              process_limits=process_limits,
-                             remote_python=python_command)
+                             remote_python=python_command,
+                             max_output_size=max_output_size,
+                             connections=self.ssh_connections())
+            scheduler.add(user_at_host, S)
+            return S
+
+    def worksheet_process_pool(self):
+        """
+        Return the pool of pre-started worksheet processes, or None if
+        the ``worksheet_process_pool_size`` server option is 0.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.worksheet_process_pool() is None
+            True
+        """
+        size = self.conf()['worksheet_process_pool_size']
+        try:
+            P = self.__worksheet_process_pool
+        except AttributeError:
+            if size <= 0 or USE_REFERENCE_WORKSHEET_PROCESSES:
+                return None
+            from sagenb.interfaces import WorksheetProcessPool
+            P = WorksheetProcessPool(self.new_worksheet_process, size)
+            self.__worksheet_process_pool = P
+        if P.size() != size:
+            P.set_size(max(size, 0))
+        P.start()
+        return P
+
+    def doc_worksheet_pool(self):
+        """
+        Return the pool of proxy worksheets for the live documentation
+        and the published worksheets; its size is the ``doc_pool_size``
+        server option.
+
+        The existing worksheets of the ``_sage_`` user are only read
+        when the pool is created.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: nb.doc_worksheet_pool()
+            Pool of 0 of 128 doc worksheets
+            sage: W = nb.doc_worksheet_pool().checkout(); W.owner()
+            '_sage_'
+            sage: nb.doc_worksheet_pool().checkin(W)
+
+        The proxies of a reloaded notebook are the loaded worksheets,
+        which the pages are rendered from::
+
+            sage: P = nb.doc_worksheet_pool()
+            sage: W = P.checkout(); V = P.checkout()
+            sage: P.checkin(W); P.checkin(V); nb.save()
+            sage: nb = sagenb.notebook.notebook.load_notebook(nb._dir)
+            sage: P = nb.doc_worksheet_pool(); P
+            Pool of 2 of 128 doc worksheets
+            sage: W = P.checkout(); W.set_name('Page A')
+            sage: V = P.checkout(); V.set_name('Page B')
+            sage: [nb.get_worksheet_with_filename(X.filename()).name() for X in [W, V]]
+            [u'Page A', u'Page B']
+            sage: P.checkin(W); P.checkin(V)
+        """
+        size = self.conf()['doc_pool_size']
+        try:
+            P = self.__doc_worksheet_pool
+        except AttributeError:
+            from .doc_pool import DocWorksheetPool
+            try:
+                scratch = self.__scratch_worksheet
+            except AttributeError:
+                scratch = None
+            # the proxies must be the loaded worksheets, since those
+            # are rendered and evaluated
+            proxies = []
+            for id_number in sorted(self.__storage.worksheet_index('_sage_')):
+                W = self.get_worksheet_with_filename('_sage_/%s' % id_number)
+                if W is not scratch:
+                    proxies.append(W)
+            P = DocWorksheetPool(lambda: self.create_new_worksheet('', '_sage_'),
+                                 size, proxies)
+            self.__doc_worksheet_pool = P
+        if P.size() != size:
+            P.set_size(max(size, 1))
+        return P
+
+    def get_worksheet_process(self):
+        """
+        Return a started worksheet process for a worksheet, taken from
+        the pool of pre-started processes if possible.
+        """
+        P = self.worksheet_process_pool()
+        if P is not None:
+            S = P.take()
+            if S is not None:
+                return S
+        return self.new_worksheet_process()
+
+    def release_worksheet_process(self, S):
+        """
+        Quit the worksheet process ``S``, which is no longer used by its
+        worksheet.  With a pool of pre-started processes, ``S`` is quit
+        in the background and replaced by a new process in the pool.
+        """
+        try:
+            worksheet.all_worksheet_processes.remove(S)
+        except ValueError:
+            pass
+        P = self.worksheet_process_pool()
+        if P is not None:
+            P.recycle(S)
+        else:
+            S.quit()
 
 
     def _python_command(self):
@@ -705,36 +1228,94 @@ class Notebook(object):
     ##########################################################
     # The notebook history.
     ##########################################################
-    def user_history(self, username):
-        if not hasattr(self, '_user_history'):
-            self._user_history = {}
-        if username in self._user_history:
-            return self._user_history[username]
-        history = []
-        for hunk in self.__storage.load_user_history(username):
-            hunk = unicode_str(hunk)
-            history.append(hunk)
-        self._user_history[username] = history
+    def user_history(self, username, maxlen=None):
+        """
+        Return the last entries of the history of the given user.
+
+        Only the needed part of the history is read from disk.
+
+        INPUT:
+
+        - ``username`` - a string
+
+        - ``maxlen`` - None or an integer (default: None); the number
+          of entries to return, by default the ``max_history_length``
+          of the user
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: for i in range(5): nb.add_to_user_history(u'%s+%s' % (i, i), 'sage')
+            sage: nb.save()
+            sage: nb.add_to_user_history(u'2^5', 'sage')
+            sage: nb.user_history('sage', 3)
+            [u'3+3', u'4+4', u'2^5']
+            sage: len(nb.user_history('sage'))
+            6
+        """
+        if maxlen is None:
+            maxlen = self.user_manager().user_conf(username)['max_history_length']
+        if maxlen <= 0:
+            return []
+        with self.__history_save_lock:
+            with self.__history_lock:
+                history = self._pending_history.get(username, [])[-maxlen:]
+            if len(history) < maxlen:
+                saved = self.__storage.load_user_history(username, maxlen - len(history))
+                history = [unicode_str(hunk) for hunk in saved] + history
         return history
 
     def create_new_worksheet_from_history(self, name, username, maxlen=None):
         W = self.create_new_worksheet(name, username)
-        W.edit_save('Log Worksheet\n' + self.user_history_text(username, maxlen=None))
+        W.edit_save('Log Worksheet\n' + self.user_history_text(username, maxlen=maxlen))
         return W
 
     def user_history_text(self, username, maxlen=None):
-        history = self.user_history(username)
-        if maxlen:
-            history = history[-maxlen:]
+        history = self.user_history(username, maxlen)
         return '\n\n'.join([hunk.strip() for hunk in history])
 
     def add_to_user_history(self, entry, username):
-        history = self.user_history(username)
-        history.append(entry)
+        """
+        Add an entry to the history of the given user.  It is written
+        to disk by the next :meth:`save`, which only appends the new
+        entries.
+        """
         maxlen = self.user_manager().user_conf(username)['max_history_length']
-        while len(history) > maxlen:
-            del history[0]
+        with self.__history_lock:
+            pending = self._pending_history.setdefault(username, [])
+            pending.append(entry)
+            # older entries would never be shown anyway
+            del pending[:len(pending) - maxlen]
+
+    def _save_user_history(self):
+        """
+        Append the new history entries to disk and let the datastore
+        drop the entries beyond ``max_history_length``.
 
+        The history lock is only held to take the pending entries, so
+        that adding entries never waits for the disk; inside a write
+        batch, the histories are synced to disk when it ends.
+        """
+        S = self.__storage
+        with self.__history_save_lock:
+            with self.__history_lock:
+                pending, self._pending_history = self._pending_history, {}
+            usernames = list(pending)
+            try:
+                for username in usernames:
+                    S.append_user_history(username, pending[username])
+                    del pending[username]
+            except:
+                # keep the entries not written yet for the next save
+                with self.__history_lock:
+                    for username, entries in pending.items():
+                        entries.extend(self._pending_history.get(username, []))
+                        self._pending_history[username] = entries
+                raise
+        for username in usernames:
+            maxlen = self.user_manager().user_conf(username)['max_history_length']
+            S.compact_user_history(username, maxlen)
 
     ##########################################################
     # Importing and exporting worksheets to files
@@ -759,6 +1340,74 @@ class Notebook(object):
         id_number = W.id_number()
         S.export_worksheet(username, id_number, output_filename, title=title)
 
+    def export_worksheets(self, worksheet_filenames, threads=4):
+        """
+        Export several worksheets to sws files, in parallel.
+
+        Return an iterator over pairs ``(worksheet, sws_filename)``, in
+        the order of ``worksheet_filenames``.  Each sws file is a
+        temporary file, which is deleted when the iteration goes on,
+        so it must be used at once.  While a file is being used, up to
+        ``2*threads`` of the next worksheets are being exported by a
+        pool of ``threads`` threads.  A worksheet that cannot be
+        exported is skipped.
+
+        INPUT:
+
+            - ``worksheet_filenames`` - a list of strings, e.g.,
+              ['username/id_number']
+
+            - ``threads`` - integer (default: 4)
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: for i in range(3): W = nb.create_new_worksheet('W%s' % i, 'sage')
+            sage: [(W.name(), os.path.getsize(f) > 0)
+            ....:  for W, f in nb.export_worksheets(['sage/2', 'sage/0', 'sage/1'], threads=2)]
+            [(u'W2', True), (u'W0', True), (u'W1', True)]
+        """
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        directory = tmp_dir()
+
+        def export(filename):
+            sws_filename = os.path.join(directory, '%s.sws' % filename.replace('/', '_'))
+            self.export_worksheet(filename, sws_filename)
+            return sws_filename
+
+        pool = ThreadPool(threads)
+        pending = deque()
+        filenames = iter(worksheet_filenames)
+
+        def submit():
+            for filename in filenames:
+                pending.append((filename, pool.apply_async(export, (filename,))))
+                if len(pending) >= 2 * threads:
+                    break
+
+        try:
+            submit()
+            while pending:
+                filename, result = pending.popleft()
+                try:
+                    sws_filename = result.get()
+                except Exception:
+                    import traceback
+                    print("Warning: problem exporting %s: %s" % (filename, traceback.format_exc()))
+                    continue
+                finally:
+                    submit()
+                try:
+                    yield self.get_worksheet_with_filename(filename), sws_filename
+                finally:
+                    os.unlink(sws_filename)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(directory, ignore_errors=True)
+
     def worksheet(self, username, id_number=None):
         """
         Create a new worksheet with given id_number belonging to the
@@ -1268,12 +1917,82 @@ class Notebook(object):
             W.set_not_computing()
 
     def quit(self):
+        try:
+            self.__supervisor.stop()
+        except AttributeError:
+            pass
         for W in list(self.__worksheets.values()):
             W.quit()
+        try:
+            self.__worksheet_process_pool.quit()
+        except AttributeError:
+            pass
+        try:
+            self.__ssh_connections.close_all()
+        except AttributeError:
+            pass
 
     def update_worksheet_processes(self):
         worksheet.update_worksheets()
 
+    def supervisor(self):
+        """
+        Return the supervisor quitting the idle worksheet processes and
+        those exceeding the wall time limit in the background; see
+        :mod:`sagenb.notebook.supervisor`.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.supervisor()
+            Supervisor of 0 deadlines
+        """
+        try:
+            return self.__supervisor
+        except AttributeError:
+            from .supervisor import Supervisor
+            self.__supervisor = Supervisor(self)
+            return self.__supervisor
+
+    def start_supervisor(self, worksheet_lock=None):
+        """
+        Start the thread of the supervisor of the worksheet processes.
+
+        INPUT:
+
+        - ``worksheet_lock`` -- None or a function; if given, it is
+          called with each worksheet and returns a lock held while
+          quitting its process
+        """
+        S = self.supervisor()
+        S._worksheet_lock = worksheet_lock
+        S.start()
+
+    def supervise_worksheet(self, W):
+        """
+        Schedule the deadlines of the compute process of the worksheet
+        ``W`` with the supervisor, if it is running.
+        """
+        try:
+            S = self.__supervisor
+        except AttributeError:
+            return
+        if S.is_alive():
+            S.schedule_worksheet(W)
+
+    def loaded_worksheets(self):
+        """
+        Return the list of the loaded worksheets.
+        """
+        return list(self.__worksheets.values())
+
+    def loaded_worksheet(self, filename):
+        """
+        Return the worksheet with given filename if it is loaded, and
+        None otherwise.
+        """
+        return dict.get(self.__worksheets, filename)
+
     def quit_idle_worksheet_processes(self):
         timeout = self.conf()['idle_timeout']
         doc_timeout = self.conf()['doc_timeout']
@@ -1285,6 +2004,61 @@ class Notebook(object):
                 else:
                     W.quit_if_idle(timeout)
 
+    def evict_idle_worksheets(self, pub_timeout=None, worksheet_lock=None):
+        """
+        Unload the published worksheets that were not viewed in the
+        last ``pub_timeout`` seconds (by default, the ``pub_timeout``
+        server option), and the other worksheets that were not used in
+        the last ``worksheet_timeout`` seconds.  Then unload the least
+        recently used worksheets while more than
+        ``max_loaded_worksheets`` are loaded or their total size
+        exceeds ``max_loaded_worksheets_size``.
+
+        The worksheets are saved first, and loaded again when needed.
+        Worksheets with a running compute process are never unloaded.
+
+        This is called by the supervisor and by the background saver.
+
+        INPUT:
+
+        - ``worksheet_lock`` -- None or a function; if given, it is
+          called with each worksheet and returns a lock held while
+          unloading it (a worksheet whose lock is held stays loaded)
+        """
+        conf = self.conf()
+        if pub_timeout is None:
+            pub_timeout = conf['pub_timeout']
+        D = self.__worksheets
+        idle = D.idle(pub_timeout, prefix='pub/')
+        if conf['worksheet_timeout'] > 0:
+            idle += [f for f in D.idle(conf['worksheet_timeout'])
+                     if not f.startswith('pub/')]
+        for filename in idle:
+            try:
+                D.evict(filename, worksheet_lock)
+            except Exception:
+                import traceback
+                print("Warning: problem unloading %s: %s" % (filename, traceback.format_exc()))
+        D.shrink(max_count=conf['max_loaded_worksheets'],
+                 max_size=conf['max_loaded_worksheets_size'],
+                 worksheet_lock=worksheet_lock)
+
+    def worksheet_cache_stats(self):
+        """
+        Return a dictionary with statistics about the loaded
+        worksheets: the numbers of ``hits`` (accesses to a loaded
+        worksheet), ``misses`` (worksheets loaded from the datastore)
+        and ``evictions`` (worksheets unloaded), the number of
+        ``loaded`` worksheets and their total approximate ``size``.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: sorted(nb.worksheet_cache_stats().items())
+            [('evictions', 0), ('hits', 0), ('loaded', 0), ('misses', 0), ('size', 0)]
+        """
+        return self.__worksheets.stats()
+
     def quit_worksheet(self, W):
         try:
             del self.__worksheets[W.filename()]
@@ -1298,12 +2072,33 @@ class Notebook(object):
         W = self.users_worksheets('pub')
 
         if search:
-            W = [x for x in W if x.satisfies_search(search)]
+            W = self.search_worksheets(W, search)
 
         sort_worksheet_list(W, sort, reverse)  # changed W in place
         return W
 
     def worksheet_list_for_user(self, user, typ="active", sort='last_edited', reverse=False, search=None):
+        """
+        Return the list of worksheets of type ``typ`` that ``user``
+        can see.
+
+        The worksheets are built from the worksheet metadata indexes
+        of the datastore, so listing does not read the configuration
+        of each worksheet from disk.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.load_notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.new_worksheet_with_title_from_text('Sage', owner='sage')
+            sage: [X.filename() for X in nb.worksheet_list_for_user('sage')]
+            ['sage/0']
+            sage: W.move_to_trash('sage'); nb.save_worksheet(W)
+            sage: nb.worksheet_list_for_user('sage')
+            []
+            sage: [X.filename() for X in nb.worksheet_list_for_user('sage', typ='trash')]
+            ['sage/0']
+        """
         X = self.get_worksheets_with_viewer(user)
         if typ == "trash":
             W = [x for x in X if x.is_trashed(user)]
@@ -1312,10 +2107,225 @@ class Notebook(object):
         else: # typ must be archived
             W = [x for x in X if not (x.is_trashed(user) or x.is_active(user))]
         if search:
-            W = [x for x in W if x.satisfies_search(search)]
+            W = self.search_worksheets(W, search)
         sort_worksheet_list(W, sort, reverse)  # changed W in place
         return W
 
+    def worksheet_listing(self, username, typ='active', sort='last_edited',
+                          reverse=False, search=None, pub=False,
+                          offset=0, limit=None):
+        """
+        Return one page of the worksheet listing of a user.
+
+        The listing contains the same worksheets, in the same order, as
+        :meth:`worksheet_list_for_user` (or
+        :meth:`worksheet_list_for_public` if ``pub`` is True), but it is
+        merged lazily from the orders the datastore keeps sorted for
+        each user and view (see ``worksheet_listing_order``).  So only
+        the loaded worksheets changed since they were saved and the
+        shared worksheets are sorted, only the entries up to the end of
+        the page are looked at (unless there is a ``search``), and only
+        the worksheets on the requested page are reconstructed.
+
+        INPUT:
+
+        - ``username`` - a string
+
+        - ``typ``, ``sort``, ``reverse``, ``search`` - as for
+          :meth:`worksheet_list_for_user`
+
+        - ``pub`` - a boolean (default: False); whether to list the
+          published worksheets
+
+        - ``offset`` - an integer (default: 0); the position of the
+          first worksheet of the page in the listing
+
+        - ``limit`` - None or an integer (default: None); the maximal
+          number of worksheets on the page
+
+        OUTPUT:
+
+        - a pair ``(total, worksheets)``: the number of worksheets in
+          the whole listing and the list of worksheets on the page
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.load_notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: for name in ['b', 'C', 'a']: W = nb.new_worksheet_with_title_from_text(name, owner='sage')
+            sage: total, page = nb.worksheet_listing('sage', sort='name', offset=1, limit=1)
+            sage: total, [X.name() for X in page]
+            (3, [u'b'])
+            sage: W.move_to_trash('sage')
+            sage: total, page = nb.worksheet_listing('sage', sort='name', reverse=True)
+            sage: total, [X.name() for X in page]
+            (2, [u'C', u'b'])
+            sage: nb.worksheet_listing('sage', sort='size')
+            Traceback (most recent call last):
+            ...
+            ValueError: invalid sort key 'size'
+        """
+        from .worksheet import listing_view, LISTING_SORTS
+        try:
+            sort_key, flip = LISTING_SORTS[sort]
+        except KeyError:
+            raise ValueError("invalid sort key '%s'" % sort)
+        descending = (reverse != flip)
+        S = self.__storage
+        admin = not pub and self._user_manager.user_is_admin(username)
+        if pub:
+            owners = ['pub']
+            viewer = view = None
+            listed = lambda row: True
+        else:
+            if admin:
+                owners = [x for x in self._user_manager.usernames()
+                          if x not in ['_sage_', 'pub']]
+            else:
+                owners = [username]
+            viewer = username
+            view = {'trash': worksheet.TRASH, 'active': worksheet.ACTIVE}.get(typ, worksheet.ARCHIVED)
+            listed = lambda row: listing_view(row, username) == view
+
+        # Only the loaded worksheets that changed since they were
+        # saved have listing rows that differ from the datastore.
+        changed = self.__worksheets.changed_listing_rows()
+
+        # The datastore keeps the worksheets of each owner in this view
+        # sorted, so a page is merged lazily from these orders, and
+        # only the entries up to the end of the page are looked at.
+        orders = []
+        total = 0
+        for owner in owners:
+            order = S.worksheet_listing_order(owner, sort, viewer, view, copy=False)
+            total += len(order)
+            orders.append((owner, order))
+        owners = set(owners)
+        # the worksheets of other users shared with this user
+        others = set()
+        if not pub and not admin:
+            for owner, id_number in self._user_manager.user(username).viewable_worksheets():
+                if owner in owners:
+                    continue
+                row = S.worksheet_listing_rows(owner, copy=False).get(id_number)
+                if row is not None and username in row['viewers']:
+                    others.add((owner, id_number))
+        extra = []
+        for (owner, id_number), row in iteritems(changed):
+            if owner in owners:
+                # it is in the order of the owner with its saved row
+                saved = S.worksheet_listing_rows(owner, copy=False).get(id_number)
+                if saved is not None and listed(saved):
+                    total -= 1
+            elif (owner, id_number) in others:
+                others.discard((owner, id_number))
+            else:
+                continue
+            if listed(row):
+                extra.append((sort_key(row), owner, id_number))
+        for owner, id_number in others:
+            row = S.worksheet_listing_rows(owner, copy=False)[id_number]
+            if listed(row):
+                extra.append((sort_key(row), owner, id_number))
+        extra.sort(reverse=descending)
+        total += len(extra)
+
+        def stream(owner, order):
+            # The order is not copied; while a worksheet is saved it
+            # may change under us, which at worst shifts this page.
+            for key, id_number in (reversed(order) if descending else order):
+                if (owner, id_number) not in changed:
+                    yield (key, owner, id_number)
+        streams = [stream(owner, order) for owner, order in orders if order]
+        if extra:
+            streams.append(extra)
+        entries = _merge_sorted(streams, descending)
+        if search:
+            keys = [(owner, id_number) for key, owner, id_number in entries]
+            candidates = S.search_worksheets(search)
+            if candidates is not None:
+                keys = [key for key in keys if '%s/%s' % key in candidates]
+            keys = [(W.owner(), W.id_number()) for W in self._listing_worksheets(keys)
+                    if W.satisfies_search(search)]
+            total = len(keys)
+            page = keys[offset:] if limit is None else keys[offset:offset + limit]
+        else:
+            stop = None if limit is None else offset + limit
+            page = [(owner, id_number) for key, owner, id_number
+                    in itertools.islice(entries, offset, stop)]
+        return total, self._listing_worksheets(page)
+
+    def _listing_worksheets(self, keys):
+        """
+        Return the worksheets with the given ``(owner, id_number)``
+        pairs, in the same order, using the loaded ones if possible.
+        """
+        ids = {}
+        for owner, id_number in keys:
+            ids.setdefault(owner, []).append(id_number)
+        worksheets = {}
+        for owner, id_numbers in iteritems(ids):
+            for W in self.__storage.worksheets(owner, id_numbers):
+                worksheets[(owner, W.id_number())] = W
+        v = []
+        for owner, id_number in keys:
+            filename = '%s/%s' % (owner, id_number)
+            if filename in self.__worksheets:
+                v.append(self.__worksheets[filename])
+            elif (owner, id_number) in worksheets:
+                v.append(worksheets[(owner, id_number)])
+        return v
+
+    def search_worksheets(self, worksheets, search):
+        r"""
+        Return the worksheets in the list ``worksheets`` that satisfy
+        the given search.
+
+        The full text search index of the datastore is used to narrow
+        down the worksheets which actually have to be searched.
+
+        INPUT:
+
+        - ``worksheets`` - a list of worksheets
+
+        - ``search`` - a string; see :meth:`Worksheet.satisfies_search`
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.load_notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.new_worksheet_with_title_from_text('Modular Forms', owner='sage')
+            sage: V = nb.new_worksheet_with_title_from_text('Elliptic Curves', owner='sage')
+            sage: V.edit_save('{{{\nModularSymbols(11)\n}}}'); nb.save_worksheet(V)
+            sage: [X.name() for X in nb.search_worksheets([W, V], 'modular')]
+            [u'Modular Forms', u'Elliptic Curves']
+            sage: [X.name() for X in nb.search_worksheets([W, V], 'forms')]
+            [u'Modular Forms']
+
+        Both the index and the final check use the saved text, so
+        unsaved changes are found once the worksheet is saved::
+
+            sage: V.edit_save('{{{\nEllipticCurve([0,1])\n}}}')
+            sage: [X.name() for X in nb.search_worksheets([W, V], 'modular')]
+            [u'Modular Forms', u'Elliptic Curves']
+            sage: nb.save_worksheet(V)
+            sage: [X.name() for X in nb.search_worksheets([W, V], 'modular')]
+            [u'Modular Forms']
+            sage: [X.name() for X in nb.search_worksheets([W, V], 'ellipticcurve')]
+            [u'Elliptic Curves']
+        """
+        candidates = self.__storage.search_worksheets(search)
+        if candidates is not None:
+            worksheets = [x for x in worksheets if x.filename() in candidates]
+        return [x for x in worksheets if x.satisfies_search(search)]
+
+    def index_worksheet(self, W):
+        """
+        Update the full text search index with the saved contents of
+        the worksheet ``W``.
+        """
+        self.__storage.index_worksheet(W)
+
     ##########################################################
     # Revision history for a worksheet
     ##########################################################
@@ -1372,11 +2382,10 @@ class Notebook(object):
 
         - a string - the revision rendered as HTML
         """
-        t = time.time() - float(rev[:-4])
+        t = time.time() - ws.snapshots().revision(rev)['time']
         time_ago = prettify_time_ago(t)
 
-        filename = ws.get_snapshot_text_filename(rev)
-        txt = bz2.decompress(open(filename).read())
+        txt = ws.snapshot_text(rev)
         W = self.scratch_worksheet()
         W.set_name('Revision of ' + ws.name())
         W.delete_cells_directory()
@@ -1485,7 +2494,7 @@ class Notebook(object):
         We should only call this if the user is admin!
         """
         all_worksheets = []
-        for username in self._user_manager.users():
+        for username in self._user_manager.usernames():
             if username in ['_sage_', 'pub']:
                 continue
             for w in self.users_worksheets(username):
@@ -1521,21 +2530,107 @@ class Notebook(object):
     # Saving the whole notebook
     ###########################################################
 
-    def save(self):
+    def save(self, lock=None, worksheet_lock=None):
         """
-        Save this notebook server to disk.
+        Save the changes to this notebook server to disk.
+
+        Only the objects that changed since they were last saved are
+        written, and the files are synced to disk together at the end.
+
+        INPUT:
+
+        - ``lock`` -- None or a lock; held while saving the server
+          configuration and the users
+
+        - ``worksheet_lock`` -- None or a function; if given, it is
+          called with each worksheet and returns a lock held while
+          saving that worksheet
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.create_new_worksheet('Test', 'sage')
+            sage: nb.add_to_user_history('2+3', 'sage')
+            sage: nb.save()
+            sage: nb._Notebook__storage.load_user_history('sage')
+            [u'2+3']
+            sage: os.remove(os.path.join(nb._dir, 'users', 'index.pickle'))
+            sage: nb.save()     # nothing changed
+            sage: os.path.exists(os.path.join(nb._dir, 'users', 'index.pickle'))
+            False
         """
         S = self.__storage
-        S.save_users(self.user_manager().users())
-        S.save_server_conf(self.conf())
-        self._user_manager.save(S)
-        # Save the non-doc-browser worksheets.
-        for n, W in self.__worksheets.items():
-            if not n.startswith('doc_browser'):
-                S.save_worksheet(W)
-        if hasattr(self, '_user_history'):
-            for username, H in iteritems(self._user_history):
-                S.save_user_history(username, H)
+        with self.__save_lock:
+            with S.write_batch():
+                with (lock or _no_lock):
+                    U = self.user_manager()
+                    deleted = U.deleted_usernames()
+                    S.save_users(U.loaded_users(), deleted)
+                    U.forget_deleted(deleted)
+                    S.save_server_conf(self.conf())
+                    self._user_manager.save(S)
+                self._save_user_history()
+                # Save the non-doc-browser worksheets.  A worksheet
+                # whose lock is held (e.g., by a request) is saved the
+                # next time: waiting for it while holding the save lock
+                # could deadlock.
+                for n, W in list(self.__worksheets.items()):
+                    if n.startswith('doc_browser'):
+                        continue
+                    L = worksheet_lock(W) if worksheet_lock else _no_lock
+                    if not L.acquire(False):
+                        continue
+                    try:
+                        S.save_worksheet(W)
+                    finally:
+                        L.release()
+                S.save_search_index()
+
+    def request_save(self):
+        """
+        Have this notebook saved soon.
+
+        If a thread saves this notebook in the background (see
+        :meth:`wait_for_save_request`), it is woken up to save it now;
+        otherwise it is saved right away.  Unlike :meth:`save`, this
+        may be called while holding the lock of a worksheet.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: nb.add_to_user_history('2+3', 'sage')
+            sage: nb.request_save()
+            sage: nb._Notebook__storage.load_user_history('sage')
+            [u'2+3']
+        """
+        if self.__saver_waiting:
+            self.__save_requested.set()
+        else:
+            self.save()
+
+    def wait_for_save_request(self, timeout):
+        """
+        Wait at most ``timeout`` seconds for a call to
+        :meth:`request_save`, and return True if there was one.
+
+        This is called by the thread saving this notebook in the
+        background, between two saves.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.wait_for_save_request(0.01)
+            False
+            sage: nb.request_save()
+            sage: nb.wait_for_save_request(10)
+            True
+        """
+        self.__saver_waiting = True
+        requested = self.__save_requested.wait(timeout)
+        self.__save_requested.clear()
+        return bool(requested)
 
     def save_worksheet(self, W, conf_only=False):
         self.__storage.save_worksheet(W, conf_only=conf_only)
@@ -1772,7 +2867,7 @@ class Notebook(object):
             # this uses code from get_all_worksheets()
             user_manager = self.user_manager()
             num_users=0
-            for username in self._user_manager.users():
+            for username in self._user_manager.usernames():
                 num_users+=1
                 if num_users%1000==0:
                     print('Upgraded %d users' % num_users)
@@ -2011,11 +3106,10 @@ def migrate_old_notebook_v1(dir):
     new_nb._Notebook__worksheets = worksheets
 
     # Migrating history
-    new_nb._user_history = {}
     for username in old_nb.user_manager().users().keys():
         history_file = os.path.join(dir, 'worksheets', username, 'history.sobj')
         if os.path.exists(history_file):
-            new_nb._user_history[username] = pickle.loads(open(history_file).read())
+            new_nb._pending_history[username] = pickle.loads(open(history_file).read())
 
     # Save our newly migrated notebook to disk
     new_nb.save()
@@ -2046,6 +3140,39 @@ def make_path_relative(dir):
 ##########################################################
 
 
+class _Descending(object):
+    # reverses the order of an entry, for _merge_sorted
+    __slots__ = ['entry']
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __lt__(self, other):
+        return other.entry < self.entry
+
+
+def _merge_sorted(iterables, descending=False):
+    """
+    Return an iterator over the items of the ``iterables``, merged in
+    increasing order (or in decreasing order if ``descending``).  Each
+    iterable must yield its items in that order.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.notebook import _merge_sorted
+        sage: list(_merge_sorted([[1, 4], [2, 3, 5], []]))
+        [1, 2, 3, 4, 5]
+        sage: list(_merge_sorted([iter([4, 1]), [5, 3, 2]], descending=True))
+        [5, 4, 3, 2, 1]
+    """
+    if len(iterables) <= 1:
+        return iter(iterables[0] if iterables else [])
+    if not descending:
+        return heapq.merge(*iterables)
+    return (d.entry for d in
+            heapq.merge(*[(_Descending(e) for e in x) for x in iterables]))
+
+
 def sort_worksheet_list(v, sort, reverse):
     """
     Sort a given list on a given key, in a given order.
@@ -165,10 +165,10 @@ class NotebookObject:
        available to each worksheet processes to 500 MB.  See help on
        the ``accounts`` option above.
 
-       Be sure that ``sage_notebook.sagenb/users.pickle`` and the
+       Be sure that ``sage_notebook.sagenb/users`` and the
        contents of ``sage_notebook.sagenb/backups`` are chmod
        ``og-rwx``, i.e., only readable by the notebook process, since
-       otherwise any user can read ``users.pickle``, which contains
+       otherwise any user can read the files in ``users``, which contain
        user email addresses and account information (passwords are
        stored hashed, so fewer worries there). You will need to use
        the ``directory`` option to accomplish this.
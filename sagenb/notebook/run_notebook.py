@@ -115,6 +115,9 @@ from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 
 %(open_page)s
+# The WSGI container serves one request at a time, so cell updates
+# must not wait for output.
+flask_app.config['MAX_LONG_POLLS'] = 0
 wsgi_app = WSGIContainer(flask_app)
 http_server = HTTPServer(wsgi_app)
 http_server.listen(%(port)s)
@@ -134,6 +137,8 @@ IOLoop.instance().start()
 class NotebookRunuWSGI(NotebookRun):
     name="uWSGI"
     uWSGI_NOTEBOOK_CONFIG  = """
+# Leave at least two of the four threads for other requests.
+flask_app.config['MAX_LONG_POLLS'] = 2
 import atexit
 from functools import partial
 atexit.register(partial(save_notebook,flask_base.notebook))
@@ -263,6 +268,9 @@ signal.signal(signal.SIGINT, my_sigint)
 
 from twisted.web import server
 from twisted.web.wsgi import WSGIResource
+# Cell updates may be held while waiting for output, so make room for
+# them in the thread pool.
+reactor.suggestThreadPoolSize(10 + flask_base.notebook.conf()['max_long_polls'])
 resource = WSGIResource(reactor, reactor.getThreadPool(), flask_app)
 
 class QuietSite(server.Site):
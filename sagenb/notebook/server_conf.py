@@ -16,15 +16,32 @@ defaults = {'word_wrap_cols':72,
 
             'idle_timeout': 0,        # timeout in seconds for worksheets
             'doc_timeout': 600,         # timeout in seconds for live docs
+            'pub_timeout': 3600,        # seconds published worksheets stay loaded
+            'worksheet_timeout': 86400, # seconds other worksheets stay loaded
+            'max_loaded_worksheets': 1000,
+            'max_loaded_worksheets_size': 256*1024*1024,  # characters
             'idle_check_interval':360,
 
             'save_interval':360,        # seconds
+            'max_snapshots':30,         # revisions kept of each worksheet
 
             'doc_pool_size':128,
 
+            'cell_update_timeout':10,   # seconds
+            'max_long_polls':8,
+            'max_output_size':1048576,  # bytes
+            'worksheet_process_pool_size':0,
+            'worksheet_process_protocol':'expect',
+
             'pub_interact':False,
 
             'server_pool':[],
+            'server_pool_policy':'least-processes',
+            'server_pool_probe_interval':30,  # seconds
+            'server_pool_ssh_multiplexing':True,
+
+            'sendfile_header':'none',
+            'sendfile_prefix':'/_sagenb_home',
 
             'system':'sage',
 
@@ -84,6 +101,30 @@ defaults_descriptions = {
         TYPE : T_INTEGER,
         },
 
+    'pub_timeout': {
+        DESC : _('Time after which an unused published worksheet is unloaded (seconds)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'worksheet_timeout': {
+        DESC : _('Time after which an unused worksheet is unloaded (seconds, 0 to never unload it)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'max_loaded_worksheets': {
+        DESC : _('Maximum number of worksheets kept in memory (0 for no limit)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'max_loaded_worksheets_size': {
+        DESC : _('Maximum total size of the worksheets kept in memory (characters, 0 for no limit)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
     'idle_check_interval': {
         DESC : _('Idle check interval (seconds)'),
         GROUP : G_SERVER,
@@ -96,12 +137,49 @@ defaults_descriptions = {
         TYPE : T_INTEGER,
         },
 
+    'max_snapshots': {
+        DESC : _('Number of revisions kept of each worksheet (0 to keep all)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
     'doc_pool_size': {
         DESC : _('Doc worksheet pool size'),
         GROUP : G_SERVER,
         TYPE : T_INTEGER,
         },
 
+    'cell_update_timeout': {
+        DESC : _('Maximum time to hold a cell update request until new output arrives (seconds, 0 to disable)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'max_long_polls': {
+        DESC : _('Maximum number of cell update requests held at the same time'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'max_output_size': {
+        DESC : _('Maximum output of a computation kept by the server (bytes, 0 for no limit)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'worksheet_process_pool_size': {
+        DESC : _('Number of compute processes started in advance for new worksheet sessions'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'worksheet_process_protocol': {
+        DESC : _('How the server talks to local compute processes'),
+        GROUP : G_SERVER,
+        TYPE : T_CHOICE,
+        CHOICES : ['expect', 'framed'],
+        },
+
     'pub_interact': {
         DESC : _('Enable published interacts (EXPERIMENTAL; USE AT YOUR OWN RISK)'),
         GROUP : G_SERVER,
@@ -114,6 +192,38 @@ defaults_descriptions = {
         TYPE : T_LIST,
         },
 
+    'server_pool_policy': {
+        DESC : _('How the worksheet process user of a new worksheet process is chosen'),
+        GROUP : G_SERVER,
+        TYPE : T_CHOICE,
+        CHOICES : ['least-processes', 'least-loaded', 'memory', 'round-robin', 'random'],
+        },
+
+    'server_pool_probe_interval': {
+        DESC : _('Interval between probes of the load and memory of the worksheet process hosts (seconds)'),
+        GROUP : G_SERVER,
+        TYPE : T_INTEGER,
+        },
+
+    'server_pool_ssh_multiplexing': {
+        DESC : _('Keep an ssh connection open to each worksheet process user and share it'),
+        GROUP : G_SERVER,
+        TYPE : T_BOOL,
+        },
+
+    'sendfile_header': {
+        DESC : _('Header with which a front-end web server sends cell and data files'),
+        GROUP : G_SERVER,
+        TYPE : T_CHOICE,
+        CHOICES : [N_('none'), 'X-Sendfile', 'X-Accel-Redirect'],
+        },
+
+    'sendfile_prefix': {
+        DESC : _('Internal location of the web server serving the home directory (X-Accel-Redirect)'),
+        GROUP : G_SERVER,
+        TYPE : T_STRING,
+        },
+
     'system': {
         DESC : _('Default system'),
         GROUP : G_SERVER,
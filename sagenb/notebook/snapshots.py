@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*
+r"""
+Revision history of a worksheet
+
+Each snapshot of a worksheet is a revision of its text.  A
+:class:`SnapshotStore` keeps the revisions in the ``snapshots``
+directory of the worksheet as reverse deltas: the newest revision is
+stored in full (bz2 compressed, as snapshots always were), and each
+older revision as a compressed delta against the next newer one.
+Most snapshots only change a few cells, so a delta is much smaller
+than the worksheet.  Since older revisions depend on newer ones and
+not the other way round, the oldest revisions can simply be removed.
+Every ``FULL_INTERVAL`` revisions one is kept in full, so that reading
+an old revision applies a bounded number of deltas.
+
+The time, author and sizes of the revisions are kept in the manifest
+``manifest.json``, so that the revisions can be listed without looking
+at the directory.  A snapshot directory from before the manifest is
+converted when it is first opened.
+
+EXAMPLES::
+
+    sage: from sagenb.notebook.snapshots import SnapshotStore
+    sage: S = SnapshotStore(tmp_dir())
+    sage: a = S.save(u'{{{\n2+3\n}}}\n', 'admin', t=1000)
+    sage: b = S.save(u'{{{\n2+3\n}}}\n{{{\n4+5\n}}}\n', 'sage', t=2000)
+    sage: S
+    Snapshot store of 2 revisions
+    sage: [(r['key'], r['user'], r['delta']) for r in S.revisions()]
+    [('1000', 'admin', True), ('2000', 'sage', False)]
+    sage: S.text(a)
+    u'{{{\n2+3\n}}}\n'
+    sage: S.save(S.text(b), 'sage') is None
+    True
+"""
+
+import bisect
+import bz2
+import json
+import os
+import threading
+import time
+import zlib
+from hashlib import md5
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# at most this many deltas are applied to read a revision
+FULL_INTERVAL = 16
+
+
+def make_delta(base, text):
+    r"""
+    Return a delta that turns the string ``base`` into ``text``.
+
+    The delta is a list whose items are either pairs ``[i, j]``,
+    standing for the lines ``i`` to ``j`` of ``base``, or strings.
+
+    Snapshots are taken while the worksheet is locked, so this has to
+    be fast even for huge worksheets: after removing the common head
+    and tail, the lines are matched only around the lines which occur
+    exactly once in both (as in "patience diff"), which takes
+    `O(n \log n)` time instead of the quadratic time of
+    :class:`difflib.SequenceMatcher`.  The delta need not be minimal.
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.snapshots import make_delta, apply_delta
+        sage: d = make_delta(u'a\nb\nc\n', u'a\nx\nc\n'); d
+        [[0, 1], u'x\n', [2, 3]]
+        sage: apply_delta(u'a\nb\nc\n', d)
+        u'a\nx\nc\n'
+        sage: a = u''.join(u'{{{\n%s\n}}}\n' % i for i in range(5000))
+        sage: b = a.replace(u'\n17\n', u'\n17\n18\n').replace(u'{{{\n4000\n}}}\n', u'')
+        sage: d = make_delta(a, b); d
+        [[0, 53], u'18\n', [53, 11999], [12002, 15000]]
+        sage: apply_delta(a, d) == b
+        True
+    """
+    a = base.splitlines(True)
+    b = text.splitlines(True)
+    n, m = len(a), len(b)
+
+    # common head and tail
+    lo = 0
+    while lo < n and lo < m and a[lo] == b[lo]:
+        lo += 1
+    hi_a, hi_b = n, m
+    while hi_a > lo and hi_b > lo and a[hi_a - 1] == b[hi_b - 1]:
+        hi_a -= 1
+        hi_b -= 1
+
+    # the lines occurring exactly once in what is left of both
+    count = {}
+    for i in range(lo, hi_a):
+        c = count.setdefault(a[i], [0, 0, i])
+        c[0] += 1
+    for j in range(lo, hi_b):
+        c = count.get(b[j])
+        if c is not None:
+            c[1] += 1
+    pairs = [(count[b[j]][2], j) for j in range(lo, hi_b)
+             if count.get(b[j], (0, 0))[:2] == [1, 1]]
+
+    # longest chain of them in the same order in both (patience sort)
+    tails = []
+    tail_pairs = []
+    back = {}
+    for pair in pairs:
+        k = bisect.bisect_left(tails, pair[0])
+        back[pair] = tail_pairs[k - 1] if k else None
+        if k == len(tails):
+            tails.append(pair[0])
+            tail_pairs.append(pair)
+        else:
+            tails[k] = pair[0]
+            tail_pairs[k] = pair
+    anchors = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        anchors.append(pair)
+        pair = back[pair]
+    anchors.reverse()
+
+    delta = []
+
+    def copy(i, j):
+        if i < j:
+            if delta and isinstance(delta[-1], list) and delta[-1][1] == i:
+                delta[-1][1] = j
+            else:
+                delta.append([i, j])
+
+    def insert(j1, j2):
+        if j1 < j2:
+            delta.append(u''.join(b[j1:j2]))
+
+    copy(0, lo)
+    i0, j0 = lo, lo
+    for i, j in anchors:
+        if i < i0:
+            # already copied along with a previous anchor
+            continue
+        # grow the match around the anchor
+        while i > i0 and j > j0 and a[i - 1] == b[j - 1]:
+            i -= 1
+            j -= 1
+        insert(j0, j)
+        k = 0
+        while i + k < hi_a and j + k < hi_b and a[i + k] == b[j + k]:
+            k += 1
+        copy(i, i + k)
+        i0, j0 = i + k, j + k
+    insert(j0, hi_b)
+    copy(hi_a, n)
+    return delta
+
+
+def apply_delta(base, delta):
+    """
+    Return the string obtained by applying ``delta`` (see
+    :func:`make_delta`) to ``base``.
+    """
+    a = base.splitlines(True)
+    return u''.join([u''.join(a[x[0]:x[1]]) if isinstance(x, list) else x
+                     for x in delta])
+
+
+class SnapshotStore(object):
+    def __init__(self, directory, users=None):
+        """
+        The revisions of a worksheet, kept in ``directory``.
+
+        INPUT:
+
+        - ``directory`` -- string; the snapshot directory of the
+          worksheet
+
+        - ``users`` -- None or a dictionary; the authors of the
+          snapshots of an old snapshot directory without manifest, by
+          time stamp
+        """
+        self._directory = directory
+        self._users = users or {}
+        self._revisions = None
+        # (key, text) of the newest revision, if known
+        self._head = None
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "Snapshot store of %s revisions" % len(self)
+
+    def __len__(self):
+        return len(self._manifest())
+
+    def directory(self):
+        return self._directory
+
+    def _path(self, filename):
+        return os.path.join(self._directory, filename)
+
+    def _manifest(self):
+        if self._revisions is None:
+            try:
+                with open(self._path(MANIFEST), 'rb') as f:
+                    manifest = json.loads(f.read().decode('utf-8'))
+                if manifest['version'] != MANIFEST_VERSION:
+                    raise ValueError("unknown snapshot manifest version")
+                self._revisions = manifest['revisions']
+            except (IOError, OSError):
+                self._revisions = self._legacy_revisions()
+            except (ValueError, KeyError) as msg:
+                print("WARNING: Rebuilding snapshot manifest of %s: %s" % (self._directory, msg))
+                self._revisions = self._legacy_revisions()
+        return self._revisions
+
+    def _legacy_revisions(self):
+        """
+        Return the manifest entries of the full snapshots ``<time>.bz2``
+        in the directory, e.g., those written before there was a
+        manifest.
+        """
+        try:
+            filenames = os.listdir(self._directory)
+        except OSError:
+            return []
+        v = []
+        for filename in filenames:
+            key, ext = os.path.splitext(filename)
+            if ext == '.bz2' and key.isdigit():
+                v.append({'key': key, 'time': float(key),
+                          'user': self._users.get(key, ''), 'size': None,
+                          'stored': os.path.getsize(self._path(filename)),
+                          'delta': False, 'digest': None})
+        v.sort(key=lambda r: int(r['key']))
+        return v
+
+    def _write_manifest(self):
+        filename = self._path(MANIFEST)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION,
+                                'revisions': self._revisions}).encode('utf-8'))
+        os.rename(tmp, filename)
+
+    def _filename(self, r):
+        return self._path(r['key'] + ('.delta' if r['delta'] else '.bz2'))
+
+    def _write(self, filename, data):
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+        return len(data)
+
+    def _index(self, key):
+        # revisions used to be addressed by their file name
+        if key.endswith('.bz2'):
+            key = key[:-4]
+        for i, r in enumerate(self._manifest()):
+            if r['key'] == key:
+                return i
+        raise KeyError("no revision '%s'" % key)
+
+    def revisions(self):
+        """
+        Return a list of dictionaries describing the revisions, oldest
+        first, with the ``key`` of the revision, its ``time`` and
+        ``user``, its ``size`` in bytes (None if unknown), the number
+        of bytes ``stored`` on disk and whether it is stored as a
+        ``delta``.
+        """
+        with self._lock:
+            return [dict(r) for r in self._manifest()]
+
+    def revision(self, key):
+        """
+        Return the dictionary describing the revision ``key`` (see
+        :meth:`revisions`).  Raise a KeyError if there is no such
+        revision.
+        """
+        with self._lock:
+            return dict(self._manifest()[self._index(key)])
+
+    def text(self, key):
+        r"""
+        Return the text of the revision ``key``.  Raise a KeyError if
+        there is no such revision, or if a file it is made of is gone.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.snapshots import SnapshotStore
+            sage: S = SnapshotStore(tmp_dir())
+            sage: a = S.save(u'1\n', 'admin', t=1); b = S.save(u'2\n', 'admin', t=2)
+            sage: os.remove(os.path.join(S.directory(), '2.bz2'))
+            sage: SnapshotStore(S.directory()).text(a)
+            Traceback (most recent call last):
+            ...
+            KeyError: "revision '1' is unreadable: ..."
+        """
+        with self._lock:
+            try:
+                return self._text(key)
+            except (IOError, OSError) as msg:
+                raise KeyError("revision '%s' is unreadable: %s" % (key, msg))
+
+    def _text(self, key):
+        with self._lock:
+            revisions = self._manifest()
+            i = self._index(key)
+            j = i
+            while revisions[j]['delta']:
+                j += 1
+            if self._head is not None and self._head[0] == revisions[j]['key']:
+                text = self._head[1]
+            else:
+                with open(self._filename(revisions[j]), 'rb') as f:
+                    text = bz2.decompress(f.read()).decode('utf-8', 'ignore')
+            for r in reversed(revisions[i:j]):
+                with open(self._filename(r), 'rb') as f:
+                    delta = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+                text = apply_delta(text, delta)
+            return text
+
+    def save(self, text, user, t=None, limit=0):
+        """
+        Save ``text`` as the newest revision, made by ``user`` at the
+        time ``t`` (default: now), and keep only the newest ``limit``
+        revisions if ``limit`` is positive.  Return the key of the new
+        revision, or None if ``text`` is the newest revision already.
+        """
+        if t is None:
+            t = time.time()
+        data = text.encode('utf-8', 'ignore')
+        digest = md5(data).hexdigest()
+        with self._lock:
+            revisions = self._manifest()
+            head = revisions[-1] if revisions else None
+            if head is not None and head['digest'] == digest:
+                return None
+            key = int(t)
+            if head is not None:
+                # keys are unique, even for several snapshots a second
+                key = max(key, int(head['key']) + 1)
+            r = {'key': str(key), 'time': t, 'user': user, 'size': len(data),
+                 'delta': False, 'digest': digest}
+            if head is not None and not self._keep_full(len(revisions) - 1):
+                old = self.text(head['key'])
+                delta = json.dumps(make_delta(text, old)).encode('utf-8')
+                head = dict(head, delta=True)
+                head['stored'] = self._write(self._filename(head), zlib.compress(delta))
+            r['stored'] = self._write(self._filename(r), bz2.compress(data))
+            old_full = revisions[-1] if head is not None and head['delta'] else None
+            if head is not None:
+                revisions[-1] = head
+            revisions.append(r)
+            self._write_manifest()
+            self._head = (r['key'], text)
+            if old_full is not None:
+                self._remove_file(old_full)
+            if limit > 0:
+                self.prune(limit)
+            return r['key']
+
+    def _keep_full(self, i):
+        """
+        Return True if the revision ``i`` must stay in full when a
+        newer revision is saved, so that at most ``FULL_INTERVAL``
+        deltas are applied to read any revision.
+        """
+        revisions = self._manifest()
+        n = 0
+        while i > n and revisions[i - n - 1]['delta']:
+            n += 1
+        return n + 1 >= FULL_INTERVAL
+
+    def _remove_file(self, r):
+        try:
+            os.remove(self._filename(r))
+        except OSError:
+            pass
+
+    def prune(self, limit):
+        r"""
+        Remove all but the newest ``limit`` revisions.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.snapshots import SnapshotStore
+            sage: S = SnapshotStore(tmp_dir())
+            sage: for i in range(5): k = S.save(u'%s\n' % i, 'admin', t=i)
+            sage: S.prune(2); [r['key'] for r in S.revisions()]
+            ['3', '4']
+            sage: sorted(os.listdir(S.directory()))
+            ['3.delta', '4.bz2', 'manifest.json']
+        """
+        with self._lock:
+            revisions = self._manifest()
+            if limit <= 0 or len(revisions) <= limit:
+                return
+            removed = revisions[:len(revisions) - limit]
+            del revisions[:len(removed)]
+            self._write_manifest()
+            for r in removed:
+                self._remove_file(r)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*
+"""
+Quitting idle and overtime worksheet processes in the background
+
+A worksheet process is quit when its worksheet has not computed
+anything for ``idle_timeout`` seconds (``doc_timeout`` for the live
+documentation), or when it has run longer than the wall time limit of
+the server.  The :class:`Supervisor` of a notebook keeps a heap of these
+deadlines, and a background thread quits the processes when their
+deadlines are reached, in a small pool of threads so that slow quits
+do not delay each other.  The heap is only a schedule: when a deadline
+is reached the worksheet is checked again, and if it computed in the
+meantime its new deadline is scheduled instead.
+
+Worksheets are scheduled when their process is started (see
+:meth:`Notebook.supervise_worksheet`), and every
+``idle_check_interval`` seconds all loaded worksheets are scheduled
+again and idle worksheets are unloaded (see
+:meth:`Notebook.evict_idle_worksheets`).
+"""
+
+import heapq
+import threading
+
+from sagenb.misc.misc import walltime
+
+IDLE = 'idle'
+WALLTIME = 'walltime'
+
+
+class Supervisor(object):
+    def __init__(self, notebook, worksheet_lock=None, threads=4):
+        """
+        The supervisor of the worksheet processes of ``notebook``.
+
+        INPUT:
+
+        - ``notebook`` -- a :class:`Notebook`
+
+        - ``worksheet_lock`` -- None or a function; if given, it is
+          called with each worksheet and returns a lock held while
+          quitting its process
+
+        - ``threads`` -- integer (default: 4); the number of processes
+          quit in parallel
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.supervisor import Supervisor
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: S = Supervisor(nb); S
+            Supervisor of 0 deadlines
+            sage: S.schedule('idle', 'sage/0', 10)
+            sage: S.schedule('idle', 'sage/0', 5)
+            sage: S.schedule('walltime', 'sage/0', 20)
+            sage: S
+            Supervisor of 2 deadlines
+            sage: S.due(7)
+            [('idle', 'sage/0')]
+            sage: S.due(30)
+            [('walltime', 'sage/0')]
+        """
+        self._notebook = notebook
+        self._worksheet_lock = worksheet_lock
+        self._threads = threads
+        # (deadline, kind, filename); entries superseded by an earlier
+        # deadline stay in the heap and are skipped
+        self._heap = []
+        # (kind, filename) --> deadline
+        self._deadlines = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+
+    def __repr__(self):
+        return "Supervisor of %s deadlines" % len(self._deadlines)
+
+    def is_alive(self):
+        """
+        Return True if the thread of this supervisor is running.
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def schedule(self, kind, filename, deadline):
+        """
+        Check the worksheet with given filename at the wall time
+        ``deadline``, for being idle (``kind`` is ``'idle'``) or for
+        exceeding the wall time limit (``kind`` is ``'walltime'``).
+
+        An earlier deadline of the same kind for the same worksheet is
+        kept.
+        """
+        key = (kind, filename)
+        with self._cond:
+            old = self._deadlines.get(key)
+            if old is not None and old <= deadline:
+                return
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, kind, filename))
+            if self._heap[0][0] == deadline:
+                self._cond.notify()
+
+    def due(self, now):
+        """
+        Remove and return the ``(kind, filename)`` pairs whose deadline
+        is not later than ``now``.
+        """
+        v = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, kind, filename = heapq.heappop(self._heap)
+                if self._deadlines.get((kind, filename)) == deadline:
+                    del self._deadlines[(kind, filename)]
+                    v.append((kind, filename))
+        return v
+
+    def schedule_worksheet(self, W):
+        """
+        Schedule the deadlines of the worksheet ``W``, if its process
+        is running.
+        """
+        if not W.compute_process_has_been_started():
+            return
+        conf = self._notebook.conf()
+        timeout = conf['doc_timeout'] if W.docbrowser() else conf['idle_timeout']
+        if timeout > 0:
+            self.schedule(IDLE, W.filename(), W.last_compute_walltime() + timeout)
+        deadline = W.walltime_deadline()
+        if deadline is not None:
+            self.schedule(WALLTIME, W.filename(), deadline)
+
+    def start(self):
+        """
+        Start the thread of this supervisor.
+        """
+        with self._cond:
+            if self._thread is not None:
+                return
+            from multiprocessing.pool import ThreadPool
+            self._stopped = False
+            self._pool = ThreadPool(self._threads)
+            self._thread = threading.Thread(target=self._run,
+                                            name='worksheet supervisor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop the thread of this supervisor.
+        """
+        with self._cond:
+            self._stopped = True
+            thread = self._thread
+            pool = self._pool
+            self._thread = self._pool = None
+            self._cond.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _run(self):
+        next_sweep = walltime()
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    wake = next_sweep
+                    if self._heap:
+                        wake = min(wake, self._heap[0][0])
+                    if wake <= walltime():
+                        break
+                    self._cond.wait(wake - walltime())
+                if self._stopped:
+                    return
+                pool = self._pool
+            now = walltime()
+            if now >= next_sweep:
+                next_sweep = now + max(self._notebook.conf()['idle_check_interval'], 1)
+                pool.apply_async(self._guard, (self.sweep,))
+            for kind, filename in self.due(now):
+                pool.apply_async(self._guard, (self.check, kind, filename))
+
+    def _guard(self, f, *args):
+        try:
+            f(*args)
+        except Exception:
+            import traceback
+            print("Error supervising worksheet processes:\n%s" % traceback.format_exc())
+
+    def sweep(self):
+        """
+        Schedule all loaded worksheets and unload the idle ones.
+        """
+        for W in self._notebook.loaded_worksheets():
+            self.schedule_worksheet(W)
+        self._notebook.evict_idle_worksheets(worksheet_lock=self._worksheet_lock)
+
+    def check(self, kind, filename):
+        """
+        Quit the process of the worksheet with given filename if its
+        deadline of the given kind is reached, and otherwise schedule
+        its new deadline.
+        """
+        W = self._notebook.loaded_worksheet(filename)
+        if W is None:
+            return
+        lock = self._worksheet_lock(W) if self._worksheet_lock else None
+        if lock is not None:
+            lock.acquire()
+        try:
+            if not W.compute_process_has_been_started():
+                return
+            if kind == IDLE:
+                conf = self._notebook.conf()
+                timeout = conf['doc_timeout'] if W.docbrowser() else conf['idle_timeout']
+                W.quit_if_idle(timeout)
+            elif kind == WALLTIME:
+                deadline = W.walltime_deadline()
+                if deadline is not None and walltime() >= deadline:
+                    print("Quitting worksheet process for %r (wall time limit reached)." % W.name())
+                    W.quit()
+            self.schedule_worksheet(W)
+        finally:
+            if lock is not None:
+                lock.release()
@@ -13,6 +13,7 @@ from flask_babel import lazy_gettext
 defaults = {'max_history_length':1000,
             'default_system':'sage',
             'autosave_interval':60*60,   # 1 hour in seconds
+            'max_snapshots':0,   # revisions kept; 0 for the server's setting
             'default_pretty_print': False,
             'next_worksheet_id_number': -1,  # not yet initialized
             'language': 'default'
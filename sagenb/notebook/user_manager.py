@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from . import user
 import crypt
 import hashlib
+import threading
 
 try:
     unicode
@@ -22,6 +23,20 @@ class UserManager(object):
         """
         self._users = {}
         self._accounts = accounts
+        # see set_datastore
+        self._datastore = None
+        self._deleted = set()
+        # taken when loading, adding or deleting a user
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
     def __eq__(self, other):
         """
@@ -50,6 +65,67 @@ class UserManager(object):
             return False
         return True
 
+    def set_datastore(self, datastore):
+        """
+        Load users from ``datastore`` when they are first needed,
+        instead of keeping all of them in memory.
+
+        The datastore must implement ``load_user`` and ``usernames``.
+        """
+        self._datastore = datastore
+
+    def _load_user(self, username):
+        """
+        Load the user ``username`` from the datastore and return it, or
+        return None if there is no such user.
+        """
+        with self._lock:
+            if self._datastore is None or username in self._deleted:
+                return None
+            U = self._users.get(username)
+            if U is not None:
+                # loaded by another thread in the meantime
+                return U
+            try:
+                U = self._datastore.load_user(username)
+            except LookupError:
+                return None
+            return self._users.setdefault(username, U)
+
+    def loaded_users(self):
+        """
+        Return a dictionary whose keys are the usernames and whose
+        values are the corresponding users, for the users that are in
+        memory.  Only these can have changed since they were loaded.
+        """
+        return self._users
+
+    def deleted_usernames(self):
+        """
+        Return the list of usernames of the users that were deleted.
+        """
+        return list(self._deleted)
+
+    def forget_deleted(self, usernames):
+        """
+        Forget that the users ``usernames`` were deleted, once their
+        deletion is saved in the datastore.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.user_manager import SimpleUserManager
+            sage: U = SimpleUserManager()
+            sage: U.create_default_users('password')
+            sage: U.delete_user('pub')
+            sage: U.deleted_usernames()
+            ['pub']
+            sage: U.forget_deleted(['pub'])
+            sage: U.deleted_usernames()
+            []
+        """
+        with self._lock:
+            self._deleted.difference_update(usernames)
+
     def user_list(self):
         """
         Return a sorted list of the users that have logged into the notebook.
@@ -72,6 +148,10 @@ class UserManager(object):
         Note that these are just the users that have logged into the notebook and are
         note necessarily all of the valid users.
 
+        This loads all the users from the datastore, if any, so it
+        should be avoided when the usernames are enough
+        (see :meth:`usernames`).
+
         EXAMPLES::
 
             sage: from sagenb.notebook.user_manager import SimpleUserManager
@@ -80,6 +160,10 @@ class UserManager(object):
             sage: list(sorted(U.users().items()))
             [('_sage_', _sage_), ('admin', admin), ('guest', guest), ('pub', pub)]
         """
+        if self._datastore is not None:
+            for username in self._datastore.usernames():
+                if username not in self._users:
+                    self._load_user(username)
         return self._users
 
     def user(self, username):
@@ -113,8 +197,13 @@ class UserManager(object):
         """
         if not isinstance(username, (str, unicode)) or '/' in username:
             raise ValueError("no user '%s'" % username)
-        if username in self.users():
-            return self.users()[username]
+        try:
+            return self._users[username]
+        except KeyError:
+            pass
+        U = self._load_user(username)
+        if U is not None:
+            return U
 
         try:
             return self._user(username)
@@ -145,7 +234,7 @@ class UserManager(object):
             sage: U.user_exists('admin')
             True
         """
-        return username in self.users()
+        return username in self._users or self._load_user(username) is not None
 
     def usernames(self):
         """
@@ -157,7 +246,11 @@ class UserManager(object):
             sage: u = U.usernames(); u.sort(); u
             ['_sage_', 'admin', 'guest', 'pub']
         """
-        return list(self.users())
+        names = set(self._users)
+        if self._datastore is not None:
+            names.update([x for x in self._datastore.usernames()
+                          if x not in self._deleted])
+        return list(names)
 
     def user_is_admin(self, username):
         """
@@ -233,9 +326,9 @@ class UserManager(object):
             sage: U.user_list()
             [_sage_, admin, guest]
         """
-        us = self.users()
-        if username in us:
-            del us[username]
+        with self._lock:
+            self._users.pop(username, None)
+            self._deleted.add(username)
 
     def user_conf(self, username):
         """        
@@ -313,11 +406,12 @@ class UserManager(object):
         if not self.get_accounts() and not force:
             raise ValueError("creating new accounts disabled.")
 
-        us = self.users()
-        if username in us:
+        if self.user_exists(username):
             print("WARNING: User '%s' already exists -- and is now being replaced." % username)
         U = user.User(username, password, email, account_type, external_auth)
-        us[username] = U
+        with self._lock:
+            self._users[username] = U
+            self._deleted.discard(username)
         self.set_password(username, password)
 
     def add_user_object(self, user, force=False):
@@ -342,11 +436,12 @@ class UserManager(object):
         """
         if not self.get_accounts() and not force:
             raise ValueError("creating new accounts disabled.")
-        us = self.users()
-        if user.username() in us:
+        if self.user_exists(user.username()):
             print("WARNING: User '%s' already exists -- and is now being replaced." % user.username())
 
-        self._users[user.username()] = user 
+        with self._lock:
+            self._users[user.username()] = user
+            self._deleted.discard(user.username())
 
 class SimpleUserManager(UserManager):
     def __init__(self, accounts=True, conf=None):
@@ -386,6 +481,12 @@ class SimpleUserManager(UserManager):
         passwd = O.password()
         self.set_password(username, passwd, encrypt=False)
 
+    def _load_user(self, username):
+        U = UserManager._load_user(self, username)
+        if U is not None:
+            self._passwords[username] = U.password()
+        return U
+
     def _user(self, username):
         """
         Returns a User object with username username.
@@ -464,7 +565,7 @@ class SimpleUserManager(UserManager):
                                                    hashlib.sha256(salt + new_password).hexdigest())
         self._passwords[username] = new_password
         # need to make sure password in the user object is synced
-        # for compatibility only the user object data is stored in the 'users.pickle'
+        # for compatibility only the user object data is stored in the datastore
         self.user(username).set_password(new_password, encrypt = False)
 
     def passwords(self):
@@ -500,6 +601,8 @@ class SimpleUserManager(UserManager):
             sage: U.check_password('admin','passpass')
             True
         """
+        if username not in self._users:
+            self._load_user(username)
         return self._passwords.get(username, None)
         
     def check_password(self, username, password):
@@ -574,7 +677,7 @@ class ExtAuthUserManager(SimpleUserManager):
         Find auth method for user 'username' and
         use that auth method to check username/password combination.
         """
-        u = self.users()[username]
+        u = self.user(username)
         if u.is_external():
             a = u.external_auth()
         else:
@@ -28,8 +28,6 @@ from six import iteritems
 
 # Import standard Python libraries that we will use below
 import base64
-import bz2
-import calendar
 import copy
 import os
 import re
@@ -41,7 +39,7 @@ import locale
 
 # General sage library code
 from sagenb.misc.misc import (cython, load, save, verbose, DOT_SAGENB,
-                              walltime, ignore_nonexistent_files,
+                              walltime, move_path,
                               set_restrictive_permissions,
                               set_permissive_permissions,
                               encoded_str, unicode_str)
@@ -56,6 +54,8 @@ from sagenb.misc.format import relocate_future_imports
 
 # Imports specifically relevant to the sage notebook
 from .cell import Cell, TextCell
+from .cell_list import CellList, CellQueue
+from .snapshots import SnapshotStore
 from .template import template, clean_name, prettify_time_ago
 from flask_babel import gettext, lazy_gettext
 _ = gettext
@@ -154,6 +154,70 @@ def Worksheet_from_basic(obj, notebook_worksheet_directory):
     W.reconstruct_from_basic(obj, notebook_worksheet_directory)
     return W
 
+def listing_row(obj):
+    """
+    Return what is needed to list and sort the worksheet given by the
+    basic Python object ``obj`` (see :meth:`Worksheet.basic`), without
+    reconstructing the worksheet.
+
+    OUTPUT:
+
+    - a dictionary with the lower cased ``name`` and ``owner``, the
+      ``last_edited`` time, the ``rating``, the ``views`` of the users
+      (ACTIVE, ARCHIVED or TRASH) and the set of ``viewers`` (see
+      :meth:`Worksheet.is_viewer`)
+
+    EXAMPLES::
+
+        sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+        sage: nb.create_default_users('password')
+        sage: W = nb.create_new_worksheet('Test', 'admin')
+        sage: W.set_last_change('admin', 1000)
+        sage: W.move_to_archive('admin')
+        sage: row = sagenb.notebook.worksheet.listing_row(W.basic())
+        sage: row['name'], row['owner'], row['last_edited'], row['rating']
+        (u'test', 'admin', 1000.0, -1)
+        sage: row['views'] == {'admin': sagenb.notebook.worksheet.ARCHIVED}
+        True
+    """
+    ratings = [x[1] for x in obj.get('ratings', [])]
+    owner = obj.get('owner') or ''
+    publisher = (obj.get('worksheet_that_was_published') or (owner, None))[0]
+    return {'name': unicode(obj.get('name', '')).lower(),
+            'owner': owner.lower(),
+            'last_edited': float(obj.get('last_change', (None, 0))[1]),
+            'rating': float(sum(ratings)) / len(ratings) if ratings else -1,
+            'views': dict([(user, v[0]) for user, v in iteritems(obj.get('tags', {}))
+                           if len(v) >= 1]),
+            'viewers': frozenset(list(obj.get('viewers', [])) +
+                                 list(obj.get('collaborators', [])) + [publisher])}
+
+
+def listing_view(row, username):
+    """
+    Return the view (ACTIVE, ARCHIVED or TRASH) of the user
+    ``username`` on the worksheet with listing row ``row`` (see
+    :func:`listing_row`).
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.worksheet import listing_view, ACTIVE, TRASH
+        sage: listing_view({'views': {'sage': TRASH}}, 'sage') == TRASH
+        True
+        sage: listing_view({'views': {'sage': TRASH}}, 'admin') == ACTIVE
+        True
+    """
+    return row['views'].get(username, ACTIVE)
+
+
+# For each sort of the worksheet listing, the key on listing rows and
+# whether the order is reversed; see sort_worksheet_list in notebook.py.
+LISTING_SORTS = {
+    'last_edited': (lambda row: row['last_edited'], True),
+    'name': (lambda row: (row['name'], -row['last_edited']), False),
+    'owner': (lambda row: (row['owner'], -row['last_edited']), False),
+    'rating': (lambda row: (row['rating'], -row['last_edited']), True)}
+
 
 class Worksheet(object):
     def __init__(self, name=None, id_number=None,
@@ -373,6 +437,53 @@ class Worksheet(object):
              }
         return d
 
+    def listing_version(self):
+        """
+        Return a number which changes whenever something shown in the
+        worksheet listing (see :func:`listing_row`) changes.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: v = W.listing_version()
+            sage: W.set_name('Renamed')
+            sage: W.listing_version() == v
+            False
+        """
+        try:
+            return self.__listing_version
+        except AttributeError:
+            self.__listing_version = 0
+            return 0
+
+    def _listing_changed(self):
+        self.__listing_version = self.listing_version() + 1
+        # the set of changed listings of the notebook this worksheet
+        # is loaded in, if any (see WorksheetDict.changed_listing_rows)
+        changed = getattr(self, '_changed_listings', None)
+        if changed is not None:
+            changed.add(self.filename())
+
+    def listing_changed(self):
+        """
+        Return True if this worksheet changed in a way shown in the
+        worksheet listing since it was last saved or loaded, so that
+        its listing row in the datastore is out of date.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: W.save(); W.listing_changed()
+            False
+            sage: W.set_name('Renamed'); W.listing_changed()
+            True
+        """
+        return getattr(self, '_listed_version', None) != self.listing_version()
+
     def reconstruct_from_basic(self, obj, notebook_worksheet_directory=None):
         """
         Reconstruct as much of the worksheet's configuration as
@@ -429,6 +540,7 @@ class Worksheet(object):
                 self.set_published_version('pub/%s' % value)
             elif key == 'worksheet_that_was_published':
                 self.set_worksheet_that_was_published(value)
+        self._listing_changed()
         self.create_directories()
 
     def __eq__(self, other):
@@ -734,10 +846,11 @@ class Worksheet(object):
             sage: W.collaborators()
             ['hilbert', 'sage']
         """
-        users = self.notebook().user_manager().users()
+        user_manager = self.notebook().user_manager()
         owner = self.owner()
-        collaborators = set([u for u in v if u in users and u != owner])
+        collaborators = set([u for u in v if u != owner and user_manager.user_exists(u)])
         self.__collaborators = sorted(collaborators)
+        self._listing_changed()
 
     def viewers(self):
         """
@@ -821,6 +934,7 @@ class Worksheet(object):
         self.__attached = {}
         self.__collaborators = [self.owner()]
         self.__viewers = []
+        self._listing_changed()
 
     def name(self, username=None):
         r"""
@@ -866,6 +980,7 @@ class Worksheet(object):
             name = gettext('Untitled')
         name = unicode_str(name)
         self.__name = name
+        self._listing_changed()
 
     def set_filename_without_owner(self, nm):
         r"""
@@ -1444,6 +1559,7 @@ class Worksheet(object):
             self.__worksheet_came_from = W
         else:
             self.__worksheet_came_from = (W.owner(), W.id_number())
+        self._listing_changed()
 
     def rate(self, x, comment, username):
         """
@@ -1479,6 +1595,7 @@ class Worksheet(object):
         """
         r = self.ratings()
         x = int(x)
+        self._listing_changed()
         for i in range(len(r)):
             if r[i][0] == username:
                 r[i] = (username, x, comment)
@@ -1706,6 +1823,7 @@ class Worksheet(object):
                 d[user] = v[0]  # must be a single int for now, until
                                 # the tag system is implemented
         self.__user_view = d
+        self._listing_changed()
 
     def set_user_view(self, user, x):
         """
@@ -1734,6 +1852,7 @@ class Worksheet(object):
         except (KeyError, AttributeError):
             self.user_view(user)
             self.__user_view[user] = x
+        self._listing_changed()
 
         # it is important to save the configuration and changing the
         # views, e.g., moving to trash, etc., since the user can't
@@ -1963,6 +2082,7 @@ class Worksheet(object):
         self.__owner = owner
         if not owner in self.collaborators():
             self.__collaborators.append(owner)
+        self._listing_changed()
 
     def is_only_viewer(self, user):
         try:
@@ -2085,6 +2205,7 @@ class Worksheet(object):
                 # assign the owner None, which means nobody owns it.
                 # It will get purged elsewhere.
                 self.__owner = None
+        self._listing_changed()
 
     def add_viewer(self, user):
         """
@@ -2109,6 +2230,7 @@ class Worksheet(object):
                 self.__viewers.append(user)
         except AttributeError:
             self.__viewers = [user]
+        self._listing_changed()
 
     def add_collaborator(self, user):
         """
@@ -2135,6 +2257,7 @@ class Worksheet(object):
                 self.__collaborators.append(user)
         except AttributeError:
             self.__collaborators = [user]
+        self._listing_changed()
 
     ##########################################################
     # Searching
@@ -2181,30 +2304,100 @@ class Worksheet(object):
     # Saving
     ##########################################################
     def save_snapshot(self, user, E=None):
+        r"""
+        Save the worksheet and add its text as a new revision, made by
+        ``user``, to its revision history.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.create_default_users('password')
+            sage: W = nb.create_new_worksheet('Test', 'admin')
+            sage: W.edit_save('{{{\n2+3\n}}}')
+            sage: W.save_snapshot('admin')
+            sage: W.edit_save('{{{\n2+3\n}}}\n{{{\n4+5\n}}}')
+            sage: W.save_snapshot('admin')
+            sage: [r['delta'] for r in W.snapshots().revisions()]
+            [True, False]
+            sage: key = W.snapshot_data()[0][1]
+            sage: W.snapshot_text(key)
+            u'\n\n{{{id=0|\n2+3\n///\n}}}'
+        """
         if not self.body_is_loaded(): 
             return
-        self.uncache_snapshot_data()
-        path = self.snapshot_directory()
-        basename = str(int(time.time()))
-        filename = os.path.join(path, '%s.bz2' % basename)
         if E is None:
             E = self.edit_text()
-        worksheet_html = self.worksheet_html_filename()
-        open(filename, 'w').write(bz2.compress(E.encode('utf-8', 'ignore')))
-        open(worksheet_html, 'w').write(self.body().encode('utf-8', 'ignore'))
-        self.limit_snapshots()
-        try:
-            X = self.__saved_by_info
-        except AttributeError:
-            X = {}
-            self.__saved_by_info = X
-        X[basename] = user
+        nb = self.notebook()
+        if nb is None:
+            worksheet_html = self.worksheet_html_filename()
+            open(worksheet_html, 'w').write(self.body().encode('utf-8', 'ignore'))
+        else:
+            # only writes what changed
+            nb.save_worksheet(self)
+        self.snapshots().save(E, user, limit=self.max_snapshots())
         if self.is_auto_publish():
             self.notebook().publish_worksheet(self, user)
 
-    def get_snapshot_text_filename(self, name):
-        path = self.snapshot_directory()
-        return os.path.join(path, name)
+    def snapshots(self):
+        """
+        Return the :class:`~sagenb.notebook.snapshots.SnapshotStore`
+        with the revision history of this worksheet.
+        """
+        try:
+            return self.__snapshots
+        except AttributeError:
+            try:
+                users = self.__saved_by_info
+            except AttributeError:
+                users = {}
+            self.__snapshots = SnapshotStore(self.snapshot_directory(), users)
+            return self.__snapshots
+
+    def delete_snapshots(self):
+        """
+        Delete all snapshots of this worksheet.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.create_new_worksheet('Test', 'sage')
+            sage: W.save_snapshot('sage'); len(W.snapshots())
+            1
+            sage: W.delete_snapshots(); len(W.snapshots())
+            0
+            sage: W.save_snapshot('sage'); len(W.snapshots())
+            1
+        """
+        shutil.rmtree(os.path.join(self.__dir, 'snapshots'), ignore_errors=True)
+        # the store caches the manifest of the removed directory
+        try:
+            del self.__snapshots
+        except AttributeError:
+            pass
+
+    def snapshot_text(self, key):
+        """
+        Return the text of the revision with given key (see
+        :meth:`snapshot_data`).  Raise a KeyError if there is no such
+        revision.
+        """
+        return self.snapshots().text(key)
+
+    def max_snapshots(self):
+        """
+        Return the number of revisions kept for this worksheet, or 0
+        to keep them all.  This is the ``max_snapshots`` setting of the
+        owner, if not 0, and otherwise that of the server.
+        """
+        nb = self.notebook()
+        if nb is None:
+            return 0
+        try:
+            n = nb.user(self.owner())['max_snapshots']
+        except LookupError:
+            n = 0
+        return n if n else nb.conf()['max_snapshots']
 
     def user_autosave_interval(self, username):
         return self.notebook().user(username)['autosave_interval']
@@ -2222,45 +2415,27 @@ class Worksheet(object):
             self.save_snapshot(username)
 
     def revert_to_snapshot(self, name):
-        path = self.snapshot_directory()
-        filename = os.path.join(path, '%s.txt' % name)
-        E = bz2.decompress(open(filename).read())
-        self.edit_save(E)
-
-    def _saved_by_info(self, x, username=None):
-        try:
-            u = self.__saved_by_info[x]
-            return u
-        except (KeyError, AttributeError):
-            return ''
+        self.edit_save(self.snapshot_text(name))
 
     def snapshot_data(self):
-        try:
-            self.__filenames
-        except AttributeError:
-            filenames = os.listdir(self.snapshot_directory())
-            filenames.sort()
-            self.__filenames = filenames
+        """
+        Return a list of pairs of a description of when and by whom a
+        revision of this worksheet was made and the key of the
+        revision, oldest first.
+        """
         t = time.time()
         v = []
-        for x in self.__filenames:
-            base = os.path.splitext(x)[0]
-            if self._saved_by_info(x):
+        for r in self.snapshots().revisions():
+            if r['user']:
                 v.append((_('%(t)s ago by %(le)s',) %
-                            {'t': prettify_time_ago(t - float(base)),
-                             'le': self._saved_by_info(base)},
-                          x))
+                            {'t': prettify_time_ago(t - r['time']),
+                             'le': r['user']},
+                          r['key']))
             else:
-                v.append((_('%(seconds)s ago', seconds=prettify_time_ago(t - float(base))),
-                          x))
+                v.append((_('%(seconds)s ago', seconds=prettify_time_ago(t - r['time'])),
+                          r['key']))
         return v
 
-    def uncache_snapshot_data(self):
-        try:
-            del self.__snapshot_data
-        except AttributeError:
-            pass
-
     def revert_to_last_saved_state(self):
         filename = self.worksheet_html_filename()
         if os.path.exists(filename):
@@ -2278,28 +2453,10 @@ class Worksheet(object):
 
     def limit_snapshots(self):
         r"""
-        This routine will limit the number of snapshots of a worksheet,
-        as specified by a hard-coded value below.
-
-        Prior behavior was to allow unlimited numbers of snapshots and
-        so this routine will not delete files created prior to this change.
-
-        This assumes snapshot names correspond to the ``time.time()``
-        method used to create base filenames in seconds in UTC time,
-        and that there are no other extraneous files in the directory.
+        Remove all but the newest revisions of this worksheet, keeping
+        as many as :meth:`max_snapshots` says.
         """
-
-        # This should be user-configurable with an option like 'max_snapshots'
-        max_snaps = 30
-        amnesty = int(calendar.timegm(time.strptime("01 May 2009", "%d %b %Y")))
-
-        path = self.snapshot_directory()
-        snapshots = os.listdir(path)
-        snapshots.sort()
-        for i in range(len(snapshots) - max_snaps):
-            creation = int(os.path.splitext(snapshots[i])[0])
-            if creation > amnesty:
-                os.remove(os.path.join(path, snapshots[i]))
+        self.snapshots().prune(self.max_snapshots())
 
     ##########################################################
     # Exporting the worksheet in plain text command-line format
@@ -2361,6 +2518,35 @@ class Worksheet(object):
         except AttributeError:
             return False
 
+    def approximate_size(self):
+        r"""
+        Return a rough measure of the memory used by the loaded body of
+        this worksheet: the number of characters of the input and
+        output of its cells and of its cached HTML.
+
+        EXAMPLES::
+
+            sage: nb = sagenb.notebook.notebook.Notebook(tmp_dir(ext='.sagenb'))
+            sage: nb.user_manager().add_user('sage','sage','sage@sagemath.org',force=True)
+            sage: W = nb.create_new_worksheet('Test', 'sage')
+            sage: W.edit_save('{{{\n2+3\n///\n5\n}}}')
+            sage: W.approximate_size()
+            5
+        """
+        try:
+            cells = self.__cells
+        except AttributeError:
+            return 0
+        n = 0
+        for C in cells:
+            for a in ('_in', '_out', '_out_html', '_text'):
+                n += len(getattr(C, a, None) or '')
+        try:
+            n += len(self.__html)
+        except AttributeError:
+            pass
+        return n
+
     def edit_text(self):
         """
         Returns a plain-text version of the worksheet with {{{}}}
@@ -2468,31 +2654,32 @@ class Worksheet(object):
 
         text.replace('\r\n', '\n')
 
-        data = []
-        while True:
-            plain_text = extract_text_before_first_compute_cell(text).strip()
-            if len(plain_text) > 0:
-                T = plain_text
-                data.append(('plain', T))
-            try:
-                meta, input, output, i = extract_first_compute_cell(text)
-                data.append(('compute', (meta, input, output)))
-            except EOFError:
-                # print(msg) # -- don't print msg, just outputs a blank
-                #                 line every time, which makes for an
-                #                 ugly and unprofessional log.
-                break
-            text = text[i:]
+        data = parse_worksheet_text(text)
 
         ids = set([x[0]['id'] for typ, x in data if typ == 'compute' and  'id' in x[0]])
         used_ids = set([])
+        # The ids are only added to ids, so the smallest available one
+        # never decreases.
+        free = [0]
+        def new_id():
+            i = free[0]
+            while i in ids:
+                i += 1
+            ids.add(i)
+            free[0] = i + 1
+            return i
+
+        # The existing cells, to reuse them.
+        try:
+            old_cells = self.__cells
+        except AttributeError:
+            old_cells = None
 
         cells = []
         for typ, T in data:
             if typ == 'plain':
                 if len(T) > 0:
-                    id = next_available_id(ids)
-                    ids.add(id)
+                    id = new_id()
                     cells.append(self._new_text_cell(T, id=id))
                     used_ids.add(id)
             elif typ == 'compute':
@@ -2501,20 +2688,14 @@ class Worksheet(object):
                     id = meta['id']
                     if id in used_ids:
                         # In this case don't reuse, since ids must be unique.
-                        id = next_available_id(ids)
-                        ids.add(id)
+                        id = new_id()
                     html = True
                 else:
-                    id = next_available_id(ids)
-                    ids.add(id)
+                    id = new_id()
                     html = False
                 used_ids.add(id)
-                try:
-                    self.__cells
-                    C = self.get_cell_with_id(id = id)
-                    if C.is_text_cell():
-                        C = self._new_cell(id)
-                except AttributeError:
+                C = old_cells.cell(id) if old_cells is not None else None
+                if C is None or C.is_text_cell():
                     C = self._new_cell(id)
                 C.set_input_text(input)
                 C.set_output_text(output, '')
@@ -2522,7 +2703,7 @@ class Worksheet(object):
                     C.update_html_output(output)
                 cells.append(C)
 
-        self.__cells = cells
+        self.__cells = CellList(cells)
         # Set the next id.  This *depends* on self.cell_list() being
         # set!!
         self.set_cell_counter()
@@ -2536,6 +2717,10 @@ class Worksheet(object):
                 if c.is_interactive_cell():
                     c.delete_output()
 
+        # The full text search index is brought up to date when the
+        # worksheet is saved, so that it always agrees with the saved
+        # text that satisfies_search reads.
+
 
     ##########################################################
     # HTML rendering of the whole worksheet
@@ -2669,6 +2854,7 @@ class Worksheet(object):
         tm = float(tm)
         self.__date_edited = (time.localtime(tm), username)
         self.__last_edited = (tm, username)
+        self._listing_changed()
 
     # TODO: all code below needs to be re-organized, but without
     # breaking old worksheet migration.  Do this after I wrote a
@@ -2703,6 +2889,7 @@ class Worksheet(object):
     def record_edit(self, user):
         self.__last_edited = (time.time(), user)
         self.__date_edited = (time.localtime(), user)
+        self._listing_changed()
         self.autosave(user)
 
     def time_since_last_edited(self):
@@ -2845,7 +3032,7 @@ class Worksheet(object):
             # load from disk
             worksheet_html = self.worksheet_html_filename()
             if not os.path.exists(worksheet_html):
-                self.__cells = []
+                self.__cells = CellList()
             else:
                 self.set_body(open(worksheet_html).read())
             return self.__cells
@@ -2916,13 +3103,12 @@ class Worksheet(object):
         - a new :class:`sagenb.notebook.cell.Cell` instance
         """
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_cell(input=input)
-                cells.insert(i, C)
-                return C
+        i = cells.position(id)
         C = self._new_cell(input=input)
-        cells.append(C)
+        if i is None:
+            cells.append(C)
+        else:
+            cells.insert(i, C)
         return C
 
     def new_text_cell_before(self, id, input=''):
@@ -2943,13 +3129,12 @@ class Worksheet(object):
         - a new :class:`sagenb.notebook.cell.TextCell` instance
         """
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_text_cell(plain_text=input)
-                cells.insert(i, C)
-                return C
+        i = cells.position(id)
         C = self._new_text_cell(plain_text=input)
-        cells.append(C)
+        if i is None:
+            cells.append(C)
+        else:
+            cells.insert(i, C)
         return C
 
     def new_cell_after(self, id, input=''):
@@ -2969,13 +3154,12 @@ class Worksheet(object):
         - a new :class:`sagenb.notebook.cell.Cell` instance
         """
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_cell(input=input)
-                cells.insert(i + 1, C)
-                return C
+        i = cells.position(id)
         C = self._new_cell(input=input)
-        cells.append(C)
+        if i is None:
+            cells.append(C)
+        else:
+            cells.insert(i + 1, C)
         return C
 
     def new_text_cell_after(self, id, input=''):
@@ -2995,13 +3179,12 @@ class Worksheet(object):
         - a new :class:`sagenb.notebook.cell.TextCell` instance
         """
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-                C = self._new_text_cell(plain_text=input)
-                cells.insert(i + 1, C)
-                return C
+        i = cells.position(id)
         C = self._new_text_cell(plain_text=input)
-        cells.append(C)
+        if i is None:
+            cells.append(C)
+        else:
+            cells.insert(i + 1, C)
         return C
 
     def delete_cell_with_id(self, id):
@@ -3043,24 +3226,21 @@ class Worksheet(object):
             ['foo', 'dont_delete_me']
         """
         cells = self.cell_list()
-        for i in range(len(cells)):
-            if cells[i].id() == id:
-
-                # Delete this cell from the queued up calculation list:
-                C = cells[i]
-                if C in self.__queue and self.__queue[0] != C:
-                    self.__queue.remove(C)
-
-                # Delete the cell's output.
-                C.delete_output()
+        i = cells.position(id)
+        if i is not None:
+            # Delete this cell from the queued up calculation list:
+            C = cells[i]
+            if C in self.__queue and self.__queue[0] != C:
+                self.__queue.remove(C)
+
+            # Delete the cell's output.
+            C.delete_output()
 
-                # Delete this cell from the list of cells in this worksheet:
-                del cells[i]
+            # Delete this cell from the list of cells in this worksheet:
+            del cells[i]
 
-                if i > 0:
-                    return cells[i - 1].id()
-                else:
-                    break
+            if i > 0:
+                return cells[i - 1].id()
         return cells[0].id()
 
     ##########################################################
@@ -3068,8 +3248,8 @@ class Worksheet(object):
     ##########################################################
     def clear(self):
         self.__comp_is_running = False
-        self.__queue = []
-        self.__cells = []
+        self.__queue = CellQueue()
+        self.__cells = CellList()
         for i in range(INITIAL_NUM_CELLS):
             self.append_new_cell()
 
@@ -3085,7 +3265,7 @@ class Worksheet(object):
 
     def set_not_computing(self):
         self.__comp_is_running = False
-        self.__queue = []
+        self.__queue = CellQueue()
 
     def quit(self):
         try:
@@ -3096,7 +3276,7 @@ class Worksheet(object):
             return
 
         try:
-            S.quit()
+            self.notebook().release_worksheet_process(S)
         except AttributeError as msg:
             print("WARNING: %s" % msg)
         except Exception as msg:
@@ -3134,6 +3314,16 @@ class Worksheet(object):
         self.__next_block_id = i
         return i
 
+    def walltime_deadline(self):
+        """
+        Return the wall time at which the compute process of this
+        worksheet exceeds the wall time limit of the server, or None.
+        """
+        try:
+            return self.__sage.walltime_deadline()
+        except AttributeError:
+            return None
+
     def compute_process_has_been_started(self):
         """
         Return True precisely if the compute process has been started,
@@ -3145,6 +3335,20 @@ class Worksheet(object):
         except AttributeError:
             return False
 
+    def wait_for_output(self, timeout):
+        """
+        Block until the compute process of this worksheet may have
+        produced new output, or until ``timeout`` seconds have
+        elapsed.  Return at once if nothing is being computed.
+
+        INPUT:
+
+        -  ``timeout`` - float; maximum number of seconds to wait
+        """
+        if len(self.__queue) == 0 or not self.compute_process_has_been_started():
+            return
+        self.__sage.wait_for_output(timeout)
+
     def initialize_sage(self):
         S = self.__sage
         try:
@@ -3222,7 +3426,7 @@ except (KeyError, IOError):
                 return S
         except AttributeError:
             pass
-        self.__sage = self.notebook().new_worksheet_process()
+        self.__sage = self.notebook().get_worksheet_process()
         all_worksheet_processes.append(self.__sage)
         self.__next_block_id = 0
         
@@ -3232,6 +3436,7 @@ except (KeyError, IOError):
         S = self.__sage
 
         self.initialize_sage()
+        self.notebook().supervise_worksheet(self)
 
         # make sure we have a __sage attribute
         # We do this to diagnose google issue 81; once we
@@ -3281,7 +3486,8 @@ except (KeyError, IOError):
 
         #Handle any percent directives
         if 'save_server' in percent_directives:
-            self.notebook().save()
+            # we hold the lock of this worksheet, which the saver may wait for
+            self.notebook().request_save()
 
         id = self.next_block_id()
         C.code_id = id
@@ -3471,16 +3677,10 @@ except (KeyError, IOError):
                     if os.path.split(X)[-1] == CODE_PY:
                         continue
                     target = os.path.join(cell_dir, os.path.split(X)[1])
-                    # We move X to target. Note that we don't actually
-                    # do a rename: in a client/server setup, X might be
-                    # owned by a different Unix user than ourselves.
-                    if os.path.isdir(X):
-                        shutil.copytree(X, target,
-                                        ignore=ignore_nonexistent_files)
-                        shutil.rmtree(X, ignore_errors=True)
-                    else:
-                        shutil.copy(X, target)
-                        os.unlink(X)
+                    # X is renamed if we own it, but in a client/server
+                    # setup it might be owned by a different Unix user
+                    # than ourselves, and then it is copied.
+                    move_path(X, target)
                     set_restrictive_permissions(target)
             # Generate html, etc.
             html = C.files_html(out)
@@ -3558,7 +3758,7 @@ except (KeyError, IOError):
         # empty the queue
         for C in self.__queue:
             C.interrupt()
-        self.__queue = []
+        self.__queue = CellQueue()
         self.__comp_is_running = False
 
     def restart_sage(self):
@@ -3712,10 +3912,7 @@ except (KeyError, IOError):
         """
         Gets a pre-existing cell with this id, or returns None. 
         """
-        for c in self.cell_list():
-            if c.id() == id:
-                return c
-        return None
+        return self.cell_list().cell(id)
         
     def get_cell_with_id(self, id):
         """
@@ -4332,6 +4529,65 @@ def ignore_prompts_and_output(aString):
             new += after_first_word(line) + '\n'
     return new
 
+def parse_worksheet_text(text):
+    r"""
+    Split the plain text ``text`` of a worksheet into its text blocks
+    and compute cells.
+
+    This is the same as repeatedly applying
+    :func:`extract_text_before_first_compute_cell` and
+    :func:`extract_first_compute_cell`, but it scans ``text`` once
+    instead of copying the rest of it for each cell.
+
+    OUTPUT:
+
+    - a list of pairs ``('plain', text)``, with nonempty stripped
+      ``text``, and ``('compute', (meta, input, output))``
+
+    EXAMPLES::
+
+        sage: from sagenb.notebook.worksheet import parse_worksheet_text
+        sage: parse_worksheet_text('<p>Hi</p>\n{{{id=3|\n2+3\n///\n5\n}}}\n{{{\nfactor(6)\n}}}')
+        [('plain', '<p>Hi</p>'), ('compute', ({'id': 3}, '2+3', '\n5')), ('compute', ({}, 'factor(6)', ''))]
+    """
+    data = []
+    n = len(text)
+    pos = 0
+    while True:
+        i = text.find('{{{', pos)
+        plain_text = (text[pos:] if i == -1 else text[pos:i]).strip()
+        if len(plain_text) > 0:
+            data.append(('plain', plain_text))
+        if i == -1:
+            break
+        j = text.find('\n', i)
+        if j == -1:
+            break
+        k = text.find('|', i, j)
+        if k != -1:
+            try:
+                meta = dictify(text[i + 3:k])
+            except TypeError:
+                meta = {}
+            i = k + 1
+        else:
+            meta = {}
+            i += 3
+
+        j = text.find('\n}}}', i)
+        if j == -1:
+            j = n
+        k = text.find('\n///', i, j)
+        if k == -1:
+            input = text[i:j]
+            output = ''
+        else:
+            input = text[i:k].strip()
+            output = text[k + 4:j]
+        data.append(('compute', (meta, input.strip(), output)))
+        pos = j + 4
+    return data
+
 def extract_text_before_first_compute_cell(text):
     """
     OUTPUT: Everything in text up to the first {{{.
@@ -34,23 +34,44 @@ class Datastore(object):
     def save_openid(self, openid_dict):
         raise NotImplementedError
 
-    def load_users(self):
+    def load_users(self, user_manager):
         """
+        Load the users into ``user_manager``, or let it load them
+        when needed (see :meth:`UserManager.set_datastore`).
+
         OUTPUT:
 
-            - dictionary of user info
+            - ``user_manager``
+        """
+        raise NotImplementedError
+
+    def load_user(self, username):
+        """
+        Return the user with given username, or raise a LookupError.
+        Only needed by datastores whose :meth:`load_users` calls
+        :meth:`UserManager.set_datastore`.
+        """
+        raise NotImplementedError
+
+    def usernames(self):
+        """
+        Return the list of the names of all saved users.  Only needed
+        by datastores whose :meth:`load_users` calls
+        :meth:`UserManager.set_datastore`.
         """
         raise NotImplementedError
     
-    def save_users(self, users):
+    def save_users(self, users, deleted=()):
         """
         INPUT:
 
             - ``users`` -- dictionary mapping user names to users
+
+            - ``deleted`` -- list of user names of deleted users
         """
         raise NotImplementedError
 
-    def load_user_history(self, username):
+    def load_user_history(self, username, maxlen=None):
         """
         Return the history log for the given user.
 
@@ -58,6 +79,9 @@ class Datastore(object):
 
             - ``username`` -- string
 
+            - ``maxlen`` -- None or integer; if given, only return
+              (at most) the last ``maxlen`` entries
+
         OUTPUT:
 
             - list of strings
@@ -75,7 +99,72 @@ class Datastore(object):
             - ``history`` -- list of strings
         """
         raise NotImplementedError        
+
+    def append_user_history(self, username, entries):
+        """
+        Append entries to the history log of the given user.
+
+        Datastores should override this if they can write only the
+        new entries.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``entries`` -- list of strings
+        """
+        history = self.load_user_history(username)
+        self.save_user_history(username, history + list(entries))
+
+    def compact_user_history(self, username, maxlen):
+        """
+        Allow the datastore to forget all but the last ``maxlen``
+        entries of the history log of the given user.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``maxlen`` -- integer
+        """
+        history = self.load_user_history(username)
+        if len(history) > maxlen:
+            self.save_user_history(username, history[len(history) - maxlen:])
         
+    def worksheet_listing_rows(self, username, copy=True):
+        """
+        Return a dictionary mapping the id numbers of the worksheets of
+        the given user to their listing rows (see
+        :func:`sagenb.notebook.worksheet.listing_row`).  If ``copy`` is
+        False, the dictionary must not be modified.
+
+        Datastores should override this if they can avoid loading the
+        worksheets.
+        """
+        from sagenb.notebook.worksheet import listing_row
+        return dict([(W.id_number(), listing_row(W.basic()))
+                     for W in self.worksheets(username)])
+
+    def worksheet_listing_order(self, username, sort, viewer=None, view=None,
+                                copy=True):
+        """
+        Return the list of pairs ``(key, id_number)`` of the worksheets
+        of the given user, sorted by the key of their listing rows for
+        ``sort`` (see ``LISTING_SORTS`` in
+        :mod:`sagenb.notebook.worksheet`), in increasing order.  If
+        ``viewer`` is given, only the worksheets in the ``view`` of
+        the user ``viewer`` are listed.  If ``copy`` is False, the list
+        must not be modified.
+
+        Datastores should override this if they can keep the orders
+        sorted.
+        """
+        from sagenb.notebook.worksheet import listing_view, LISTING_SORTS
+        sort_key = LISTING_SORTS[sort][0]
+        return sorted([(sort_key(row), id_number) for id_number, row
+                       in self.worksheet_listing_rows(username).items()
+                       if viewer is None or listing_view(row, viewer) == view])
+
     def save_worksheet(self, worksheet, conf_only=False):
         """
         INPUT:
@@ -143,12 +232,73 @@ class Datastore(object):
         """
         raise NotImplementedError        
         
-    def worksheets(self, username):
+    def delete_worksheet(self, username, id_number, remove_files=True):
+        """
+        Delete the worksheet with given id_number belonging to the
+        given user, together with all of its files.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+
+            - ``remove_files`` -- bool (default: True); if False, the
+              worksheet is deleted at once, but its files are only
+              removed by :meth:`remove_deleted_files`
+
+        OUTPUT:
+
+            - None, or if ``remove_files`` is False, the object to
+              pass to :meth:`remove_deleted_files`
+        """
+        raise NotImplementedError
+
+    def remove_deleted_files(self, deleted):
+        """
+        Remove the files of a worksheet deleted with
+        ``remove_files=False``; ``deleted`` is the value returned by
+        :meth:`delete_worksheet`.
+        """
+        pass
+
+    def worksheet_index(self, username):
+        """
+        Return the metadata index of the worksheets belonging to the
+        user with given name.
+
+        INPUT:
+
+            - ``username`` -- string
+
+        OUTPUT:
+
+            - dictionary mapping id numbers to the basic Python
+              objects (see ``Worksheet.basic``) of the worksheets
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.abstract_storage import Datastore
+            sage: Datastore().worksheet_index('foobar')
+            Traceback (most recent call last):
+            ...
+            NotImplementedError
+        """
+        raise NotImplementedError
+
+    def worksheets(self, username, id_numbers=None):
         """
         Return list of all the worksheets belonging to the user with
         given name.  If the given user does not exists, an empty list
         is returned.
 
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_numbers`` -- default: None; if given, an iterable
+              of id numbers, and only those worksheets are returned
+
         EXAMPLES: The load_user_data function must be defined in the
         derived class::
         
@@ -160,6 +310,47 @@ class Datastore(object):
         """
         raise NotImplementedError
 
+    def search_worksheets(self, search):
+        """
+        Return the set of filenames of the worksheets that may satisfy
+        the given search, or None if the search cannot be narrowed
+        down.  Every worksheet that satisfies the search must be in
+        the set.
+
+        INPUT:
+
+            - ``search`` -- string; see ``Worksheet.satisfies_search``
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.abstract_storage import Datastore
+            sage: Datastore().search_worksheets('foo')
+            Traceback (most recent call last):
+            ...
+            NotImplementedError
+        """
+        raise NotImplementedError
+
+    def index_worksheet(self, worksheet):
+        """
+        Update the search index with the saved contents of the given
+        worksheet.
+        """
+        raise NotImplementedError
+
+    def save_search_index(self):
+        """
+        Save the search index, if it changed.
+        """
+        raise NotImplementedError
+
+    def write_batch(self):
+        """
+        Return a context manager grouping the files written in its
+        block, so that they are synced to disk together when it ends.
+        """
+        raise NotImplementedError
+
     def delete(self):
         """
         Delete all files associated with this datastore.  Dangerous!
@@ -13,12 +13,21 @@ Sage notebook server::
 
     sage_notebook.sagenb
          conf.pickle
-         users.pickle
+         users/
+             index.pickle
+             00.pickle
+             ...
+             ff.pickle
          openid.pickle (optional)
          readonly.txt (optional)
+         search_index.pickle (optional)
          home/
              username0/
-                history.pickle
+                history/
+                    00000000.log
+                    00000001.log
+                    ...
+                worksheet_index.pickle
                 id_number0/
                     worksheet.html
                     worksheet_conf.pickle
@@ -34,25 +43,52 @@ Sage notebook server::
                 ...
              username1/
              ...
-             
+
+The history of a user is a journal split into segments of
+``HISTORY_SEGMENT_LENGTH`` entries, which are only ever appended to;
+each entry is written as its length in bytes on a line, followed by
+the UTF-8 encoded entry and a newline.  Old segments are deleted as a
+whole once the history is longer than needed.  (Older notebooks kept
+the whole history in a single ``history.pickle``, which is converted
+on first use.)
+
+The user accounts are split into shards by the first two hex digits
+of the md5 hash of the username, and ``users/index.pickle`` maps each
+username to its shard, so that a user is loaded by reading a single
+small file.  (Older notebooks kept all accounts in ``users.pickle``,
+which is converted when the users are loaded.)
 """
 
+import bisect
 import copy
+import errno
 import shutil
 import tarfile
 import tempfile
+import threading
 import os
 try:
    import cPickle as pickle
 except ImportError:
    import pickle
+from contextlib import contextmanager
+from hashlib import md5
 from six import iteritems
 
 from .abstract_storage import Datastore
+from .search_index import SearchIndex, search_text
 from sagenb.misc.misc import set_restrictive_permissions, encoded_str
 
 from sage.misc.temporary_file import atomic_write
 
+# the permissions of files written in a batch (see write_batch), as
+# for other newly created files
+_umask = os.umask(0)
+os.umask(_umask)
+
+# the number of history entries in each history segment
+HISTORY_SEGMENT_LENGTH = 100
+
 def is_safe(a):
     """
     Used when importing contents of various directories from Sage
@@ -85,9 +121,34 @@ class FilesystemDatastore(Datastore):
         self._home_path = 'home'
         self._conf_filename = 'conf.pickle'
         self._users_filename = 'users.pickle'
+        self._users_path = 'users'
+        # username --> shard, and shard --> {username: basic user},
+        # loaded on demand
+        self._user_index = None
+        self._user_shards = {}
+        self._users_lock = threading.RLock()
         self._readonly_filename = 'readonly.txt'
         self._readonly_mtime = 0
         self._readonly = None
+        # worksheet metadata indexes, loaded on demand (see worksheet_index)
+        self._worksheet_indexes = {}
+        self._index_lock = threading.RLock()
+        # username --> {id_number: listing row}, see worksheet_listing_rows
+        self._listing_rows = {}
+        # username --> {(sort, viewer, view): sorted list of (key,
+        # id_number)}, see worksheet_listing_order
+        self._listing_orders = {}
+        # full text search index, loaded on demand (see search_index)
+        self._search_index_filename = 'search_index.pickle'
+        self._search_index = None
+        # digests of the pickles last written by _save_if_changed
+        self._digests = {}
+        # files written in the current batch of each thread (see write_batch)
+        self._batch = threading.local()
+        # username --> (number of the last history segment, its length)
+        self._history_segment = {}
+        self._history_lock = threading.RLock()
+        self._remove_leftover_deleted_files()
 
     def __repr__(self):
         return "Filesystem Sage Notebook Datastore at %s"%self._path
@@ -158,9 +219,19 @@ class FilesystemDatastore(Datastore):
     def _worksheet_html_filename(self, username, id_number):
         return os.path.join(self._worksheet_path(username, id_number), 'worksheet.html')
 
+    def _worksheet_index_filename(self, username):
+        return os.path.join(self._user_path(username), 'worksheet_index.pickle')
+
     def _history_filename(self, username):
+        # only used by old notebooks, see _history_segments
         return os.path.join(self._user_path(username), 'history.pickle')
 
+    def _history_path(self, username):
+        return self._makepath(os.path.join(self._user_path(username), 'history'))
+
+    def _history_segment_filename(self, username, number):
+        return os.path.join(self._history_path(username), '%08d.log' % number)
+
     def _abspath(self, file):
         """
         Return absolute path to filename got by joining self._path
@@ -215,8 +286,139 @@ class FilesystemDatastore(Datastore):
         s = pickle.dumps(obj)
         if len(s) == 0:
             raise ValueError("Invalid Pickle")
-        with atomic_write(self._abspath(filename), binary=True) as f:
-            f.write(s)
+        self._write(s, filename)
+
+    def _save_if_changed(self, obj, filename):
+        """
+        Save ``obj`` like :meth:`_save`, unless exactly the same pickle
+        was last written to ``filename`` by this method.  Return True
+        if the file was written.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.filesystem_storage import FilesystemDatastore
+            sage: D = FilesystemDatastore(tmp_dir())
+            sage: D._save_if_changed([1, 2], 'a.pickle')
+            True
+            sage: D._save_if_changed([1, 2], 'a.pickle')
+            False
+            sage: D._save_if_changed([1, 2, 3], 'a.pickle')
+            True
+        """
+        s = pickle.dumps(obj)
+        if len(s) == 0:
+            raise ValueError("Invalid Pickle")
+        digest = md5(s).digest()
+        if self._digests.get(filename) == digest:
+            return False
+        self._write(s, filename)
+        self._digests[filename] = digest
+        return True
+
+    def _write(self, data, filename):
+        """
+        Atomically replace the contents of the file ``filename`` by the
+        string ``data``.  Inside :meth:`write_batch`, the file is only
+        synced to disk when the batch ends.
+        """
+        path = self._abspath(filename)
+        pending = getattr(self._batch, 'files', None)
+        if pending is None:
+            with atomic_write(path, binary=True) as f:
+                f.write(data)
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix='.' + os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o666 & ~_umask)
+            # Renamed now, while the caller still holds the locks it
+            # wrote under, so that a newer version written later by
+            # another thread is never replaced by this one.
+            os.rename(tmp, path)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        pending.add(path)
+
+    @contextmanager
+    def write_batch(self):
+        """
+        Context manager grouping the files written in its block by the
+        current thread.  Each file is replaced atomically as usual, but
+        the files are only synced to disk when the block ends, together
+        with each directory involved, once.  This is much cheaper than
+        syncing each file separately.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.filesystem_storage import FilesystemDatastore
+            sage: D = FilesystemDatastore(tmp_dir())
+            sage: with D.write_batch():
+            ....:     D._save('a', 'a.pickle')
+            ....:     D._save('b', 'b.pickle')
+            ....:     D._save('c', 'a.pickle')
+            ....:     D._load('a.pickle')
+            'c'
+            sage: D._load('a.pickle'), D._load('b.pickle')
+            ('c', 'b')
+            sage: sorted(os.listdir(D._path))
+            ['a.pickle', 'b.pickle', 'home']
+        """
+        if getattr(self._batch, 'files', None) is not None:
+            # nested batch
+            yield
+            return
+        self._batch.files = pending = set()
+        # the users whose worksheet index changed; each index is only
+        # saved once, at the end of the batch
+        self._batch.indexes = indexes = set()
+        try:
+            yield
+            self._batch.indexes = None
+            for username in indexes:
+                with self._index_lock:
+                    self._save_worksheet_index(username,
+                                               self.worksheet_index(username, copy=False))
+        finally:
+            self._batch.files = self._batch.indexes = None
+            self._sync_files(pending)
+
+    def _sync_files(self, paths):
+        """
+        Sync the files ``paths`` and their directories to disk.  Files
+        deleted in the meantime are skipped.
+        """
+        directories = set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError as msg:
+                # e.g., the worksheet was deleted in the meantime
+                if msg.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path))
+        for d in directories:
+            try:
+                fd = os.open(d, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                # not supported on all platforms
+                pass
+            finally:
+                os.close(fd)
 
     def _permissions(self, filename):
         f = self._abspath(filename)
@@ -271,8 +473,8 @@ class FilesystemDatastore(Datastore):
             - ``server`` --
         """
         basic = self._server_conf_to_basic(server_conf)
-        self._save(basic, 'conf.pickle')
-        self._permissions('conf.pickle')
+        if self._save_if_changed(basic, 'conf.pickle'):
+            self._permissions('conf.pickle')
 
     def load_openid(self):
         """
@@ -284,14 +486,85 @@ class FilesystemDatastore(Datastore):
         """
         Saves an open_id dict to the disk.
         """
-        self._save(openid_dict, 'openid.pickle')
-        self._permissions('openid.pickle')
+        if self._save_if_changed(openid_dict, 'openid.pickle'):
+            self._permissions('openid.pickle')
+
+    def _user_shard(self, username):
+        return md5(encoded_str(username)).hexdigest()[:2]
+
+    def _user_shard_filename(self, shard):
+        return os.path.join(self._users_path, '%s.pickle' % shard)
+
+    def _load_user_index(self):
+        """
+        Return the dictionary mapping usernames to shards, converting
+        an old ``users.pickle`` first.
+        """
+        with self._users_lock:
+            if self._user_index is not None:
+                return self._user_index
+            self._makepath(self._users_path)
+            index_filename = os.path.join(self._users_path, 'index.pickle')
+            if os.path.exists(self._abspath(index_filename)):
+                self._user_index = self._load(index_filename)
+            else:
+                self._user_index = {}
+                if os.path.exists(self._abspath(self._users_filename)):
+                    users = self._load(self._users_filename)
+                    with self.write_batch():
+                        self._save_user_records(dict(users), ())
+                    os.unlink(self._abspath(self._users_filename))
+            return self._user_index
+
+    def _load_user_shard(self, shard):
+        with self._users_lock:
+            try:
+                return self._user_shards[shard]
+            except KeyError:
+                pass
+            filename = self._user_shard_filename(shard)
+            if os.path.exists(self._abspath(filename)):
+                records = dict(self._load(filename))
+            else:
+                records = {}
+            self._user_shards[shard] = records
+            return records
+
+    def _save_user_records(self, records, deleted):
+        """
+        Write the basic user records ``records`` (a dictionary), and
+        delete the users in ``deleted``.  Only the shards whose
+        contents changed are written.
+        """
+        with self._users_lock:
+            index = self._load_user_index()
+            shards = set()
+            for username, basic in iteritems(records):
+                shard = self._user_shard(username)
+                self._load_user_shard(shard)[username] = basic
+                shards.add(shard)
+                index[username] = shard
+            for username in deleted:
+                shard = index.pop(username, None)
+                if shard is not None:
+                    self._load_user_shard(shard).pop(username, None)
+                    shards.add(shard)
+            for shard in shards:
+                filename = self._user_shard_filename(shard)
+                if self._save_if_changed(sorted(self._user_shards[shard].items()), filename):
+                    self._permissions(filename)
+            filename = os.path.join(self._users_path, 'index.pickle')
+            if self._save_if_changed(index, filename):
+                self._permissions(filename)
 
     def load_users(self, user_manager):
         """
+        Let ``user_manager`` load its users from this datastore, when
+        they are needed (see :meth:`load_user`).
+
         OUTPUT:
 
-            - dictionary of user info
+            - ``user_manager``
         
         EXAMPLES::
         
@@ -302,22 +575,61 @@ class FilesystemDatastore(Datastore):
             sage: from sagenb.storage import FilesystemDatastore
             sage: ds = FilesystemDatastore(tmp_dir())
             sage: ds.save_users(users)
-            sage: 'users.pickle' in os.listdir(ds._path)
-            True
+            sage: sorted(os.listdir(os.path.join(ds._path, 'users')))
+            ['21.pickle', 'e5.pickle', 'index.pickle']
+            sage: ds = FilesystemDatastore(ds._path)
             sage: users = ds.load_users(U)
-            sage: U.users()
-            {'admin': admin, 'wstein': wstein}
+            sage: U.loaded_users()
+            {}
+            sage: sorted(U.usernames())
+            ['admin', 'wstein']
+            sage: U.user('wstein')
+            wstein
+            sage: U.loaded_users()
+            {'wstein': wstein}
         """
-        for user in self._basic_to_users(self._load('users.pickle')).values():
-            user_manager.add_user_object(user, force=True) 
-            user_manager.set_password(user.username(), user.password(), encrypt = False)
+        user_manager.set_datastore(self)
         return user_manager
-    
-    def save_users(self, users):
+
+    def load_user(self, username):
+        """
+        Return the user with given username.
+
+        INPUT:
+
+            - ``username`` -- string
+
+        OUTPUT:
+
+            - a :class:`sagenb.notebook.user.User`; a LookupError is
+              raised if there is no such user
+        """
+        from sagenb.notebook.user import User_from_basic
+        with self._users_lock:
+            shard = self._load_user_index().get(username)
+            if shard is not None:
+                basic = self._load_user_shard(shard).get(username)
+                if basic is not None:
+                    return User_from_basic(basic)
+        raise LookupError("no user '{}'".format(username))
+
+    def usernames(self):
         """
+        Return the list of the names of all saved users.
+        """
+        with self._users_lock:
+            return list(self._load_user_index())
+
+    def save_users(self, users, deleted=()):
+        """
+        Save the given users.  Users that are not given are not
+        changed, unless they are in ``deleted``.
+
         INPUT:
 
             - ``users`` -- dictionary mapping user names to users
+
+            - ``deleted`` -- list of user names of deleted users
         
         EXAMPLES::
         
@@ -328,35 +640,201 @@ class FilesystemDatastore(Datastore):
             sage: from sagenb.storage import FilesystemDatastore
             sage: ds = FilesystemDatastore(tmp_dir())
             sage: ds.save_users(users)
-            sage: 'users.pickle' in os.listdir(ds._path)
-            True
+            sage: ds.save_users({}, deleted=['admin'])
             sage: users = ds.load_users(U)
             sage: U.users()
-            {'admin': admin, 'wstein': wstein}
+            {'wstein': wstein}
         """
-        self._save(self._users_to_basic(users), 'users.pickle')
-        self._permissions('users.pickle')
+        self._save_user_records(dict([(name, U.basic()) for name, U in iteritems(users)]),
+                                deleted)
         
-    def load_user_history(self, username):
+    def _history_segments(self, username):
+        """
+        Return the sorted list of the numbers of the history segments
+        of the given user, first converting an old ``history.pickle``.
+        """
+        legacy = self._history_filename(username)
+        if os.path.exists(self._abspath(legacy)):
+            path = self._abspath(self._history_path(username))
+            if not os.listdir(path):
+                history = self._load(legacy)
+                numbers = range(0, len(history), HISTORY_SEGMENT_LENGTH)
+                for i in numbers:
+                    self._append_history_entries(username, i // HISTORY_SEGMENT_LENGTH,
+                                                 history[i:i + HISTORY_SEGMENT_LENGTH])
+                # inside a batch, the segments are not synced yet
+                self._sync_files([self._abspath(self._history_segment_filename(
+                    username, i // HISTORY_SEGMENT_LENGTH)) for i in numbers])
+            os.unlink(self._abspath(legacy))
+        path = self._abspath(self._history_path(username))
+        return sorted([int(F[:-4]) for F in os.listdir(path)
+                       if F.endswith('.log') and F[:-4].isdigit()])
+
+    def _read_history_segment(self, username, number, repair=False):
         """
+        Return the list of entries of a history segment.  A truncated
+        last entry (from an interrupted write) is ignored, and removed
+        from the file if ``repair`` is True.
+        """
+        filename = self._abspath(self._history_segment_filename(username, number))
+        with open(filename, 'rb') as f:
+            data = f.read()
+        entries = []
+        i = 0
+        while True:
+            j = data.find('\n', i)
+            if j == -1 or not data[i:j].isdigit():
+                break
+            k = j + 1 + int(data[i:j])
+            if k >= len(data):
+                break
+            entries.append(data[j + 1:k].decode('utf-8'))
+            i = k + 1
+        if repair and i < len(data):
+            with open(filename, 'r+b') as f:
+                f.truncate(i)
+        return entries
+
+    def _append_history_entries(self, username, number, entries):
+        """
+        Append ``entries`` to the history segment with the given
+        number, and sync it to disk (when the batch ends, inside
+        :meth:`write_batch`).
+        """
+        filename = self._abspath(self._history_segment_filename(username, number))
+        data = []
+        for entry in entries:
+            entry = encoded_str(entry)
+            data.append('%d\n%s\n' % (len(entry), entry))
+        new = not os.path.exists(filename)
+        pending = getattr(self._batch, 'files', None)
+        with open(filename, 'ab') as f:
+            f.write(''.join(data))
+            f.flush()
+            if pending is None:
+                os.fsync(f.fileno())
+        if pending is not None:
+            pending.add(filename)
+        if new:
+            set_restrictive_permissions(filename, allow_execute=False)
+
+    def load_user_history(self, username, maxlen=None):
+        r"""
         Return the history log for the given user.
 
+        Only the history segments containing the last ``maxlen``
+        entries are read.
+
         INPUT:
 
             - ``username`` -- string
 
+            - ``maxlen`` -- None or integer; if given, only return
+              (at most) the last ``maxlen`` entries
+
         OUTPUT:
 
             - list of strings
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: D = FilesystemDatastore(tmp_dir())
+            sage: D.load_user_history('sage')
+            []
+            sage: D.append_user_history('sage', ['%s+%s' % (i, i) for i in range(250)])
+            sage: D.append_user_history('sage', [u'\xe9\n'])
+            sage: H = D.load_user_history('sage'); len(H), H[0], H[-1]
+            (251, u'0+0', u'\xe9\n')
+            sage: D.load_user_history('sage', 2)
+            [u'249+249', u'\xe9\n']
+            sage: D.load_user_history('sage', 0)
+            []
         """
-        filename = self._history_filename(username)
-        if not os.path.exists(self._abspath(filename)):
-            return []
-        return self._load(filename)
+        with self._history_lock:
+            history = []
+            for number in reversed(self._history_segments(username)):
+                if maxlen is not None and len(history) >= maxlen:
+                    break
+                history[:0] = self._read_history_segment(username, number)
+        if maxlen is not None:
+            history = history[len(history) - maxlen:] if maxlen > 0 else []
+        return history
+
+    def append_user_history(self, username, entries):
+        """
+        Append entries to the history log of the given user.  Only
+        the new entries are written.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``entries`` -- list of strings
+        """
+        with self._history_lock:
+            try:
+                number, length = self._history_segment[username]
+            except KeyError:
+                segments = self._history_segments(username)
+                if segments:
+                    number = segments[-1]
+                    length = len(self._read_history_segment(username, number,
+                                                            repair=True))
+                else:
+                    number, length = 0, 0
+            entries = list(entries)
+            while entries:
+                if length >= HISTORY_SEGMENT_LENGTH:
+                    number, length = number + 1, 0
+                n = HISTORY_SEGMENT_LENGTH - length
+                self._append_history_entries(username, number, entries[:n])
+                length += len(entries[:n])
+                del entries[:n]
+            self._history_segment[username] = (number, length)
+
+    def compact_user_history(self, username, maxlen):
+        """
+        Delete the history segments of the given user that only
+        contain entries older than the last ``maxlen`` ones.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``maxlen`` -- integer
+
+        EXAMPLES::
+
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: D = FilesystemDatastore(tmp_dir())
+            sage: D.append_user_history('sage', [str(i) for i in range(450)])
+            sage: D.compact_user_history('sage', 120)
+            sage: sorted(os.listdir(D._abspath(D._history_path('sage'))))
+            ['00000003.log', '00000004.log']
+            sage: len(D.load_user_history('sage')), D.load_user_history('sage', 120)[0]
+            (150, u'330')
+        """
+        with self._history_lock:
+            segments = self._history_segments(username)
+            if not segments:
+                return
+            try:
+                length = self._history_segment[username][1]
+            except KeyError:
+                length = len(self._read_history_segment(username, segments[-1]))
+            # all segments except the last one are full
+            keep = 1
+            while length < maxlen and keep < len(segments):
+                length += HISTORY_SEGMENT_LENGTH
+                keep += 1
+            for number in segments[:-keep]:
+                os.unlink(self._abspath(self._history_segment_filename(username, number)))
 
     def save_user_history(self, username, history):
         """
-        Save the history log (a list of strings) for the given user.
+        Save the history log (a list of strings) for the given user,
+        replacing the previous one.
 
         INPUT:
 
@@ -364,10 +842,12 @@ class FilesystemDatastore(Datastore):
 
             - ``history`` -- list of strings
         """
-        filename = self._history_filename(username)
-        self._save(history, filename)
-        self._permissions(filename)
-        
+        with self._history_lock:
+            for number in self._history_segments(username):
+                os.unlink(self._abspath(self._history_segment_filename(username, number)))
+            self._history_segment.pop(username, None)
+            self.append_user_history(username, history)
+
     def save_worksheet(self, worksheet, conf_only=False):
         """
         INPUT:
@@ -387,17 +867,38 @@ class FilesystemDatastore(Datastore):
             sage: DS.save_worksheet(W)
         """
         username = worksheet.owner(); id_number = worksheet.id_number()
+        version = worksheet.listing_version()
         basic = self._worksheet_to_basic(worksheet)
-        if not hasattr(worksheet, '_last_basic') or worksheet._last_basic != basic:
+        # _last_basic shares lists (e.g., the ratings) with the
+        # worksheet, so changes made to these in place only show in
+        # the listing version
+        if (not hasattr(worksheet, '_last_basic') or worksheet._last_basic != basic or
+                getattr(worksheet, '_listed_version', None) != version):
             # only save if changed
             self._save(basic, self._worksheet_conf_filename(username, id_number))
             worksheet._last_basic = basic
+            self._update_worksheet_index(username, id_number, basic)
+            reindex = self._search_index is not None
+        else:
+            reindex = False
+        # the listing row in the index is now up to date
+        worksheet._listed_version = version
         if not conf_only and worksheet.body_is_loaded():
-            # only save if loaded
-            # todo -- add check if changed
+            # only save if loaded and changed
+            body = worksheet.body()
+            data = body.encode('utf-8', 'ignore')
+            # a worksheet may be saved to more than one datastore
+            digest = (self._path, md5(data).digest())
+        else:
+            digest = None
+        if digest is not None and getattr(worksheet, '_last_body_digest', None) != digest:
             filename = self._worksheet_html_filename(username, id_number)
-            with atomic_write(self._abspath(filename)) as f:
-                f.write(worksheet.body().encode('utf-8', 'ignore'))
+            self._write(data, filename)
+            worksheet._last_body_digest = digest
+            if self._search_index is not None:
+                self._index_worksheet(username, id_number, basic, body)
+        elif reindex:
+            self._index_worksheet(username, id_number, basic)
 
     def create_worksheet(self, username, id_number):
         """
@@ -459,6 +960,7 @@ class FilesystemDatastore(Datastore):
             basic['id_number'] = id_number
             W = self._basic_to_worksheet(basic)
             W._last_basic = basic   # cache
+            W._listed_version = W.listing_version()
         except Exception:
             #the worksheet conf loading didn't work, so we make up one
             import traceback
@@ -618,14 +1120,332 @@ class FilesystemDatastore(Datastore):
         
         T.close()
         
-        return self.load_worksheet(username, id_number)
+        W = self.load_worksheet(username, id_number)
+        self._update_worksheet_index(username, id_number, W.basic())
+        return W
+
+    def delete_worksheet(self, username, id_number, remove_files=True):
+        """
+        Delete the worksheet with given id_number belonging to the
+        given user, together with all of its files.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_number`` -- integer
+
+            - ``remove_files`` -- bool (default: True); if False, the
+              directory of the worksheet is only moved to the
+              ``deleted`` directory of the datastore, and its new name
+              is returned, to be removed with
+              :meth:`remove_deleted_files` (e.g., in the background)
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: W = Worksheet('test', 2, tmp, owner='sageuser')
+            sage: DS.save_worksheet(W)
+            sage: DS.delete_worksheet('sageuser', 2)
+            sage: DS.worksheets('sageuser')
+            []
+            sage: DS.save_worksheet(Worksheet('test', 3, tmp, owner='sageuser'))
+            sage: deleted = DS.delete_worksheet('sageuser', 3, remove_files=False)
+            sage: DS.worksheets('sageuser'), os.path.isdir(deleted)
+            ([], True)
+            sage: DS.remove_deleted_files(deleted)
+            sage: os.path.exists(deleted)
+            False
+        """
+        path = self._abspath(self._worksheet_pathname(username, id_number))
+        if remove_files:
+            shutil.rmtree(path, ignore_errors=False)
+            deleted = None
+        else:
+            deleted = self._makepath('deleted')
+            deleted = tempfile.mkdtemp(prefix='%s-%s-' % (username, id_number),
+                                       dir=self._abspath(deleted))
+            os.rename(path, os.path.join(deleted, 'worksheet'))
+        self._update_worksheet_index(username, id_number, None)
+        if self._search_index is not None:
+            self._search_index.remove('%s/%s' % (username, id_number))
+        return deleted
+
+    def remove_deleted_files(self, deleted):
+        shutil.rmtree(deleted, ignore_errors=True)
+
+    def _remove_leftover_deleted_files(self):
+        """
+        Remove what is left in the ``deleted`` directory, i.e., the
+        files of worksheets deleted with ``remove_files=False`` (e.g.,
+        by a bulk operation of the notebook) that were not removed
+        before the server stopped.  This is done when the datastore is
+        opened.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: DS.save_worksheet(Worksheet('test', 2, tmp, owner='sageuser'))
+            sage: deleted = DS.delete_worksheet('sageuser', 2, remove_files=False)
+            sage: os.path.isdir(deleted)
+            True
+            sage: DS = FilesystemDatastore(tmp)
+            sage: os.path.exists(deleted), os.listdir(os.path.join(tmp, 'deleted'))
+            (False, [])
+        """
+        path = self._abspath('deleted')
+        if not os.path.isdir(path):
+            return
+        for name in os.listdir(path):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    #########################################################################
+    # The worksheet metadata index.
+    #
+    # For each user we keep a pickle of a dictionary mapping id
+    # numbers to the basic Python objects of the worksheets of that
+    # user.  It is kept up to date by save_worksheet, import_worksheet
+    # and delete_worksheet, so that listing the worksheets of a user
+    # does not require unpickling the conf of each one of them.
+    #########################################################################
+    def _update_worksheet_index(self, username, id_number, basic):
+        """
+        Record ``basic`` as the metadata of the worksheet
+        username/id_number in the index, or remove the worksheet from
+        the index if ``basic`` is None.
+        """
+        from sagenb.notebook.worksheet import listing_row, listing_view, LISTING_SORTS
+        with self._index_lock:
+            index = self.worksheet_index(username, copy=False)
+            rows = self._listing_rows.get(str(username))
+            if basic is None:
+                if index.pop(id_number, None) is None:
+                    return
+                row = None
+            else:
+                index[id_number] = self._copy_basic(basic)
+                row = listing_row(basic)
+            if rows is not None:
+                old = rows.pop(id_number, None)
+                if row is not None:
+                    rows[id_number] = row
+                # keep the sort orders sorted
+                for (sort, viewer, view), order in iteritems(self._listing_orders.get(str(username), {})):
+                    sort_key = LISTING_SORTS[sort][0]
+                    if old is not None and (viewer is None or listing_view(old, viewer) == view):
+                        entry = (sort_key(old), id_number)
+                        i = bisect.bisect_left(order, entry)
+                        if i < len(order) and order[i] == entry:
+                            del order[i]
+                    if row is not None and (viewer is None or listing_view(row, viewer) == view):
+                        bisect.insort(order, (sort_key(row), id_number))
+            self._save_worksheet_index(username, index)
+
+    def _save_worksheet_index(self, username, index):
+        indexes = getattr(self._batch, 'indexes', None)
+        if indexes is not None:
+            indexes.add(username)
+            return
+        filename = self._worksheet_index_filename(username)
+        self._save(index, filename)
+        self._permissions(filename)
+
+    def _copy_basic(self, obj):
+        # basic objects are nested dictionaries and lists, so a pickle
+        # round trip is the quickest way to get a deep copy.
+        return pickle.loads(pickle.dumps(obj, 2))
+
+    def _rebuild_worksheet_index(self, username, index):
+        """
+        Bring ``index`` in sync with the worksheet directories of the
+        given user.  Return True if the index changed.
+        """
+        path = self._abspath(self._user_path(username))
+        on_disk = set(int(a) for a in os.listdir(path) if a.isdigit())
+        changed = False
+        for id_number in set(index).difference(on_disk):
+            del index[id_number]
+            changed = True
+        for id_number in on_disk.difference(index):
+            html_file = self._abspath(self._worksheet_html_filename(username, id_number))
+            if not os.path.exists(html_file):
+                # not (yet) a complete worksheet
+                continue
+            try:
+                index[id_number] = self._copy_basic(self.load_worksheet(username, id_number).basic())
+                changed = True
+            except Exception:
+                import traceback
+                print("Warning: problem loading %s/%s: %s" % (username, id_number, traceback.format_exc()))
+        return changed
+
+    def worksheet_index(self, username, copy=True):
+        """
+        Return the metadata index of the worksheets belonging to the
+        user with given name.
+
+        The index is read from disk only the first time it is
+        requested; at that point it is also checked against the
+        worksheet directories of the user and repaired if needed.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``copy`` -- default: True; if False return the cached
+              index itself, which must then not be modified
+
+        OUTPUT:
+
+            - dictionary mapping id numbers to the basic Python
+              objects (see ``Worksheet.basic``) of the worksheets
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: DS.worksheet_index('sageuser')
+            {}
+            sage: W = Worksheet('test', 2, tmp, owner='sageuser')
+            sage: DS.save_worksheet(W)
+            sage: DS.worksheet_index('sageuser')[2]['name']
+            u'test'
+
+        The index survives a restart::
+
+            sage: FilesystemDatastore(tmp).worksheet_index('sageuser').keys()
+            [2]
+        """
+        username = str(username)
+        with self._index_lock:
+            try:
+                index = self._worksheet_indexes[username]
+            except KeyError:
+                filename = self._worksheet_index_filename(username)
+                try:
+                    index = self._load(filename)
+                except Exception:
+                    index = {}
+                self._worksheet_indexes[username] = index
+                if self._rebuild_worksheet_index(username, index):
+                    self._save_worksheet_index(username, index)
+            if copy:
+                return self._copy_basic(index)
+            return index
+
+    def worksheet_listing_rows(self, username, copy=True):
+        """
+        Return a dictionary mapping the id numbers of the worksheets of
+        the given user to their listing rows (see
+        :func:`sagenb.notebook.worksheet.listing_row`), which are
+        computed from the metadata index once and then kept up to date.
+
+        If ``copy`` is False, the cached dictionary itself is returned,
+        which must then not be modified.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: DS.save_worksheet(Worksheet('Test', 2, tmp, owner='sageuser'))
+            sage: DS.worksheet_listing_rows('sageuser')[2]['name']
+            u'test'
+            sage: DS.save_worksheet(Worksheet('Other', 2, tmp, owner='sageuser'))
+            sage: DS.worksheet_listing_rows('sageuser')[2]['name']
+            u'other'
+        """
+        from sagenb.notebook.worksheet import listing_row
+        username = str(username)
+        with self._index_lock:
+            rows = self._listing_rows.get(username)
+            if rows is None:
+                index = self.worksheet_index(username, copy=False)
+                rows = dict([(id_number, listing_row(basic))
+                             for id_number, basic in iteritems(index)])
+                self._listing_rows[username] = rows
+            if copy:
+                return dict(rows)
+            return rows
+
+    def worksheet_listing_order(self, username, sort, viewer=None, view=None,
+                                copy=True):
+        """
+        Return the list of pairs ``(key, id_number)`` of the worksheets
+        of the given user, sorted by the key of their listing rows for
+        ``sort`` (see ``LISTING_SORTS`` in
+        :mod:`sagenb.notebook.worksheet`), in increasing order.
+
+        If ``viewer`` is given, only the worksheets which are in the
+        ``view`` (ACTIVE, ARCHIVED or TRASH) of the user ``viewer``
+        are listed.  If ``copy`` is False, the cached list itself is
+        returned, which must then not be modified; it changes when
+        worksheets are saved.
+
+        Each order is sorted once, and then kept sorted as the index
+        changes.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet, TRASH
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: for i, name in enumerate(['b', 'c', 'a']): DS.save_worksheet(Worksheet(name, i, tmp, owner='sageuser'))
+            sage: [id_number for key, id_number in DS.worksheet_listing_order('sageuser', 'name')]
+            [2, 0, 1]
+            sage: DS.save_worksheet(Worksheet('d', 2, tmp, owner='sageuser'))
+            sage: [id_number for key, id_number in DS.worksheet_listing_order('sageuser', 'name')]
+            [0, 1, 2]
+            sage: W = Worksheet('e', 3, tmp, owner='sageuser'); W.set_tags({'sageuser': [TRASH]})
+            sage: trash = DS.worksheet_listing_order('sageuser', 'name', 'sageuser', TRASH, copy=False)
+            sage: trash
+            []
+            sage: DS.save_worksheet(W); [id_number for key, id_number in trash]
+            [3]
+        """
+        from sagenb.notebook.worksheet import listing_view, LISTING_SORTS
+        username = str(username)
+        sort_key = LISTING_SORTS[sort][0]
+        with self._index_lock:
+            orders = self._listing_orders.setdefault(username, {})
+            order = orders.get((sort, viewer, view))
+            if order is None:
+                rows = self.worksheet_listing_rows(username, copy=False)
+                order = sorted([(sort_key(row), id_number)
+                                for id_number, row in iteritems(rows)
+                                if viewer is None or listing_view(row, viewer) == view])
+                orders[(sort, viewer, view)] = order
+            if copy:
+                return list(order)
+            return order
         
-    def worksheets(self, username):
+    def worksheets(self, username, id_numbers=None):
         """
         Return list of all the worksheets belonging to the user with
         given name.  If the given user does not exists, an empty list
         is returned.
 
+        The worksheets are reconstructed from the metadata index (see
+        :meth:`worksheet_index`), so their bodies are only read from
+        disk when needed.
+
+        INPUT:
+
+            - ``username`` -- string
+
+            - ``id_numbers`` -- default: None; if given, an iterable
+              of id numbers, and only those worksheets are returned
+
         EXAMPLES: The load_user_data function must be defined in the
         derived class::
         
@@ -640,19 +1460,189 @@ class FilesystemDatastore(Datastore):
             sage: DS.save_worksheet(W)
             sage: DS.worksheets('sageuser')
             [sageuser/2: [Cell 0: in=, out=]]
+            sage: DS.worksheets('sageuser', [3])
+            []
         """
-        path = self._abspath(self._user_path(username))
-        if not os.path.exists(path): return []
+        index = self.worksheet_index(username, copy=False)
+        if id_numbers is None:
+            id_numbers = sorted(index)
+        with self._index_lock:
+            basics = [(id_number, index[id_number]) for id_number in id_numbers
+                      if id_number in index]
         v = []
-        for id_number in os.listdir(path):
-            if id_number.isdigit():
-                try:
-                    v.append(self.load_worksheet(username, int(id_number)))
-                except Exception:
-                    import traceback
-                    print("Warning: problem loading %s/%s: %s" % (username, id_number, traceback.format_exc()))
+        for id_number, basic in basics:
+            basic = self._copy_basic(basic)
+            basic['owner'] = username
+            basic['id_number'] = id_number
+            W = self._basic_to_worksheet(basic)
+            W._last_basic = self._copy_basic(basic)
+            W._listed_version = W.listing_version()
+            v.append(W)
         return v
 
+    #########################################################################
+    # The full text search index.
+    #
+    # The search index (see sagenb.storage.search_index) covers the
+    # worksheets of all users except _sage_.  Each entry is stamped
+    # with the modification time of worksheet.html and with the name
+    # and publisher of the worksheet, so that entries which went out
+    # of date while the index was not loaded can be detected.
+    #########################################################################
+    def _search_stamp(self, username, id_number, basic):
+        try:
+            mtime = os.path.getmtime(self._abspath(self._worksheet_html_filename(username, id_number)))
+        except OSError:
+            mtime = None
+        return (mtime, basic.get('name'), self._publisher(username, basic))
+
+    def _publisher(self, username, basic):
+        # See Worksheet.publisher
+        came_from = basic.get('worksheet_that_was_published')
+        if came_from:
+            return came_from[0]
+        return username
+
+    def _index_worksheet(self, username, id_number, basic, body=None):
+        """
+        (Re)index the worksheet username/id_number, whose basic
+        Python object is ``basic``.  If ``body`` is not given, it is
+        read from disk.
+        """
+        if username == '_sage_':
+            return
+        filename = '%s/%s' % (username, id_number)
+        stamp = self._search_stamp(username, id_number, basic)
+        if body is None:
+            if self._search_index.stamp(filename) == stamp:
+                return
+            if stamp[0] is None:
+                self._search_index.remove(filename)
+                return
+            with open(self._abspath(self._worksheet_html_filename(username, id_number))) as f:
+                body = f.read().decode('utf-8', 'ignore')
+        try:
+            text = search_text(username, stamp[2], basic.get('name', u''), body)
+        except UnicodeDecodeError:
+            # such worksheets never satisfy a search
+            self._search_index.remove(filename)
+            return
+        self._search_index.add(filename, text, stamp)
+
+    def _refresh_search_index(self):
+        """
+        Bring the search index in sync with the worksheets on disk,
+        only reading the worksheets whose stamp changed.
+        """
+        I = self._search_index
+        home = self._abspath(self._home_path)
+        seen = set()
+        for username in os.listdir(home):
+            if username in ['__store__', '_sage_'] or not os.path.isdir(os.path.join(home, username)):
+                continue
+            for id_number, basic in iteritems(self.worksheet_index(username, copy=False)):
+                filename = '%s/%s' % (username, id_number)
+                seen.add(filename)
+                if I.stamp(filename) != self._search_stamp(username, id_number, basic):
+                    try:
+                        self._index_worksheet(username, id_number, basic)
+                    except (IOError, OSError):
+                        I.remove(filename)
+        for filename in set(I.filenames()).difference(seen):
+            I.remove(filename)
+
+    def search_index(self):
+        """
+        Return the full text search index of the worksheets in this
+        datastore.
+
+        The index is loaded from disk (and brought up to date) the
+        first time it is requested.
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: W = Worksheet('Modular Forms', 2, tmp, owner='sageuser')
+            sage: DS.save_worksheet(W)
+            sage: DS.search_index()
+            Worksheet search index (1 worksheets)
+        """
+        if self._search_index is None:
+            with self._index_lock:
+                if self._search_index is None:
+                    try:
+                        I = self._load(self._search_index_filename)
+                    except Exception:
+                        I = SearchIndex()
+                    self._search_index = I
+                    self._refresh_search_index()
+        return self._search_index
+
+    def save_search_index(self):
+        """
+        Save the full text search index to disk, if it is loaded and
+        changed since it was last saved.
+        """
+        I = self._search_index
+        if I is not None and I.is_dirty():
+            I.set_clean()
+            self._save(I, self._search_index_filename)
+            self._permissions(self._search_index_filename)
+
+    def index_worksheet(self, worksheet):
+        """
+        Update the full text search index with the saved contents of
+        the worksheet.  Unsaved changes are indexed when the worksheet
+        is saved, since searches are checked against the saved text.
+        """
+        if self._search_index is None:
+            return
+        username, id_number = worksheet.owner(), worksheet.id_number()
+        basic = self.worksheet_index(username, copy=False).get(id_number)
+        if basic is None:
+            return
+        try:
+            self._index_worksheet(username, id_number, basic)
+        except (IOError, OSError):
+            self._search_index.remove('%s/%s' % (username, id_number))
+
+    def search_worksheets(self, search):
+        """
+        Return the set of filenames of the worksheets that may satisfy
+        the given search, or None if the search cannot be narrowed
+        down by the index.  Every worksheet that satisfies the search
+        is in the set.
+
+        INPUT:
+
+            - ``search`` -- string; see ``Worksheet.satisfies_search``
+
+        EXAMPLES::
+
+            sage: from sagenb.notebook.worksheet import Worksheet
+            sage: tmp = tmp_dir()
+            sage: from sagenb.storage import FilesystemDatastore
+            sage: DS = FilesystemDatastore(tmp)
+            sage: DS.save_worksheet(Worksheet('Modular Forms', 2, tmp, owner='sageuser'))
+            sage: DS.save_worksheet(Worksheet('Elliptic Curves', 3, tmp, owner='sageuser'))
+            sage: DS.search_worksheets('modular')
+            set(['sageuser/2'])
+            sage: sorted(DS.search_worksheets('SAGEUSER'))
+            ['sageuser/2', 'sageuser/3']
+
+        The index is updated when a worksheet is saved::
+
+            sage: W = DS.load_worksheet('sageuser', 3)
+            sage: W.set_name('Modular Curves')
+            sage: DS.save_worksheet(W)
+            sage: sorted(DS.search_worksheets('modular'))
+            ['sageuser/2', 'sageuser/3']
+        """
+        return self.search_index().candidates(search)
+
     def readonly_user(self, username):
         """
         Each line of the readonly file has a username.
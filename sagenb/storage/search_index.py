@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*
+"""
+A full-text search index for worksheets
+
+Searching worksheets (see :meth:`Worksheet.satisfies_search`) checks
+that each keyword of the search string is a substring of the lower
+cased owner, publisher, name and body of a worksheet.  To avoid
+reading every worksheet from disk for each search, the
+:class:`SearchIndex` maps each sequence of three consecutive
+characters (a trigram) to the set of worksheets whose text contains
+it.  A worksheet can only contain a keyword if it contains all of the
+trigrams of that keyword, so intersecting the corresponding sets gives
+a (usually very small) set of candidates, which then only have to be
+checked with :meth:`Worksheet.satisfies_search`.
+
+Keywords of less than three characters do not narrow down the set of
+candidates.
+"""
+
+import threading
+from hashlib import md5
+
+
+def search_text(owner, publisher, name, body):
+    r"""
+    Return the text that is searched for a worksheet with given
+    owner, publisher, name and body, exactly as it is built by
+    :meth:`Worksheet.satisfies_search`.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.search_index import search_text
+        sage: search_text('sage', 'admin', u'My Worksheet', u'2+2')
+        u'sage admin my worksheet 2+2'
+    """
+    return u" ".join([unicode(x.lower()) for x in [owner, publisher, name, body]])
+
+
+def trigrams(text):
+    """
+    Return the set of trigrams of the string ``text``.
+
+    EXAMPLES::
+
+        sage: from sagenb.storage.search_index import trigrams
+        sage: sorted(trigrams(u'abcab'))
+        [u'abc', u'bca', u'cab']
+        sage: trigrams(u'ab')
+        set([])
+    """
+    return set([text[i:i + 3] for i in range(len(text) - 2)])
+
+
+class SearchIndex(object):
+    def __init__(self):
+        """
+        An inverted index from trigrams to worksheet filenames.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.search_index import SearchIndex
+            sage: SearchIndex()
+            Worksheet search index (0 worksheets)
+        """
+        # filename --> (stamp, digest of the text, frozenset of trigrams)
+        self._documents = {}
+        # trigram --> set of filenames
+        self._postings = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "Worksheet search index (%s worksheets)" % len(self._documents)
+
+    def __getstate__(self):
+        # The postings are redundant and are rebuilt on unpickling.
+        return {'documents': self._documents}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._documents = state['documents']
+        for filename, (stamp, digest, grams) in self._documents.items():
+            for g in grams:
+                self._postings.setdefault(g, set()).add(filename)
+
+    def __contains__(self, filename):
+        return filename in self._documents
+
+    def filenames(self):
+        """
+        Return the list of filenames of the indexed worksheets.
+        """
+        return list(self._documents)
+
+    def stamp(self, filename):
+        """
+        Return the stamp with which the worksheet with given filename
+        was last indexed, or None if it is not indexed.
+        """
+        try:
+            return self._documents[filename][0]
+        except KeyError:
+            return None
+
+    def is_dirty(self):
+        """
+        Return True if the index changed since :meth:`set_clean` was
+        last called.
+        """
+        return self._dirty
+
+    def set_clean(self):
+        self._dirty = False
+
+    def add(self, filename, text, stamp=None):
+        """
+        Index (or reindex) the worksheet with given filename.
+
+        INPUT:
+
+        - ``filename`` -- string; the filename of the worksheet, e.g.,
+          'sage/10'
+
+        - ``text`` -- unicode string; see :func:`search_text`
+
+        - ``stamp`` -- any object; stored with the entry so that the
+          caller can later decide whether it is out of date
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.search_index import SearchIndex
+            sage: I = SearchIndex()
+            sage: I.add('sage/0', u'sage sage hello world', stamp=1)
+            sage: I
+            Worksheet search index (1 worksheets)
+            sage: I.stamp('sage/0')
+            1
+        """
+        digest = md5(text.encode('utf-8', 'ignore')).digest()
+        with self._lock:
+            old = self._documents.get(filename)
+            if old is not None and old[1] == digest:
+                if old[0] != stamp:
+                    self._documents[filename] = (stamp, digest, old[2])
+                    self._dirty = True
+                return
+            grams = frozenset(trigrams(text))
+            if old is not None:
+                for g in old[2].difference(grams):
+                    self._discard(g, filename)
+                new = grams.difference(old[2])
+            else:
+                new = grams
+            for g in new:
+                self._postings.setdefault(g, set()).add(filename)
+            self._documents[filename] = (stamp, digest, grams)
+            self._dirty = True
+
+    def _discard(self, g, filename):
+        S = self._postings.get(g)
+        if S is not None:
+            S.discard(filename)
+            if not S:
+                del self._postings[g]
+
+    def remove(self, filename):
+        """
+        Remove the worksheet with given filename from the index.
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.search_index import SearchIndex
+            sage: I = SearchIndex()
+            sage: I.add('sage/0', u'sage sage hello world')
+            sage: I.remove('sage/0'); I.remove('sage/1')
+            sage: I
+            Worksheet search index (0 worksheets)
+        """
+        with self._lock:
+            old = self._documents.pop(filename, None)
+            if old is None:
+                return
+            for g in old[2]:
+                self._discard(g, filename)
+            self._dirty = True
+
+    def candidates(self, search):
+        """
+        Return the set of filenames of the indexed worksheets that
+        may satisfy the given search, or None if the index cannot
+        narrow down the search (e.g., because all keywords are
+        shorter than three characters).
+
+        The worksheets that are not indexed are never candidates.
+
+        INPUT:
+
+        - ``search`` -- string; see :meth:`Worksheet.satisfies_search`
+
+        EXAMPLES::
+
+            sage: from sagenb.storage.search_index import SearchIndex
+            sage: I = SearchIndex()
+            sage: I.add('sage/0', u'sage sage modular forms')
+            sage: I.add('sage/1', u'sage sage elliptic curves')
+            sage: I.candidates('Modular')
+            set(['sage/0'])
+            sage: sorted(I.candidates('"sage" ve'))
+            ['sage/0', 'sage/1']
+            sage: I.candidates('modular curves')
+            set([])
+            sage: I.candidates('ve') is None
+            True
+        """
+        from sagenb.notebook.worksheet import split_search_string_into_keywords
+        from sagenb.misc.misc import unicode_str
+        grams = set()
+        for W in split_search_string_into_keywords(search):
+            grams.update(trigrams(unicode_str(W).lower()))
+        with self._lock:
+            if not grams:
+                return None
+            # intersect the smallest sets first
+            sets = sorted([self._postings.get(g, ()) for g in grams], key=len)
+            result = set(sets[0])
+            for S in sets[1:]:
+                if not result:
+                    break
+                result.intersection_update(S)
+            return result
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*
+r"""
+Benchmark of parsing the plain text of large worksheets
+
+This times :func:`~sagenb.notebook.worksheet.parse_worksheet_text` and
+:meth:`~sagenb.notebook.worksheet.Worksheet.edit_save` on synthetic
+worksheets with many cells and long outputs, and checks that the
+parser gives the same result as the loop over
+:func:`~sagenb.notebook.worksheet.extract_first_compute_cell` that
+``edit_save`` used before.  Run it with::
+
+    python -m sagenb.testing.parse_benchmark [CELLS [OUTPUT_LINES]]
+
+EXAMPLES::
+
+    sage: from sagenb.testing.parse_benchmark import benchmark
+    sage: sorted(benchmark(cells=20, output_lines=2, repeat=1))
+    ['bytes', 'cells', 'edit_save', 'legacy', 'parse']
+"""
+import shutil
+import tempfile
+import time
+from math import sin
+
+from sagenb.notebook.worksheet import (Worksheet, parse_worksheet_text,
+                                       extract_text_before_first_compute_cell,
+                                       extract_first_compute_cell)
+
+
+def synthetic_worksheet_text(cells=2000, output_lines=40):
+    r"""
+    Return the plain text of a worksheet with ``cells`` compute cells,
+    some of them without id or output, with ``output_lines`` lines of
+    output each and text blocks between some of them.
+
+    EXAMPLES::
+
+        sage: from sagenb.testing.parse_benchmark import synthetic_worksheet_text
+        sage: print(synthetic_worksheet_text(2, 1))
+        {{{id=0|
+        plot(sin(x), 0, 0)
+        ///
+        0 0.000000000000000 0.000000000000000
+        }}}
+        <p>Text 1</p>
+        {{{id=1|
+        plot(sin(x), 0, 1)
+        ///
+        0 0.841470984807897 0.841470984807897
+        }}}
+    """
+    v = []
+    for n in range(cells):
+        if n % 7 == 1:
+            v.append(u'<p>Text %s</p>' % n)
+        meta = u'id=%s|' % n if n % 11 != 5 else u''
+        if n % 13 == 3:
+            v.append(u'{{{%s\nx = %s\n}}}' % (meta, n))
+        else:
+            output = u'\n'.join([u'%s %.15f %.15f' % (i, sin(n + i), sin(n + i))
+                                 for i in range(output_lines)])
+            v.append(u'{{{%s\nplot(sin(x), 0, %s)\n///\n%s\n}}}' % (meta, n, output))
+    return u'\n'.join(v)
+
+
+def legacy_parse_worksheet_text(text):
+    """
+    Split ``text`` like
+    :func:`~sagenb.notebook.worksheet.parse_worksheet_text`, by the
+    loop ``edit_save`` used before, which copies the rest of ``text``
+    for each cell.
+    """
+    data = []
+    while True:
+        plain_text = extract_text_before_first_compute_cell(text).strip()
+        if len(plain_text) > 0:
+            data.append(('plain', plain_text))
+        try:
+            meta, input, output, i = extract_first_compute_cell(text)
+            data.append(('compute', (meta, input, output)))
+        except EOFError:
+            break
+        text = text[i:]
+    return data
+
+
+def _best_time(f, repeat):
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        f()
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def benchmark(cells=2000, output_lines=40, repeat=3):
+    """
+    Return a dictionary with the size in ``bytes`` and the number of
+    ``cells`` of a synthetic worksheet, and the best times in seconds
+    of ``repeat`` runs of the ``parse``, ``legacy`` parsing and of
+    ``edit_save`` on it (twice: once on a new worksheet, once reusing
+    its cells).
+    """
+    text = synthetic_worksheet_text(cells, output_lines)
+    if parse_worksheet_text(text) != legacy_parse_worksheet_text(text):
+        raise AssertionError("the parsers do not agree")
+    directory = tempfile.mkdtemp()
+    try:
+        def edit_save():
+            W = Worksheet('benchmark', 0, directory, owner='benchmark')
+            W.edit_save(text)
+            W.edit_save(text)
+        return {'bytes': len(text.encode('utf-8')),
+                'cells': cells,
+                'parse': _best_time(lambda: parse_worksheet_text(text), repeat),
+                'legacy': _best_time(lambda: legacy_parse_worksheet_text(text), repeat),
+                'edit_save': _best_time(edit_save, repeat)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import sys
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    output_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    B = benchmark(cells, output_lines)
+    print("%(cells)s cells, %(bytes)s bytes: parse %(parse).3fs, "
+          "before %(legacy).3fs; edit_save %(edit_save).3fs" % B)
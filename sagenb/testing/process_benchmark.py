@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*
+r"""
+Benchmark of the worksheet process implementations
+
+This compares the expect implementation of worksheet processes with
+the framed one (see :mod:`sagenb.interfaces.framed`) on plain Python
+code: the ``latency`` of many small computations, each waited for
+like a cell evaluation, and the ``throughput`` of a computation that
+prints a lot of output.  It also checks that both give the same
+output.  Run it with::
+
+    python -m sagenb.testing.process_benchmark [COMPUTATIONS [OUTPUT_LINES]]
+
+EXAMPLES::
+
+    sage: from sagenb.testing.process_benchmark import benchmark
+    sage: B = benchmark(computations=5, output_lines=100, python=sys.executable)
+    sage: sorted(B), sorted(B['framed'])
+    (['expect', 'framed'], ['latency', 'output', 'throughput'])
+"""
+import sys
+import time
+
+from sagenb.interfaces import (WorksheetProcess_ExpectImplementation,
+                               WorksheetProcess_FramedImplementation)
+
+IMPLEMENTATIONS = [('expect', WorksheetProcess_ExpectImplementation),
+                   ('framed', WorksheetProcess_FramedImplementation)]
+
+
+def run(W, code, timeout=60):
+    """
+    Execute ``code`` in the worksheet process ``W`` and return its
+    output once it is done, like a cell evaluation.
+    """
+    W.execute(code)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        W.wait_for_output(1)
+        O = W.output_status()
+        if O.done:
+            return O.output
+    raise RuntimeError("the computation did not finish in %s seconds" % timeout)
+
+
+def benchmark(computations=200, output_lines=100000, python='python'):
+    """
+    Return a dictionary with, for each implementation, the average
+    ``latency`` in seconds of ``computations`` small computations, the
+    ``throughput`` in bytes per second of a computation printing
+    ``output_lines`` lines, and the number of bytes of that
+    ``output``.
+    """
+    code = 'for i in range(%s): print("%%s %%s" %% (i, i * i))' % output_lines
+    results = {}
+    outputs = {}
+    for name, cls in IMPLEMENTATIONS:
+        W = cls(python=python)
+        try:
+            run(W, '0')  # start the process
+            t = time.time()
+            for i in range(computations):
+                if str(i + 1) not in run(W, '%s+1' % i).split():
+                    raise AssertionError("wrong output of %s" % name)
+            latency = (time.time() - t) / computations
+            t = time.time()
+            output = run(W, code).replace('\r\n', '\n')
+            t = time.time() - t
+        finally:
+            W.quit()
+        outputs[name] = output
+        results[name] = {'latency': latency,
+                         'throughput': len(output) / t,
+                         'output': len(output)}
+    # the terminal of the expect process may add control sequences
+    if outputs['framed'] not in outputs['expect']:
+        raise AssertionError("the implementations give different output")
+    return results
+
+
+if __name__ == '__main__':
+    computations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    output_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    results = benchmark(computations, output_lines, python=sys.executable)
+    for name, B in sorted(results.items()):
+        print("%s: %.2fms per computation, %.1f MB/s of output (%s bytes)"
+              % (name, 1000 * B['latency'], B['throughput'] / 1e6, B['output']))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*
+r"""
+Simulation of the placement of worksheet processes on a server pool
+
+This runs the policies of :class:`~sagenb.interfaces.scheduler.HostScheduler`
+on a simulated cluster standing in for the hosts of a ``server_pool``:
+hosts with different numbers of CPUs, memory and load from other
+users, to which worksheet sessions arrive at random and leave after a
+while.  Each worksheet process uses some memory, and is busy computing
+part of the time.  The hosts are probed like with ssh, giving their
+one minute load average and their available memory.
+
+For each policy, it reports the largest number of processes on one
+host, the average ``slowdown`` of the computations (how many busy
+processes share a CPU, at least 1), the fraction of the time a host is
+``overloaded`` (more busy processes than CPUs) and the number of times
+a host ran ``out_of_memory``.  Run it with::
+
+    python -m sagenb.testing.scheduler_benchmark [HOURS [SESSIONS_PER_HOUR]]
+
+EXAMPLES::
+
+    sage: from sagenb.testing.scheduler_benchmark import benchmark
+    sage: B = benchmark(hours=1, sessions_per_hour=20)
+    sage: sorted(B['least-processes'])
+    ['max_processes', 'out_of_memory', 'overloaded', 'slowdown']
+"""
+import math
+import random
+
+from sagenb.interfaces.scheduler import HostScheduler, POLICIES
+
+# name, CPUs, memory (GB), load of other users
+CLUSTER = [('sage@big', 16, 64, 0.0),
+           ('sage@node1', 8, 16, 0.0),
+           ('sage@node2', 8, 16, 0.0),
+           ('sage@shared', 8, 16, 6.0),
+           ('sage@small', 4, 8, 0.0)]
+
+GB = 2**30
+
+# seconds of simulated time per step
+STEP = 10
+
+
+class SimulatedProcess(object):
+    def __init__(self, memory, busy, end):
+        self.memory = memory
+        self.busy = busy
+        self.end = end
+        self.running = True
+
+    def is_started(self):
+        return self.running
+
+
+class SimulatedHost(object):
+    def __init__(self, name, cpus, memory, other_load):
+        self.name = name
+        self.cpus = cpus
+        self.memory = memory * GB
+        self.other_load = other_load
+        self.processes = []
+        self.load = other_load
+        self.busy = 0
+
+    def used_memory(self):
+        return sum([P.memory for P in self.processes]) + int(self.other_load * GB)
+
+    def step(self, rng):
+        self.busy = self.other_load + len([P for P in self.processes
+                                           if rng.random() < P.busy])
+        # one minute load average
+        self.load += (self.busy - self.load) * (1 - math.exp(-STEP / 60.0))
+
+    def probe(self):
+        return {'load': self.load, 'cpus': self.cpus,
+                'memory': max(self.memory - self.used_memory(), 0)}
+
+
+def simulate(policy, hours=8, sessions_per_hour=120, cluster=CLUSTER, seed=0):
+    """
+    Simulate ``hours`` hours of worksheet sessions arriving at an
+    average rate of ``sessions_per_hour`` on ``cluster``, placed by
+    the ``policy`` of a :class:`~sagenb.interfaces.scheduler.HostScheduler`,
+    and return the dictionary of the results.
+    """
+    rng = random.Random(seed)
+    hosts = dict([(name, SimulatedHost(name, *rest)) for name, rest in
+                  [(c[0], c[1:]) for c in cluster]])
+    names = [c[0] for c in cluster]
+    now = [0]
+    scheduler = HostScheduler(policy, probe=lambda h: hosts[h].probe(),
+                              background=False, clock=lambda: now[0])
+    max_processes = 0
+    slowdown = busy = 0.0
+    overloaded = out_of_memory = 0
+    steps = int(hours * 3600 / STEP)
+    for i in range(steps):
+        now[0] = i * STEP
+        for k in range(_poisson(rng, sessions_per_hour * STEP / 3600.0)):
+            P = SimulatedProcess(memory=int(rng.uniform(0.2, 2.0) * GB),
+                                 busy=rng.choice([0.05, 0.1, 0.3, 0.9]),
+                                 end=now[0] + rng.expovariate(1 / 1800.0))
+            name = scheduler.choose(names)
+            hosts[name].processes.append(P)
+            scheduler.add(name, P)
+        for H in hosts.values():
+            for P in H.processes:
+                if P.end <= now[0]:
+                    P.running = False
+            H.processes = [P for P in H.processes if P.running]
+            H.step(rng)
+            max_processes = max(max_processes, len(H.processes))
+            n = H.busy - H.other_load
+            if n > 0:
+                busy += n
+                slowdown += n * max(1.0, H.busy / float(H.cpus))
+            overloaded += H.busy > H.cpus
+            out_of_memory += H.used_memory() > H.memory
+    return {'max_processes': max_processes,
+            'slowdown': slowdown / busy if busy else 1.0,
+            'overloaded': overloaded / float(steps * len(hosts)),
+            'out_of_memory': out_of_memory}
+
+
+def _poisson(rng, mean):
+    # Knuth's algorithm, fine for small means
+    L = math.exp(-mean)
+    k = 0
+    p = rng.random()
+    while p > L:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+def benchmark(hours=8, sessions_per_hour=120, seed=0):
+    """
+    Return a dictionary with the results of :func:`simulate` for each
+    policy.
+    """
+    return dict([(policy, simulate(policy, hours, sessions_per_hour, seed=seed))
+                 for policy in POLICIES])
+
+
+if __name__ == '__main__':
+    import sys
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    sessions_per_hour = float(sys.argv[2]) if len(sys.argv) > 2 else 120
+    results = benchmark(hours, sessions_per_hour)
+    for policy, B in sorted(results.items()):
+        B = dict(B, policy=policy, overloaded=100 * B['overloaded'])
+        print("%(policy)-16s at most %(max_processes)3s processes on a host, "
+              "slowdown %(slowdown).2f, overloaded %(overloaded).1f%% of the "
+              "time, out of memory %(out_of_memory)s times" % B)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*
+r"""
+Benchmark of starting remote worksheet processes over ssh
+
+This times how long a new
+:class:`~sagenb.interfaces.expect.WorksheetProcess_RemoteExpectImplementation`
+takes to start and run its first computation, with its own ssh
+connection (``direct``) and over a shared master connection
+(``multiplexed``, see :mod:`sagenb.interfaces.ssh`), and how long
+opening the ``master`` connection takes.  Run it with::
+
+    python -m sagenb.testing.ssh_benchmark [USER@HOST [STARTS [REMOTE_PYTHON]]]
+
+``USER@HOST`` must accept logins with ssh keys.  Without sshd, the
+ssh command can be replaced by :mod:`sagenb.testing.ssh_standin`, by
+setting ``SAGENB_SSH`` to ``python -m sagenb.testing.ssh_standin``.
+
+EXAMPLES::
+
+    sage: from sagenb.testing.ssh_benchmark import benchmark
+    sage: ssh = sys.executable + ' -m sagenb.testing.ssh_standin'
+    sage: B = benchmark('sage@localhost', starts=2, ssh=ssh, remote_python=sys.executable)
+    sage: sorted(B)
+    ['direct', 'master', 'multiplexed']
+    sage: B['multiplexed'] < B['direct']
+    True
+"""
+import os
+import time
+
+from sagenb.interfaces import (WorksheetProcess_RemoteExpectImplementation,
+                               SSHConnections)
+from sagenb.testing.process_benchmark import run
+
+
+class DirectConnections(SSHConnections):
+    """
+    The ssh command of :class:`~sagenb.interfaces.ssh.SSHConnections`,
+    without master connections.
+    """
+    def options(self, user_at_host):
+        return []
+
+
+def time_starts(user_at_host, connections, starts, remote_python):
+    """
+    Return the average number of seconds a new remote worksheet
+    process using ``connections`` takes to run its first computation.
+    """
+    total = 0
+    for i in range(starts):
+        W = WorksheetProcess_RemoteExpectImplementation(user_at_host, remote_python,
+                                                        connections=connections)
+        t = time.time()
+        try:
+            run(W, '0')
+            total += time.time() - t
+        finally:
+            W.quit()
+    return total / starts
+
+
+def benchmark(user_at_host='localhost', starts=10, ssh='sage-native-execute ssh',
+              remote_python='python'):
+    """
+    Return a dictionary with the average time in seconds ``starts``
+    remote worksheet processes on ``user_at_host`` take to run their
+    first computation, ``direct`` and ``multiplexed``, and the time
+    opening the ``master`` connection takes.
+    """
+    connections = SSHConnections(ssh)
+    try:
+        t = time.time()
+        if not connections.options(user_at_host):
+            raise RuntimeError("unable to open a master connection to %s" % user_at_host)
+        master = time.time() - t
+        return {'direct': time_starts(user_at_host, DirectConnections(ssh),
+                                      starts, remote_python),
+                'multiplexed': time_starts(user_at_host, connections,
+                                           starts, remote_python),
+                'master': master}
+    finally:
+        connections.close_all()
+
+
+if __name__ == '__main__':
+    import sys
+    user_at_host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    starts = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    remote_python = sys.argv[3] if len(sys.argv) > 3 else 'python'
+    ssh = os.environ.get('SAGENB_SSH', 'sage-native-execute ssh')
+    B = benchmark(user_at_host, starts, ssh, remote_python)
+    print("%s: first computation after %.3fs with a new connection, "
+          "%.3fs over the master connection (opened in %.3fs)"
+          % (user_at_host, B['direct'], B['multiplexed'], B['master']))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*
+r"""
+A stand-in for ssh to test remote worksheet processes without sshd
+
+Run as ``python -m sagenb.testing.ssh_standin [OPTIONS] USER@HOST
+[COMMAND]``, it understands the options of ssh that
+:class:`~sagenb.interfaces.ssh.SSHConnections` and
+:class:`~sagenb.interfaces.expect.WorksheetProcess_RemoteExpectImplementation`
+use, and runs ``COMMAND`` on the local machine.  Opening a connection
+takes ``SAGENB_SSH_STANDIN_DELAY`` seconds (default: 0.3), except for
+a session over a master connection, which is a file at the
+``ControlPath``.
+
+EXAMPLES::
+
+    sage: import subprocess
+    sage: ssh = [sys.executable, '-m', 'sagenb.testing.ssh_standin']
+    sage: subprocess.check_output(ssh + ['-t', 'sage@localhost', 'echo hello'])
+    'hello\n'
+"""
+import os
+import sys
+import time
+
+DELAY = float(os.environ.get('SAGENB_SSH_STANDIN_DELAY', 0.3))
+
+
+def main(args):
+    options = {}
+    control = None
+    while args and args[0].startswith('-'):
+        flag = args.pop(0)
+        if flag == '-o':
+            key, value = args.pop(0).split('=', 1)
+            options[key] = value
+        elif flag == '-O':
+            control = args.pop(0)
+    args.pop(0)  # user@host
+    path = options.get('ControlPath')
+
+    if control == 'check':
+        return 0 if path and os.path.exists(path) else 255
+    if control == 'exit':
+        if path and os.path.exists(path):
+            os.remove(path)
+            return 0
+        return 255
+    if options.get('ControlMaster') == 'yes':
+        time.sleep(DELAY)
+        open(path, 'w').close()
+        return 0
+    if not (path and os.path.exists(path)):
+        time.sleep(DELAY)
+    if args:
+        os.execvp('sh', ['sh', '-c', ' '.join(args)])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))